@@ -14,6 +14,7 @@ import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from matplotlib.backends.backend_pdf import PdfPages
+from proc_catalog import list_dir
 from argparse import ArgumentParser,RawTextHelpFormatter
 
 # Constants
@@ -88,7 +89,7 @@ for year in data_years:
     dnam = os.path.join(args.inpdir,ystr)
     if not os.path.isdir(dnam):
         continue
-    for f in sorted(os.listdir(dnam)):
+    for f in list_dir(dnam):
         m = re.search('^('+'\d'*8+')_indices\.tif$',f)
         if not m:
             continue
@@ -12,6 +12,7 @@ from shapely.geometry import shape
 from datetime import datetime
 from matplotlib.dates import date2num
 import numpy as np
+from proc_catalog import list_dir
 from argparse import ArgumentParser,RawTextHelpFormatter
 
 # Constants
@@ -87,7 +88,7 @@ for year in data_years:
     dnam = os.path.join(args.inpdir,ystr)
     if not os.path.isdir(dnam):
         continue
-    for f in sorted(os.listdir(dnam)):
+    for f in list_dir(dnam):
         m = re.search('^('+'\d'*8+')_geocor\.tif$',f)
         if not m:
             continue
@@ -16,6 +16,7 @@ except Exception:
     from StringIO import StringIO
 from subprocess import check_output,call
 from argparse import ArgumentParser,RawTextHelpFormatter
+from proc_gcp import read_gcps
 
 # Default values
 SCRDIR = os.path.dirname(os.path.abspath(sys.argv[0]))
@@ -69,9 +70,9 @@ parser.add_argument('-r','--rthr',default=None,type=float,help='Threshold of cor
 parser.add_argument('-E','--feps',default=None,type=float,help='Step length for curve_fit (%(default)s)')
 parser.add_argument('--img_fnam',default=None,help='Image file name (%(default)s)')
 parser.add_argument('--scan_fnam',default=None,help='Scan file name (%(default)s)')
-parser.add_argument('-g','--use_gcps',default=None,help='GCP file name to use (%(default)s)')
+parser.add_argument('-g','--use_gcps',default=None,help='GCP file name to use, binary if the extension is .npy (%(default)s)')
 parser.add_argument('-G','--save_gcps',default=None,help='GCP file name to save (%(default)s)')
-parser.add_argument('--optfile',default=None,help='Option file name for gdal_translate (%(default)s)')
+parser.add_argument('--optfile',default=None,help='Option file name for ogr2ogr (%(default)s)')
 parser.add_argument('--trg_shapefile',default=None,help='Target shapefile (%(default)s)')
 parser.add_argument('-e','--trg_epsg',default=None,help='Target EPSG (guessed from target data)')
 parser.add_argument('-n','--npoly',default=None,type=int,help='Order of polynomial used for warping between 1 and 3 (selected based on the number of GCPs)')
@@ -86,6 +87,9 @@ parser.add_argument('--minimum_ratio',default=MINIMUM_RATIO,type=float,help='Min
 parser.add_argument('--discard_number',default=None,type=int,help='Maximum number of GCPs to be discarded by refine_gcps (%(default)s)')
 parser.add_argument('--refine_number',default=REFINE_NUMBER,type=int,help='Minimum number of GCPs to perform refine_gcps (%(default)s)')
 parser.add_argument('--tr',default=None,type=float,help='Output resolution in output georeferenced units (%(default)s)')
+parser.add_argument('--te',default=None,type=float,nargs=4,help='Output extent (xmin ymin xmax ymax) in output georeferenced units, pixel edges (%(default)s)')
+parser.add_argument('--ot',default=None,help='Output data type (%(default)s)')
+parser.add_argument('--dstnodata',default=None,help='Output no-data value (%(default)s)')
 parser.add_argument('--tps',default=False,action='store_true',help='Use thin plate spline transformer (%(default)s)')
 parser.add_argument('--exp',default=False,action='store_true',help='Output in exp format (%(default)s)')
 parser.add_argument('--long',default=False,action='store_true',help='Output in long format (%(default)s)')
@@ -112,12 +116,8 @@ if trg_fnam is not None:
     trg_bnam = os.path.splitext(os.path.basename(trg_fnam))[0]
     if args.out_fnam is None:
         out_fnam = trg_bnam+'_geocor.tif'
-        tmp_fnam = trg_bnam+'_tmp.tif'
     else:
         out_fnam = args.out_fnam
-        out_dnam = os.path.dirname(out_fnam)
-        tmp_fnam = os.path.join(out_dnam,trg_bnam+'_tmp.tif')
-    tmp_xnam = tmp_fnam+'.aux.xml'
     if (args.trg_epsg is None) or (args.resampling2_band_name is not None):
         ds = gdal.Open(trg_fnam)
         if args.trg_epsg is None:
@@ -234,99 +234,103 @@ else:
         with open(args.save_gcps,'w') as fp:
             fp.write(out)
 try:
-    xi,yi,xp,yp,dx,dy,r = np.loadtxt(fnam,usecols=(0,1,2,3,4,5,6),unpack=True)
+    gcps = read_gcps(fnam)
+    xi = gcps['xc']
+    yi = gcps['yc']
+    xp = gcps['xp']
+    yp = gcps['yp']
     if xi.size < args.minimum_number:
         raise ValueError('Error, not enough GCP points.')
 except Exception:
     sys.exit()
 
+def copy_bands(ds1,ds2,dst_ds):
+    # Copy by strips of blocks, all the bands of a strip are warped at once
+    nstp = ds1.GetRasterBand(1).GetBlockSize()[1]*16
+    for y1 in range(0,ds1.RasterYSize,nstp):
+        y2 = min(y1+nstp,ds1.RasterYSize)
+        data1 = ds1.ReadAsArray(0,y1,ds1.RasterXSize,y2-y1).reshape(ds1.RasterCount,y2-y1,ds1.RasterXSize)
+        data2 = ds2.ReadAsArray(0,y1,ds2.RasterXSize,y2-y1).reshape(ds2.RasterCount,y2-y1,ds2.RasterXSize)
+        for i in range(dst_ds.RasterCount):
+            band_number = i+1
+            if band_number in args.resampling2_band:
+                data = data2[args.resampling2_band.index(band_number)]
+            else:
+                data = data1[i]
+            dst_ds.GetRasterBand(band_number).WriteArray(data,0,y1)
+    return
+
 if trg_fnam is not None:
-    command = 'gdal_translate'
+    # GCPs are attached and warped in memory (VRT), and only the output is written to disk.
     line = ''
     for i,j,x,y in zip(xi,yi,xp,yp):
         line += ' -gcp {} {} {} {}'.format(i,j,x,y)
-    if args.optfile is not None:
-        with open(args.optfile,'w') as fp:
-            fp.write(line)
-        command += ' --optfile {}'.format(args.optfile)
-    else:
-        command += line
-    command += ' '+trg_fnam
-    command += ' '+tmp_fnam
-    call(command,shell=True)
-    if args.optfile is not None:
-        if os.path.exists(args.optfile):
-            os.remove(args.optfile)
-
-    command = 'gdalwarp'
-    command += ' -t_srs EPSG:{}'.format(args.trg_epsg)
-    command += ' -overwrite'
+    tmp_ds = gdal.Translate('',trg_fnam,options='-of VRT'+line)
+    if tmp_ds is None:
+        raise ValueError('Error in adding GCPs >>> {}'.format(trg_fnam))
+    options = '-t_srs EPSG:{}'.format(args.trg_epsg)
+    if args.te is not None: # warp into the final grid
+        options += ' -te {} {} {} {}'.format(*args.te)
     if args.tr is not None:
-        command += ' -tr {} {}'.format(args.tr,args.tr)
-        command += ' -tap'
+        options += ' -tr {} {}'.format(args.tr,args.tr)
+        if args.te is None:
+            options += ' -tap'
+    if args.ot is not None:
+        options += ' -ot {}'.format(args.ot)
+    if args.dstnodata is not None:
+        options += ' -dstnodata {}'.format(args.dstnodata)
     if args.tps:
-        command += ' -tps'
+        options += ' -tps'
     elif args.npoly is not None:
-        command += ' -order {}'.format(args.npoly)
+        options += ' -order {}'.format(args.npoly)
     if args.refine_gcps is not None and xi.size >= args.refine_number:
         if args.minimum_gcps is None:
             if args.discard_number is not None:
                 args.minimum_gcps = xi.size-args.discard_number
             else:
                 args.minimum_gcps = int(args.minimum_ratio*xi.size+0.5)
-        command += ' -refine_gcps {} {}'.format(args.refine_gcps,args.minimum_gcps)
+        options += ' -refine_gcps {} {}'.format(args.refine_gcps,args.minimum_gcps)
+    if os.path.exists(out_fnam):
+        os.remove(out_fnam)
     if args.resampling2_band is not None:
-        if args.out_fnam is None:
-            tmp2_fnam = trg_bnam+'_tmp2.tif'
-            out1_fnam = trg_bnam+'_geocor1.tif'
-            out2_fnam = trg_bnam+'_geocor2.tif'
-        else:
-            tmp2_fnam = os.path.join(out_dnam,trg_bnam+'_tmp2.tif')
-            out1_fnam = os.path.join(out_dnam,trg_bnam+'_geocor1.tif')
-            out2_fnam = os.path.join(out_dnam,trg_bnam+'_geocor2.tif')
-        tmp2_xnam = tmp2_fnam+'.aux.xml'
-        command1 = command + ' -r {}'.format(args.resampling)
-        command1 += ' '+tmp_fnam
-        command1 += ' '+out1_fnam
-        command2 = command + ' -r {}'.format(args.resampling2)
-        command2 += ' '+tmp2_fnam
-        command2 += ' '+out2_fnam
-        command = 'gdal_translate'
-        for band_number in args.resampling2_band:
-            command += ' -b {}'.format(band_number)
-        command += ' '+tmp_fnam
-        command += ' '+tmp2_fnam
-        call(command,shell=True)
-        call(command1,shell=True)
-        call(command2,shell=True)
-        ds1 = gdal.Open(out1_fnam)
-        ds2 = gdal.Open(out2_fnam)
+        ds1 = gdal.Warp('',tmp_ds,options=options+' -of VRT -r {}'.format(args.resampling))
+        tmp2_ds = gdal.Translate('',tmp_ds,options='-of VRT'+''.join([' -b {}'.format(band_number) for band_number in args.resampling2_band]))
+        ds2 = gdal.Warp('',tmp2_ds,options=options+' -of VRT -r {}'.format(args.resampling2))
+        if ds1 is None or ds2 is None:
+            raise ValueError('Error in warping >>> {}'.format(trg_fnam))
         drv = gdal.GetDriverByName('GTiff')
-        ds = drv.CreateCopy(out_fnam,ds1,strict=0)
-        for i,band_number in enumerate(args.resampling2_band):
-            band = ds2.GetRasterBand(i+1)
-            ds.GetRasterBand(band_number).WriteArray(band.ReadAsArray())
+        ds = drv.Create(out_fnam,ds1.RasterXSize,ds1.RasterYSize,ds1.RasterCount,ds1.GetRasterBand(1).DataType)
+        ds.SetGeoTransform(ds1.GetGeoTransform())
+        ds.SetProjection(ds1.GetProjection())
+        ds.SetMetadata(ds1.GetMetadata())
+        for i in range(ds1.RasterCount):
+            band_number = i+1
+            src_band = ds1.GetRasterBand(band_number)
+            if band_number in args.resampling2_band:
+                band = ds2.GetRasterBand(args.resampling2_band.index(band_number)+1)
+            else:
+                band = src_band
+            out_band = ds.GetRasterBand(band_number)
+            out_band.SetDescription(src_band.GetDescription())
+            out_band.SetMetadata(src_band.GetMetadata())
+            if src_band.GetColorInterpretation() != gdal.GCI_Undefined:
+                out_band.SetColorInterpretation(src_band.GetColorInterpretation())
+            nodata = band.GetNoDataValue()
+            if nodata is not None:
+                out_band.SetNoDataValue(nodata)
+        copy_bands(ds1,ds2,ds)
         ds.FlushCache()
         ds = None
         ds1 = None
         ds2 = None
-        if os.path.exists(tmp2_fnam):
-            os.remove(tmp2_fnam)
-        if os.path.exists(tmp2_xnam):
-            os.remove(tmp2_xnam)
-        if os.path.exists(out1_fnam):
-            os.remove(out1_fnam)
-        if os.path.exists(out2_fnam):
-            os.remove(out2_fnam)
+        tmp2_ds = None
     else:
-        command += ' -r {}'.format(args.resampling)
-        command += ' '+tmp_fnam
-        command += ' '+out_fnam
-        call(command,shell=True)
-    if os.path.exists(tmp_fnam):
-        os.remove(tmp_fnam)
-    if os.path.exists(tmp_xnam):
-        os.remove(tmp_xnam)
+        ds = gdal.Warp(out_fnam,tmp_ds,options=options+' -r {}'.format(args.resampling))
+        if ds is None:
+            raise ValueError('Error in warping >>> {}'.format(trg_fnam))
+        ds.FlushCache()
+        ds = None
+    tmp_ds = None
 
 if args.trg_shapefile is not None:
     if args.out_fnam is None:
@@ -2,6 +2,11 @@
 import os
 import sys
 import re
+import json
+import time
+import hashlib
+import tempfile
+import threading
 try:
     import gdal
 except Exception:
@@ -11,9 +16,12 @@ try:
 except Exception:
     from osgeo import osr
 import numpy as np
+from collections import deque
 from scipy.interpolate import RegularGridInterpolator
 from scipy.optimize import leastsq
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser,RawTextHelpFormatter
+from proc_gcp import read_gcps,format_gcp,write_gcps
 
 # Default values
 REF_BAND = 5 # WorldView Red
@@ -28,6 +36,16 @@ MARGIN_WIDTH = 5 # pixel
 MARGIN_HEIGHT = 5 # pixel
 SCAN_STEP = 1 # pixel
 INTERP = 'linear'
+SCAN_METHOD = 'fft'
+NPROC = 1
+STRIP_HEIGHT = 512 # pixel
+PYRAMID_RADIUS = 2 # pixel
+PYRAMID_MIN_SIZE = 10 # pixel
+PRIOR_SHIFT = 2 # pixel
+FLAG_VALUES = [0,1,3,8,9,10] # SCL no data, saturated, cloud shadow, cloud medium/high probability, cirrus
+REF_CACHE_DAYS = 30 # day
+GCP_COVER = 0.8
+COVER_GRID = 4
 RTHR = 0.3
 FEPS = 0.01
 
@@ -35,11 +53,14 @@ FEPS = 0.01
 parser = ArgumentParser(formatter_class=lambda prog:RawTextHelpFormatter(prog,max_help_position=200,width=200))
 parser.add_argument('trg_fnam',default=None,help='Target image (%(default)s)')
 parser.add_argument('ref_fnam',default=None,help='Reference image (%(default)s)')
-parser.add_argument('-o','--out_fnam',default=None,help='Output file name (%(default)s)')
+parser.add_argument('-o','--out_fnam',default=None,help='Output file name, binary if the extension is .npy (%(default)s)')
 parser.add_argument('-b','--ref_band',default=REF_BAND,type=int,help='Reference band# from 1 (%(default)s)')
 parser.add_argument('--ref_band_name',default=None,help='Reference band name (%(default)s)')
 parser.add_argument('-B','--trg_band',default=TRG_BAND,type=int,help='Target band# from 1 (%(default)s)')
 parser.add_argument('--trg_band_name',default=None,help='Target band name (%(default)s)')
+parser.add_argument('--ref_pixel',default=None,type=float,help='Reference pixel size in m after block averaging (%(default)s)')
+parser.add_argument('--ref_cache_dir',default=None,help='Reference cache directory (%(default)s)')
+parser.add_argument('--ref_cache_days',default=REF_CACHE_DAYS,type=float,help='Remove cached references not used for this period in day (%(default)s)')
 parser.add_argument('--ref_multi_band',default=None,type=int,action='append',help='Reference multi-band number from 1 (%(default)s)')
 parser.add_argument('--ref_multi_band_name',default=None,action='append',help='Reference multi-band name (%(default)s)')
 parser.add_argument('--ref_multi_ratio',default=None,type=float,action='append',help='Reference multi-band ratio (%(default)s)')
@@ -62,13 +83,27 @@ parser.add_argument('--margin_width',default=MARGIN_WIDTH,type=int,help='Margin
 parser.add_argument('--margin_height',default=MARGIN_HEIGHT,type=int,help='Margin height in target pixel (%(default)s)')
 parser.add_argument('--scan_indx_step',default=SCAN_STEP,type=int,help='Scan step x index (%(default)s)')
 parser.add_argument('--scan_indy_step',default=SCAN_STEP,type=int,help='Scan step y index (%(default)s)')
+parser.add_argument('--pyramid_levels',default=None,type=int,help='Number of coarser levels for coarse-to-fine search, 0 to disable (auto)')
+parser.add_argument('--pyramid_radius',default=PYRAMID_RADIUS,type=int,help='Search radius around the shift of the coarser level in pixel (%(default)s)')
+parser.add_argument('--prior_fnam',default=None,action='append',help='GCP file of a neighboring acquisition used as prior (%(default)s)')
+parser.add_argument('--prior_shift',default=PRIOR_SHIFT,type=int,help='Max shift from the prior in target pixel (%(default)s)')
+parser.add_argument('--prior_rmin',default=None,type=float,help='Min correlation coefficient of the prior (rthr)')
 parser.add_argument('--ref_data_min',default=None,type=float,help='Minimum reference data value (%(default)s)')
 parser.add_argument('--ref_data_max',default=None,type=float,help='Maximum reference data value (%(default)s)')
 parser.add_argument('--trg_data_min',default=None,type=float,help='Minimum target data value (%(default)s)')
 parser.add_argument('--trg_data_max',default=None,type=float,help='Maximum target data value (%(default)s)')
+parser.add_argument('--trg_flag_band_name',default=None,help='Target flag band name, e.g. quality_scene_classification (%(default)s)')
+parser.add_argument('--trg_flag_value',default=None,type=int,action='append',help='Target flag value to exclude ({})'.format(FLAG_VALUES))
+parser.add_argument('--flag_max',default=None,type=float,help='Max fraction of flagged or invalid target pixels in a subset, not checked if None (%(default)s)')
+parser.add_argument('--trg_std_min',default=None,type=float,help='Min standard deviation of target data in a subset (%(default)s)')
 parser.add_argument('--ref_data_umax',default=None,type=float,help='Maximum reference data value to use (%(default)s)')
 parser.add_argument('--ref_data_umin',default=None,type=float,help='Minimum reference data value to use (%(default)s)')
 parser.add_argument('-I','--interp',default=INTERP,help='Interpolation method (%(default)s)')
+parser.add_argument('--scan_method',default=SCAN_METHOD,help='Scan method, fft (linear interpolation only) or direct (%(default)s)')
+parser.add_argument('-n','--nproc',default=NPROC,type=int,help='Number of threads to process subsets (%(default)s)')
+parser.add_argument('--gcp_nstop',default=None,type=int,help='Number of GCPs to stop the search in adaptive sampling mode (%(default)s)')
+parser.add_argument('--gcp_cover',default=GCP_COVER,type=float,help='Min fraction of grid cells with GCPs to stop the search (%(default)s)')
+parser.add_argument('--cover_grid',default=COVER_GRID,type=int,help='Number of grid cells in each direction to check coverage (%(default)s)')
 parser.add_argument('-r','--rthr',default=RTHR,type=float,help='Threshold of correlation coefficient (%(default)s)')
 parser.add_argument('-E','--feps',default=FEPS,type=float,help='Step length for curve_fit (%(default)s)')
 parser.add_argument('--img_fnam',default=None,help='Image file name (%(default)s)')
@@ -80,74 +115,389 @@ parser.add_argument('-u','--use_edge',default=False,action='store_true',help='Us
 parser.add_argument('-v','--verbose',default=False,action='store_true',help='Verbose mode (%(default)s)')
 parser.add_argument('-d','--debug',default=False,action='store_true',help='Debug mode (%(default)s)')
 args = parser.parse_args()
+if not args.scan_method in ['fft','direct']:
+    raise ValueError('Error, unknown scan method >>> {}'.format(args.scan_method))
+if args.prior_rmin is None:
+    args.prior_rmin = args.rthr
+if args.trg_flag_value is None:
+    args.trg_flag_value = FLAG_VALUES
 
-def interp_img(p,refx,refy,refz,trgx,trgy,trgz):
-    f = RegularGridInterpolator((trgx+p[0],trgy[::-1]+p[1]),trgz[::-1].T,method=args.interp)
-    xg,yg = np.meshgrid(refx,refy)
-    intz = f(np.array((xg,yg)).T).T
+def get_pyramid_levels(shift_width,shift_height):
+    if args.pyramid_levels is not None:
+        return args.pyramid_levels
+    # Use coarser levels as long as the search window at the coarsest level is wider than the refinement window
+    levels = 0
+    while max(shift_width,shift_height) > args.pyramid_radius*2**(levels+1) and \
+          min(args.subset_width,args.subset_height)//2**(levels+1) >= PYRAMID_MIN_SIZE:
+        levels += 1
+    return levels
+
+def lerp(a,b,w):
+    # Linear interpolation, the neighbor with zero weight is not used even if it is NaN
+    z = a*(1.0-w)+b*w
+    cnd = np.isnan(z)
+    if np.any(cnd):
+        w = np.broadcast_to(w,z.shape)
+        c = cnd & (w == 0.0)
+        z[c] = np.broadcast_to(a,z.shape)[c]
+        c = cnd & (w == 1.0)
+        z[c] = np.broadcast_to(b,z.shape)[c]
+    return z
+
+def make_interp(refx,refy,trgx,trgy,trgz):
+    # Interpolation of the target subset at the reference coordinates, prepared once per subset.
+    # Shifting the target grid by p is equivalent to shifting the reference coordinates by -p.
+    if args.interp == 'linear':
+        # Separable bilinear interpolation on the regular target grid
+        trg_ny,trg_nx = trgz.shape
+        xstp = trgx[1]-trgx[0]
+        ystp = trgy[1]-trgy[0]
+        fx0 = (refx-trgx[0])/xstp
+        fy0 = (refy-trgy[0])/ystp
+        def f(p):
+            fx = fx0-p[0]/xstp
+            fy = fy0-p[1]/ystp
+            if fx.min() < 0.0 or fx.max() > trg_nx-1 or fy.min() < 0.0 or fy.max() > trg_ny-1:
+                raise ValueError('Error, out of bounds >>> {}'.format(p))
+            ix = np.clip(np.floor(fx).astype(np.int64),0,trg_nx-2)
+            iy = np.clip(np.floor(fy).astype(np.int64),0,trg_ny-2)
+            wx = fx-ix
+            wy = (fy-iy)[:,None]
+            z = lerp(trgz[iy],trgz[iy+1],wy)
+            return lerp(z[:,ix],z[:,ix+1],wx)
+    else:
+        intp = RegularGridInterpolator((trgx,trgy[::-1]),trgz[::-1].T,method=args.interp)
+        xg,yg = np.meshgrid(refx,refy)
+        pts = np.array((xg,yg)).T
+        def f(p):
+            return intp(pts-p).T
+    return f
+
+def interp_img(p,refz,f):
+    intz = f(p)
     return refz,intz
 
-def residuals(p,refx,refy,refz,trgx,trgy,trgz,pmax):
+def residuals(p,refz,f,p0,pmax):
     if args.debug:
         sys.stderr.write('{}\n'.format(p))
     if np.any(np.isnan(p)):
         return np.full(3,2.0) # length = len(p)+1
     else:
-        pdif = np.abs([p[0]-args.x0,p[1]-args.y0])-pmax
+        pdif = np.abs([p[0]-p0[0],p[1]-p0[1]])-pmax
         cnd = (pdif > 0.0)
         if np.any(cnd):
             return np.full(3,2.0+pdif[cnd].sum()) # length = len(p)+1
-    f = RegularGridInterpolator((trgx+p[0],trgy[::-1]+p[1]),trgz[::-1].T,method=args.interp)
-    xg,yg = np.meshgrid(refx,refy)
-    intz = f(np.array((xg,yg)).T).T
+    intz = f(p)
     cnd = (~np.isnan(refz)) & (~np.isnan(intz))
     if cnd.sum() < cnd.size*0.5:
         return np.full(3,2.0) # length = len(p)+1
     r = np.corrcoef(intz[cnd],refz[cnd])[0,1]
     return np.full(3,1.0-r) # length = len(p)+1
 
+def scan_corr(refx,refy,refz,trgx,trgy,trgz,p0,scan_indx,scan_indy):
+    # Correlation coefficients of residuals() for integer shifts (linear interpolation only).
+    # The interpolated target is a weighted sum of 4 neighboring target pixels with weights independent of
+    # the integer shift, so every sum for the masked correlation is a cross-correlation on the target grid.
+    trg_ny,trg_nx = trgz.shape
+    xg,yg = np.meshgrid(refx,refy)
+    fx = (xg-p0[0]-trgx[0])/(trgx[1]-trgx[0]) # x index = fx-j for shift j
+    fy = (yg-p0[1]-trgy[0])/(trgy[1]-trgy[0]) # y index = fy+i for shift i
+    if fx.min()-scan_indx.max() < 0.0 or fx.max()-scan_indx.min() > trg_nx-1:
+        return None
+    if fy.min()+scan_indy.min() < 0.0 or fy.max()+scan_indy.max() > trg_ny-1:
+        return None
+    bx = np.clip(np.floor(fx).astype(np.int64),0,trg_nx-2)
+    by = np.clip(np.floor(fy).astype(np.int64),0,trg_ny-2)
+    if bx.min()-scan_indx.max() < 0 or bx.max()-scan_indx.min() > trg_nx-2:
+        return None
+    if by.min()+scan_indy.min() < 0 or by.max()+scan_indy.max() > trg_ny-2:
+        return None
+    # Reference side (accumulated on the base index of the target grid)
+    cnd = ~np.isnan(refz)
+    trg_cnd = ~np.isnan(trgz)
+    if cnd.sum() < refz.size*0.5 or not np.any(trg_cnd):
+        return np.full((scan_indy.size,scan_indx.size),-1.0)
+    wx = (fx-bx)[cnd]
+    wy = (fy-by)[cnd]
+    rz = refz[cnd]
+    rz = rz-rz.mean()
+    ny = trg_ny-1
+    nx = trg_nx-1
+    indx = by[cnd]*nx+bx[cnd]
+    ws = [(1.0-wy)*(1.0-wx),(1.0-wy)*wx,wy*(1.0-wx),wy*wx]
+    # Target side (the interpolated value at base index k is valid if the neighbors with nonzero weights are valid,
+    # as in make_interp). Reference pixels are grouped by the neighbors they use.
+    tz = np.where(trg_cnd,trgz-np.nanmean(trgz),0.0)
+    tzs = [tz[:-1,:-1],tz[:-1,1:],tz[1:,:-1],tz[1:,1:]]
+    trg_cnds = [trg_cnd[:-1,:-1],trg_cnd[:-1,1:],trg_cnd[1:,:-1],trg_cnd[1:,1:]]
+    codes = np.sum([(ws[k] > 0.0)*(1 << k) for k in range(4)],axis=0)
+    # c[d] = sum_k g[k]*h[k+d], computed with FFT
+    shape = (ny+np.abs(scan_indy).max()+1,nx+np.abs(scan_indx).max()+1)
+    def fg(w,sel):
+        return np.conj(np.fft.rfft2(np.bincount(indx[sel],weights=w[sel],minlength=ny*nx).reshape(ny,nx),s=shape))
+    def fh(h):
+        return np.fft.rfft2(h,s=shape)
+    def corr(f):
+        return np.fft.irfft2(f,s=shape)[np.mod(scan_indy,shape[0])[:,None],np.mod(-scan_indx,shape[1])[None,:]]
+    f_n = 0.0
+    f_sr = 0.0
+    f_sr2 = 0.0
+    f_si = 0.0
+    f_sri = 0.0
+    f_si2 = 0.0
+    for code in np.unique(codes):
+        sel = (codes == code)
+        q = np.full(tz[:-1,:-1].shape,True)
+        for k in range(4):
+            if code & (1 << k):
+                q &= trg_cnds[k]
+        q = q.astype(np.float64)
+        ts = [t*q for t in tzs]
+        fq = fh(q)
+        f_n += fg(np.ones(rz.size),sel)*fq
+        f_sr += fg(rz,sel)*fq
+        f_sr2 += fg(rz*rz,sel)*fq
+        for k in range(4):
+            if not code & (1 << k): # zero weight
+                continue
+            fts = fh(ts[k])
+            f_si += fg(ws[k],sel)*fts
+            f_sri += fg(rz*ws[k],sel)*fts
+            for l in range(k,4):
+                if not code & (1 << l):
+                    continue
+                f_si2 += fg(ws[k]*ws[l],sel)*fh(ts[k]*ts[l])*(1.0 if l == k else 2.0)
+    n = np.rint(corr(f_n))
+    sr = corr(f_sr)
+    sr2 = corr(f_sr2)
+    si = corr(f_si)
+    sri = corr(f_sri)
+    si2 = corr(f_si2)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        r = (n*sri-sr*si)/np.sqrt((n*sr2-sr*sr)*(n*si2-si*si))
+    r[n < refz.size*0.5] = -1.0
+    return r
+
+def block_coord(xp,factor):
+    n = xp.size//factor
+    return xp[:n*factor].reshape(n,factor).mean(axis=1)
+
+def search_level(factor,p0,scan_indx,scan_indy,refx,refy,refz,trgx,trgy,trgz):
+    # Return the best shift in (factor x target pixel) for the images averaged over factor x factor pixels
+    refx = block_coord(refx,factor)
+    refy = block_coord(refy,factor)
+    refz = block_mean(refz,factor)
+    trgx = block_coord(trgx,factor)
+    trgy = block_coord(trgy,factor)
+    trgz = block_mean(trgz,factor)
+    scan_data = None
+    if args.scan_method == 'fft' and args.interp == 'linear':
+        scan_data = scan_corr(refx,refy,refz,trgx,trgy,trgz,p0,scan_indx,scan_indy)
+    if scan_data is None:
+        xstp = np.abs(trgx[1]-trgx[0])
+        ystp = np.abs(trgy[1]-trgy[0])
+        pmax = np.array([xstp*(np.abs(scan_indx).max()+0.5),ystp*(np.abs(scan_indy).max()+0.5)])
+        f = make_interp(refx,refy,trgx,trgy,trgz)
+        scan_data = np.full((scan_indy.size,scan_indx.size),-1.0)
+        for ii,i in enumerate(scan_indy):
+            for jj,j in enumerate(scan_indx):
+                try:
+                    scan_data[ii,jj] = 1.0-residuals(np.array([p0[0]+xstp*j,p0[1]+ystp*i]),refz,f,p0,pmax)[0]
+                except ValueError: # out of the subset
+                    continue
+    if np.all(np.isnan(scan_data)):
+        return None
+    ii,jj = np.unravel_index(np.nanargmax(scan_data),scan_data.shape)
+    return scan_indx[jj],scan_indy[ii]
+
+def get_bands(ds,fnam,band,band_name,multi_band,multi_band_name,multi_ratio):
+    # Return [(band#,ratio),...], band# < 0 for all bands
+    if multi_band_name is not None:
+        if len(multi_band_name) != len(multi_ratio):
+            raise ValueError('Error, len(multi_band_name)={}, len(multi_ratio)={}'.format(len(multi_band_name),len(multi_ratio)))
+        band_names = []
+        for i in range(ds.RasterCount):
+            band_names.append(ds.GetRasterBand(i+1).GetDescription())
+        bands = []
+        for band,ratio in zip(multi_band_name,multi_ratio):
+            if not band in band_names:
+                raise ValueError('Error in finding {} >>> {}'.format(band,fnam))
+            indx = band_names.index(band)
+            bands.append((indx+1,ratio))
+    elif multi_band is not None:
+        if len(multi_band) != len(multi_ratio):
+            raise ValueError('Error, len(multi_band)={}, len(multi_ratio)={}'.format(len(multi_band),len(multi_ratio)))
+        bands = list(zip(multi_band,multi_ratio))
+    elif band_name is not None:
+        band_names = []
+        for i in range(ds.RasterCount):
+            band_names.append(ds.GetRasterBand(i+1).GetDescription())
+        if not band_name in band_names:
+            raise ValueError('Error in finding {} >>> {}'.format(band_name,fnam))
+        indx = band_names.index(band_name)
+        bands = [(indx+1,None)]
+    elif band < 0:
+        bands = [(-1,None)]
+    else:
+        bands = [(band,None)]
+    return bands
+
+def open_ds(fnam):
+    # GDAL datasets cannot be shared by threads
+    if not hasattr(ds_local,'ds'):
+        ds_local.ds = {}
+    if not fnam in ds_local.ds:
+        ds_local.ds[fnam] = gdal.Open(fnam)
+    return ds_local.ds[fnam]
+
+def read_window(fnam,bands,x1,x2,y1,y2,data_min,data_max):
+    # Read [y1:y2,x1:x2] as float64
+    ds = open_ds(fnam)
+    data = 0.0
+    for band,ratio in bands:
+        if band < 0:
+            d = ds.ReadAsArray(int(x1),int(y1),int(x2-x1),int(y2-y1)).astype(np.float64)
+        else:
+            d = ds.GetRasterBand(band).ReadAsArray(int(x1),int(y1),int(x2-x1),int(y2-y1)).astype(np.float64)
+        if ratio is None:
+            data = d
+        else:
+            data += d*ratio
+    if data_min is not None:
+        data[data < data_min] = np.nan
+    if data_max is not None:
+        data[data > data_max] = np.nan
+    return data
+
+def block_mean(data,factor):
+    # Average over factor x factor pixels ignoring NaN
+    ny = data.shape[0]//factor
+    nx = data.shape[1]//factor
+    d = np.asarray(data[:ny*factor,:nx*factor],dtype=np.float64).reshape(ny,factor,nx,factor)
+    cnt = (~np.isnan(d)).sum(axis=(1,3))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return np.where(cnt > 0,np.nansum(d,axis=(1,3))/cnt,np.nan)
+
+def scale_trans(trans,factor):
+    return (trans[0],trans[1]*factor,trans[2]*factor,trans[3],trans[4]*factor,trans[5]*factor)
+
+def make_level(read_rows,factor,out):
+    # Fill out with the data averaged over factor x factor pixels, reading a strip of rows at a time
+    nstp = max(1,STRIP_HEIGHT//factor)
+    for i1 in range(0,out.shape[0],nstp):
+        i2 = min(i1+nstp,out.shape[0])
+        d = read_rows(i1*factor,i2*factor)
+        if factor > 1:
+            d = block_mean(d,factor)
+        out[i1:i2] = d[:,:out.shape[1]]
+    return out
+
+def clean_ref_cache(dnam,key):
+    # Remove the cached references made from an older version of the reference or not used for ref_cache_days
+    st = os.stat(args.ref_fnam)
+    tmin = time.time()-args.ref_cache_days*86400.0
+    for f in os.listdir(dnam):
+        fnam = os.path.join(dnam,f)
+        try:
+            if f.endswith('.part'): # left by an interrupted process
+                if os.path.getmtime(fnam) < tmin:
+                    os.remove(fnam)
+                continue
+            m = re.search('^ref_([0-9a-f]+)\.json$',f)
+            if not m or m.group(1) == key:
+                continue
+            with open(fnam,'r') as fp:
+                cache = json.load(fp)
+            if os.path.getmtime(fnam) > tmin and (cache.get('ref_fnam') != os.path.abspath(args.ref_fnam) or
+                                                  (cache.get('ref_size'),cache.get('ref_mtime')) == (st.st_size,st.st_mtime_ns)):
+                continue
+            os.remove(fnam)
+            os.remove(os.path.join(dnam,cache['fnam']))
+        except Exception: # removed or used by another process
+            continue
+    return
+
+def ref_window(x1,x2,y1,y2):
+    if ref_data is not None:
+        return ref_data[y1:y2,x1:x2].astype(np.float64)
+    return read_window(args.ref_fnam,ref_bands,x1,x2,y1,y2,args.ref_data_min,args.ref_data_max)
+
+def trg_window(x1,x2,y1,y2):
+    return read_window(args.trg_fnam,trg_bands,x1,x2,y1,y2,args.trg_data_min,args.trg_data_max)
+
+def check_subset(x1,x2,y1,y2,data):
+    # Return False if the target subset is mostly flagged (e.g. cloud) or featureless
+    cnd = np.isnan(data)
+    if args.flag_max is not None:
+        if trg_flag_bands is not None:
+            flag = read_window(args.trg_fnam,trg_flag_bands,x1,x2,y1,y2,None,None)
+            cnd |= np.isin(flag,args.trg_flag_value)
+        if cnd.sum() > cnd.size*args.flag_max:
+            return False
+    if args.trg_std_min is not None and data[~cnd].std() < args.trg_std_min:
+        return False
+    return True
+
+# Only the windows around the subsets are read from the rasters
+ds_local = threading.local()
 ds = gdal.Open(args.ref_fnam)
 prj = ds.GetProjection()
 srs = osr.SpatialReference(wkt=prj)
-if args.ref_multi_band_name is not None:
-    if len(args.ref_multi_band_name) != len(args.ref_multi_ratio):
-        raise ValueError('Error, len(args.ref_multi_band_name)={}, len(args.ref_multi_ratio)={}'.format(len(args.ref_multi_band_name),len(args.ref_multi_ratio)))
-    band_names = []
-    for i in range(ds.RasterCount):
-        band_names.append(ds.GetRasterBand(i+1).GetDescription())
-    ref_data = 0.0
-    for band,ratio in zip(args.ref_multi_band_name,args.ref_multi_ratio):
-        if not band in band_names:
-            raise ValueError('Error in finding {} >>> {}'.format(band,args.ref_fnam))
-        indx = band_names.index(band)
-        ref_data += ds.GetRasterBand(indx+1).ReadAsArray().astype(np.float64)*ratio
-elif args.ref_multi_band is not None:
-    if len(args.ref_multi_band) != len(args.ref_multi_ratio):
-        raise ValueError('Error, len(args.ref_multi_band)={}, len(args.ref_multi_ratio)={}'.format(len(args.ref_multi_band),len(args.ref_multi_ratio)))
-    ref_data = 0.0
-    for band,ratio in zip(args.ref_multi_band,args.ref_multi_ratio):
-        ref_data += ds.GetRasterBand(band).ReadAsArray().astype(np.float64)*ratio
-elif args.ref_band_name is not None:
-    band_names = []
-    for i in range(ds.RasterCount):
-        band_names.append(ds.GetRasterBand(i+1).GetDescription())
-    if not args.ref_band_name in band_names:
-        raise ValueError('Error in finding {} >>> {}'.format(args.ref_band_name,args.ref_fnam))
-    indx = band_names.index(args.ref_band_name)
-    ref_data = ds.GetRasterBand(indx+1).ReadAsArray().astype(np.float64)
-elif args.ref_band < 0:
-    ref_data = ds.ReadAsArray().astype(np.float64)
-else:
-    ref_data = ds.GetRasterBand(args.ref_band).ReadAsArray().astype(np.float64)
-trans = ds.GetGeoTransform()
-ref_shape = ref_data.shape
-indy,indx = np.indices(ref_shape)
-ref_xp = trans[0]+(indx+0.5)*trans[1]+(indy+0.5)*trans[2]
-ref_yp = trans[3]+(indx+0.5)*trans[4]+(indy+0.5)*trans[5]
+ref_bands = get_bands(ds,args.ref_fnam,args.ref_band,args.ref_band_name,args.ref_multi_band,args.ref_multi_band_name,args.ref_multi_ratio)
 ref_epsg = srs.GetAttrValue('AUTHORITY',1)
+trans = ds.GetGeoTransform()
+ref_shape = (ds.RasterYSize,ds.RasterXSize)
 ds = None # close dataset
-ref_xp0 = ref_xp[0,:]
-ref_yp0 = ref_yp[:,0]
+ref_data = None
+factor = 1
+if args.ref_pixel is not None:
+    factor = max(1,int(args.ref_pixel/abs(trans[1])+0.5))
+ref_width0 = ref_shape[1]
+def read_ref_rows(y1,y2):
+    return read_window(args.ref_fnam,ref_bands,0,ref_width0,y1,y2,args.ref_data_min,args.ref_data_max)
+if args.ref_cache_dir is not None:
+    # The reference after band combination, range check and block averaging (ref_pixel) is cached in float32 and
+    # shared by all target images, i.e. the cache saves decoding the reference, it is not resampled to the target grid.
+    # Cached data are memory-mapped. The coarser levels of the coarse-to-fine search are made from each subset.
+    # The cache made for each reference and options is kept as long as it is used (see clean_ref_cache).
+    st = os.stat(args.ref_fnam)
+    key = hashlib.md5(json.dumps([os.path.abspath(args.ref_fnam),st.st_size,st.st_mtime_ns,
+                                  args.ref_band,args.ref_band_name,args.ref_multi_band,args.ref_multi_band_name,args.ref_multi_ratio,
+                                  args.ref_data_min,args.ref_data_max,args.ref_pixel]).encode()).hexdigest()
+    cache_fnam = os.path.join(args.ref_cache_dir,'ref_{}.json'.format(key))
+    if not os.path.exists(cache_fnam):
+        if not os.path.exists(args.ref_cache_dir):
+            os.makedirs(args.ref_cache_dir,exist_ok=True)
+        trans = scale_trans(trans,factor)
+        ref_shape = (ref_shape[0]//factor,ref_shape[1]//factor)
+        fnam = os.path.join(args.ref_cache_dir,'ref_{}.npy'.format(key))
+        # Write through a temporary file, as other processes may read or write the same cache
+        fd,tmp_fnam = tempfile.mkstemp(suffix='.part',dir=args.ref_cache_dir)
+        os.close(fd)
+        data = make_level(read_ref_rows,factor,np.lib.format.open_memmap(tmp_fnam,mode='w+',dtype=np.float32,shape=ref_shape))
+        data.flush()
+        del data
+        os.replace(tmp_fnam,fnam)
+        cache = {'ref_fnam':os.path.abspath(args.ref_fnam),'ref_size':st.st_size,'ref_mtime':st.st_mtime_ns,
+                 'epsg':ref_epsg,'fnam':os.path.basename(fnam),'trans':trans}
+        fd,tmp_fnam = tempfile.mkstemp(suffix='.part',dir=args.ref_cache_dir)
+        with os.fdopen(fd,'w') as fp:
+            json.dump(cache,fp)
+        os.replace(tmp_fnam,cache_fnam)
+    else:
+        os.utime(cache_fnam) # last use
+    clean_ref_cache(args.ref_cache_dir,key)
+    with open(cache_fnam,'r') as fp:
+        cache = json.load(fp)
+    ref_data = np.load(os.path.join(args.ref_cache_dir,cache['fnam']),mmap_mode='r')
+    trans = tuple(cache['trans'])
+    ref_shape = ref_data.shape
+elif factor > 1:
+    trans = scale_trans(trans,factor)
+    ref_shape = (ref_shape[0]//factor,ref_shape[1]//factor)
+    ref_data = make_level(read_ref_rows,factor,np.zeros(ref_shape,dtype=np.float32))
+ref_xp0 = trans[0]+(np.arange(ref_shape[1])+0.5)*trans[1]+0.5*trans[2]
+ref_yp0 = trans[3]+0.5*trans[4]+(np.arange(ref_shape[0])+0.5)*trans[5]
 ref_xp_min = ref_xp0.min()
 ref_xp_max = ref_xp0.max()
 ref_yp_min = ref_yp0.min()
@@ -159,55 +509,21 @@ if ref_xp_stp <= 0.0:
 if ref_yp_stp >= 0.0:
     raise ValueError('Error, ref_yp_stp={}'.format(ref_yp_stp))
 
-if args.ref_data_min is not None:
-    ref_data[ref_data < args.ref_data_min] = np.nan
-if args.ref_data_max is not None:
-    ref_data[ref_data > args.ref_data_max] = np.nan
-
 ds = gdal.Open(args.trg_fnam)
 prj = ds.GetProjection()
 srs = osr.SpatialReference(wkt=prj)
-if args.trg_multi_band_name is not None:
-    if len(args.trg_multi_band_name) != len(args.trg_multi_ratio):
-        raise ValueError('Error, len(args.trg_multi_band_name)={}, len(args.trg_multi_ratio)={}'.format(len(args.trg_multi_band_name),len(args.trg_multi_ratio)))
-    band_names = []
-    for i in range(ds.RasterCount):
-        band_names.append(ds.GetRasterBand(i+1).GetDescription())
-    trg_data = 0.0
-    for band,ratio in zip(args.trg_multi_band_name,args.trg_multi_ratio):
-        if not band in band_names:
-            raise ValueError('Error in finding {} >>> {}'.format(band,args.trg_fnam))
-        indx = band_names.index(band)
-        trg_data += ds.GetRasterBand(indx+1).ReadAsArray().astype(np.float64)*ratio
-elif args.trg_multi_band is not None:
-    if len(args.trg_multi_band) != len(args.trg_multi_ratio):
-        raise ValueError('Error, len(args.trg_multi_band)={}, len(args.trg_multi_ratio)={}'.format(len(args.trg_multi_band),len(args.trg_multi_ratio)))
-    trg_data = 0.0
-    for band,ratio in zip(args.trg_multi_band,args.trg_multi_ratio):
-        trg_data += ds.GetRasterBand(band).ReadAsArray().astype(np.float64)*ratio
-elif args.trg_band_name is not None:
-    band_names = []
-    for i in range(ds.RasterCount):
-        band_names.append(ds.GetRasterBand(i+1).GetDescription())
-    if not args.trg_band_name in band_names:
-        raise ValueError('Error in finding {} >>> {}'.format(args.trg_band_name,args.trg_fnam))
-    indx = band_names.index(args.trg_band_name)
-    trg_data = ds.GetRasterBand(indx+1).ReadAsArray().astype(np.float64)
-elif args.trg_band < 0:
-    trg_data = ds.ReadAsArray().astype(np.float64)
-else:
-    trg_data = ds.GetRasterBand(args.trg_band).ReadAsArray().astype(np.float64)
+trg_bands = get_bands(ds,args.trg_fnam,args.trg_band,args.trg_band_name,args.trg_multi_band,args.trg_multi_band_name,args.trg_multi_ratio)
+trg_flag_bands = None
+if args.flag_max is not None and args.trg_flag_band_name is not None:
+    trg_flag_bands = get_bands(ds,args.trg_fnam,None,args.trg_flag_band_name,None,None,None)
 trans = ds.GetGeoTransform()
-trg_shape = trg_data.shape
-indy,indx = np.indices(trg_shape)
-trg_xp = trans[0]+(indx+0.5)*trans[1]+(indy+0.5)*trans[2]
-trg_yp = trans[3]+(indx+0.5)*trans[4]+(indy+0.5)*trans[5]
+trg_shape = (ds.RasterYSize,ds.RasterXSize)
 trg_epsg = srs.GetAttrValue('AUTHORITY',1)
 if trg_epsg != ref_epsg:
     sys.stderr.write('Warning, different EPSG, ref:{}, trg:{}\n'.format(ref_epsg,trg_epsg))
 ds = None # close dataset
-trg_xp0 = trg_xp[0,:]
-trg_yp0 = trg_yp[:,0]
+trg_xp0 = trans[0]+(np.arange(trg_shape[1])+0.5)*trans[1]+0.5*trans[2]
+trg_yp0 = trans[3]+0.5*trans[4]+(np.arange(trg_shape[0])+0.5)*trans[5]
 trg_xp_min = trg_xp0.min()
 trg_xp_max = trg_xp0.max()
 trg_yp_min = trg_yp0.min()
@@ -219,11 +535,6 @@ if trg_xp_stp <= 0.0:
 if trg_yp_stp >= 0.0:
     raise ValueError('Error, trg_yp_stp={}'.format(trg_yp_stp))
 
-if args.trg_data_min is not None:
-    trg_data[trg_data < args.trg_data_min] = np.nan
-if args.trg_data_max is not None:
-    trg_data[trg_data > args.trg_data_max] = np.nan
-
 ref_height,ref_width = ref_shape
 trg_height,trg_width = trg_shape
 subset_half_width = args.subset_width//2
@@ -241,9 +552,170 @@ if args.trg_indy_stop is None:
 if args.trg_indy_step is None:
     args.trg_indy_step = subset_half_height
 
+def find_gcp(trg_indxc,trg_indyc,x0,y0,shift_width,shift_height,trg_indx1,trg_indx2,trg_indy1,trg_indy2,ref_indx1,ref_indx2,ref_indy1,ref_indy2):
+    # target subset
+    trg_subset_xp0 = trg_xp0[trg_indx1:trg_indx2]
+    trg_subset_yp0 = trg_yp0[trg_indy1:trg_indy2]
+    trg_subset_data = trg_window(trg_indx1,trg_indx2,trg_indy1,trg_indy2)
+    # Skip subsets that cannot be matched before reading the reference
+    if not check_subset(trg_indx1+args.margin_width,trg_indx2-args.margin_width,trg_indy1+args.margin_height,trg_indy2-args.margin_height,
+                        trg_subset_data[args.margin_height:trg_subset_data.shape[0]-args.margin_height,
+                                        args.margin_width:trg_subset_data.shape[1]-args.margin_width]):
+        return None
+    # reference subset
+    ref_subset_xp0 = ref_xp0[ref_indx1:ref_indx2]
+    ref_subset_yp0 = ref_yp0[ref_indy1:ref_indy2]
+    ref_subset_data = ref_window(ref_indx1,ref_indx2,ref_indy1,ref_indy2)
+    if args.ref_data_umax is not None:
+        cnd1 = (~np.isnan(ref_subset_data)) & (ref_subset_data > args.ref_data_umax)
+        if cnd1.sum() > 0:
+            cnd2 = np.full(ref_subset_data.shape,False)
+            indy,indx = np.indices(ref_subset_data.shape)
+            for indy_tmp,indx_tmp in zip(indy[cnd1],indx[cnd1]):
+                cnd2[indy_tmp-5:indy_tmp+6,indx_tmp-5:indx_tmp+6] = True
+            ref_subset_data[cnd2] = np.nan
+    if args.ref_data_umin is not None:
+        cnd1 = (~np.isnan(ref_subset_data)) & (ref_subset_data < args.ref_data_umin)
+        if cnd1.sum() > 0:
+            cnd2 = np.full(ref_subset_data.shape,False)
+            indy,indx = np.indices(ref_subset_data.shape)
+            for indy_tmp,indx_tmp in zip(indy[cnd1],indx[cnd1]):
+                cnd2[indy_tmp-5:indy_tmp+6,indx_tmp-5:indx_tmp+6] = True
+            ref_subset_data[cnd2] = np.nan
+    # Scan
+    if args.scan_fnam is not None:
+        scan_fnam = args.scan_fnam.replace('.dat','_{:05d}_{:05d}.dat'.format(trg_indxc,trg_indyc))
+        if os.path.exists(scan_fnam):
+            os.remove(scan_fnam)
+    p0 = np.array([x0,y0])
+    trg_pmax = np.array([np.abs(trg_xp_stp*(shift_width+0.5)),np.abs(trg_yp_stp*(shift_height+0.5))])
+    scan_indx = np.arange(-shift_width,shift_width+1,args.scan_indx_step)
+    scan_indy = np.arange(-shift_height,shift_height+1,args.scan_indy_step)
+    pyramid_levels = get_pyramid_levels(shift_width,shift_height)
+    if pyramid_levels > 0:
+        # Coarse-to-fine search, the whole range is scanned only at the coarsest level and
+        # the shift is refined within pyramid_radius at each finer level.
+        indx0 = 0
+        indy0 = 0
+        for level in range(pyramid_levels,0,-1):
+            factor = 2**level
+            nx = -(-shift_width//factor)
+            ny = -(-shift_height//factor)
+            level_indx = np.arange(-nx,nx+1)
+            level_indy = np.arange(-ny,ny+1)
+            if level < pyramid_levels:
+                level_indx = level_indx[np.abs(level_indx-indx0//factor) <= args.pyramid_radius]
+                level_indy = level_indy[np.abs(level_indy-indy0//factor) <= args.pyramid_radius]
+            result = search_level(factor,p0,level_indx,level_indy,ref_subset_xp0,ref_subset_yp0,ref_subset_data,
+                                  trg_subset_xp0,trg_subset_yp0,trg_subset_data)
+            if result is None:
+                return None
+            indx0 = result[0]*factor
+            indy0 = result[1]*factor
+        scan_indx = scan_indx[np.abs(scan_indx-indx0) <= args.pyramid_radius]
+        scan_indy = scan_indy[np.abs(scan_indy-indy0) <= args.pyramid_radius]
+        if scan_indx.size < 1 or scan_indy.size < 1:
+            return None
+    scan_xp = []
+    scan_yp = []
+    scan_r = []
+    p1 = p0.copy()
+    rmax = -1.0e10
+    trg_interp = make_interp(ref_subset_xp0,ref_subset_yp0,trg_subset_xp0,trg_subset_yp0,trg_subset_data)
+    scan_data = None
+    if args.scan_method == 'fft' and args.interp == 'linear':
+        scan_data = scan_corr(ref_subset_xp0,ref_subset_yp0,ref_subset_data,
+                              trg_subset_xp0,trg_subset_yp0,trg_subset_data,p0,scan_indx,scan_indy)
+    for ii,i in enumerate(scan_indy):
+        dy = y0+np.abs(trg_yp_stp)*i
+        for jj,j in enumerate(scan_indx):
+            dx = x0+np.abs(trg_xp_stp)*j
+            p2 = np.array([dx,dy])
+            if scan_data is not None:
+                r = scan_data[ii,jj]
+            else: # brute-force
+                r = 1.0-residuals(p2,ref_subset_data,trg_interp,p0,trg_pmax)[0]
+            scan_xp.append(dx)
+            scan_yp.append(dy)
+            scan_r.append(r)
+            if args.scan_fnam is not None:
+                with open(scan_fnam,'a') as fp:
+                    fp.write('{:5d} {:5d} {:13.6e}\n'.format(j,i,r))
+            if r > rmax:
+                rmax = r
+                p1 = p2.copy()
+    scan_xp = np.array(scan_xp).reshape(scan_indy.size,scan_indx.size)
+    scan_yp = np.array(scan_yp).reshape(scan_indy.size,scan_indx.size)
+    scan_r = np.array(scan_r).reshape(scan_indy.size,scan_indx.size)
+    # Optimize
+    result = leastsq(residuals,p1,args=(ref_subset_data,trg_interp,p0,trg_pmax),
+                                        epsfcn=args.feps,full_output=True)
+    p2 = result[0]
+    if not args.use_edge:
+        if np.abs(p2[0]-x0) >= np.abs(trg_xp_stp*(shift_width-0.5)):
+            return None
+        if np.abs(p2[1]-y0) >= np.abs(trg_yp_stp*(shift_height-0.5)):
+            return None
+    r = 1.0-result[2]['fvec'][0]
+    # Output results
+    if r > args.rthr:
+        cnd = (scan_r > r*0.90)
+        xcnd = scan_xp[cnd]-p2[0]
+        ycnd = scan_yp[cnd]-p2[1]
+        if xcnd.size < 1:
+            r90 = 0.0
+        else:
+            r90 = np.sqrt((np.square(xcnd)+np.square(ycnd)).mean())
+        gcp = (trg_indxc+0.5,trg_indyc+0.5,trg_xp0[trg_indxc]+p2[0],trg_yp0[trg_indyc]+p2[1],p2[0],p2[1],r,r90)
+        if args.img_fnam is not None:
+            img_fnam = args.img_fnam.replace('.npz','_{:05d}_{:05d}.npz'.format(trg_indxc,trg_indyc))
+            ref_img,trg_img = interp_img(p2,ref_subset_data,trg_interp)
+            np.savez(img_fnam,ref_img=ref_img,trg_img=trg_img,xp0=ref_subset_xp0,yp0=ref_subset_yp0)
+        return gcp
+    return None
+
 if args.out_fnam is not None:
     if os.path.exists(args.out_fnam):
         os.remove(args.out_fnam)
+def get_prior(trg_indxc,trg_indyc):
+    # Return the initial shift and the max shift of a subset
+    x0 = args.x0
+    y0 = args.y0
+    shift_width = args.shift_width
+    shift_height = args.shift_height
+    if prior_data is not None:
+        cnd = (np.abs(prior_data[:,0]-(trg_indxc+0.5)) <= args.trg_indx_step*0.5) & \
+              (np.abs(prior_data[:,1]-(trg_indyc+0.5)) <= args.trg_indy_step*0.5)
+        if cnd.sum() > 0:
+            # The median of the priors is used, and the window is widened by their spread
+            xp = np.median(prior_data[cnd,2])
+            yp = np.median(prior_data[cnd,3])
+            xw = args.prior_shift+int(np.ceil(np.abs(prior_data[cnd,2]-xp).max()/np.abs(trg_xp_stp)))
+            yw = args.prior_shift+int(np.ceil(np.abs(prior_data[cnd,3]-yp).max()/np.abs(trg_yp_stp)))
+            if xw < args.shift_width and yw < args.shift_height:
+                x0 = xp
+                y0 = yp
+                shift_width = xw
+                shift_height = yw
+    return x0,y0,shift_width,shift_height
+
+# GCPs of neighboring acquisitions (x index, y index, x shift, y shift, correlation coefficient)
+prior_data = None
+if args.prior_fnam is not None:
+    data = []
+    for fnam in args.prior_fnam:
+        if not os.path.exists(fnam):
+            continue
+        gcps = read_gcps(fnam)
+        d = np.column_stack((gcps['xc'],gcps['yc'],gcps['xd'],gcps['yd'],gcps['r']))
+        # Priors must be within the max shift from the initial shift
+        cnd = (d[:,4] >= args.prior_rmin) & (np.abs(d[:,2]-args.x0) <= np.abs(trg_xp_stp*args.shift_width)) & \
+              (np.abs(d[:,3]-args.y0) <= np.abs(trg_yp_stp*args.shift_height))
+        data.append(d[cnd])
+    if len(data) > 0:
+        prior_data = np.vstack(data)
+
+tiles = []
 for trg_indyc in np.arange(args.trg_indy_start,args.trg_indy_stop,args.trg_indy_step):
     trg_indy1 = trg_indyc-subset_half_height-args.margin_height
     trg_indy2 = trg_indyc+subset_half_height+args.margin_height+1
@@ -251,20 +723,6 @@ for trg_indyc in np.arange(args.trg_indy_start,args.trg_indy_stop,args.trg_indy_
         continue
     if trg_indy2 > trg_height:
         break
-    ref_yp1 = trg_yp0[trg_indyc-subset_half_height]+args.y0 # yp1 > ypc
-    ref_yp2 = trg_yp0[trg_indyc+subset_half_height]+args.y0 # yp2 < ypc
-    if ref_yp1 > ref_yp_max:
-        continue
-    if ref_yp2 < ref_yp_min:
-        continue
-    ref_indy1 = np.where(ref_yp0 <= ref_yp1)[0]
-    if ref_indy1.size < 1:
-        continue
-    ref_indy1 = ref_indy1[0]
-    ref_indy2 = np.where(ref_yp0 >= ref_yp2)[0]
-    if ref_indy2.size < 1:
-        continue
-    ref_indy2 = ref_indy2[-1]+1
     for trg_indxc in np.arange(args.trg_indx_start,args.trg_indx_stop,args.trg_indx_step):
         trg_indx1 = trg_indxc-subset_half_width-args.margin_width
         trg_indx2 = trg_indxc+subset_half_width+args.margin_width+1
@@ -272,8 +730,23 @@ for trg_indyc in np.arange(args.trg_indy_start,args.trg_indy_stop,args.trg_indy_
             continue
         if trg_indx2 > trg_width:
             break
-        ref_xp1 = trg_xp0[trg_indxc-subset_half_width]+args.x0
-        ref_xp2 = trg_xp0[trg_indxc+subset_half_width]+args.x0
+        x0,y0,shift_width,shift_height = get_prior(trg_indxc,trg_indyc)
+        ref_yp1 = trg_yp0[trg_indyc-subset_half_height]+y0 # yp1 > ypc
+        ref_yp2 = trg_yp0[trg_indyc+subset_half_height]+y0 # yp2 < ypc
+        if ref_yp1 > ref_yp_max:
+            continue
+        if ref_yp2 < ref_yp_min:
+            continue
+        ref_indy1 = np.where(ref_yp0 <= ref_yp1)[0]
+        if ref_indy1.size < 1:
+            continue
+        ref_indy1 = ref_indy1[0]
+        ref_indy2 = np.where(ref_yp0 >= ref_yp2)[0]
+        if ref_indy2.size < 1:
+            continue
+        ref_indy2 = ref_indy2[-1]+1
+        ref_xp1 = trg_xp0[trg_indxc-subset_half_width]+x0
+        ref_xp2 = trg_xp0[trg_indxc+subset_half_width]+x0
         if ref_xp1 < ref_xp_min:
             continue
         if ref_xp2 > ref_xp_max:
@@ -286,100 +759,65 @@ for trg_indyc in np.arange(args.trg_indy_start,args.trg_indy_stop,args.trg_indy_
         if ref_indx2.size < 1:
             continue
         ref_indx2 = ref_indx2[-1]+1
-        # target subset
-        trg_subset_xp0 = trg_xp0[trg_indx1:trg_indx2]
-        trg_subset_yp0 = trg_yp0[trg_indy1:trg_indy2]
-        trg_subset_data = trg_data[trg_indy1:trg_indy2,trg_indx1:trg_indx2].copy()
-        # reference subset
-        ref_subset_xp0 = ref_xp0[ref_indx1:ref_indx2]
-        ref_subset_yp0 = ref_yp0[ref_indy1:ref_indy2]
-        ref_subset_data = ref_data[ref_indy1:ref_indy2,ref_indx1:ref_indx2].copy()
-        if args.ref_data_umax is not None:
-            cnd1 = (~np.isnan(ref_subset_data)) & (ref_subset_data > args.ref_data_umax)
-            if cnd1.sum() > 0:
-                cnd2 = np.full(ref_subset_data.shape,False)
-                indy,indx = np.indices(ref_subset_data.shape)
-                for indy_tmp,indx_tmp in zip(indy[cnd1],indx[cnd1]):
-                    cnd2[indy_tmp-5:indy_tmp+6,indx_tmp-5:indx_tmp+6] = True
-                ref_subset_data[cnd2] = np.nan
-        if args.ref_data_umin is not None:
-            cnd1 = (~np.isnan(ref_subset_data)) & (ref_subset_data < args.ref_data_umin)
-            if cnd1.sum() > 0:
-                cnd2 = np.full(ref_subset_data.shape,False)
-                indy,indx = np.indices(ref_subset_data.shape)
-                for indy_tmp,indx_tmp in zip(indy[cnd1],indx[cnd1]):
-                    cnd2[indy_tmp-5:indy_tmp+6,indx_tmp-5:indx_tmp+6] = True
-                ref_subset_data[cnd2] = np.nan
-        # Scan
-        if args.scan_fnam is not None:
-            scan_fnam = args.scan_fnam.replace('.dat','_{:05d}_{:05d}.dat'.format(trg_indxc,trg_indyc))
-            if os.path.exists(scan_fnam):
-                os.remove(scan_fnam)
-        trg_pmax = np.array([np.abs(trg_xp_stp*(args.shift_width+0.5)),np.abs(trg_yp_stp*(args.shift_height+0.5))])
-        scan_indx = np.arange(-args.shift_width,args.shift_width+1,args.scan_indx_step)
-        scan_indy = np.arange(-args.shift_height,args.shift_height+1,args.scan_indy_step)
-        scan_xp = []
-        scan_yp = []
-        scan_r = []
-        p1 = np.array([args.x0,args.y0])
-        rmax = -1.0e10
-        for i in scan_indy:
-            dy = args.y0+np.abs(trg_yp_stp)*i
-            for j in scan_indx:
-                dx = args.x0+np.abs(trg_xp_stp)*j
-                p2 = np.array([dx,dy])
-                r = 1.0-residuals(p2,ref_subset_xp0,ref_subset_yp0,ref_subset_data,
-                                     trg_subset_xp0,trg_subset_yp0,trg_subset_data,trg_pmax)[0]
-                scan_xp.append(dx)
-                scan_yp.append(dy)
-                scan_r.append(r)
-                if args.scan_fnam is not None:
-                    with open(scan_fnam,'a') as fp:
-                        fp.write('{:5d} {:5d} {:13.6e}\n'.format(j,i,r))
-                if r > rmax:
-                    rmax = r
-                    p1 = p2.copy()
-        scan_xp = np.array(scan_xp).reshape(scan_indy.size,scan_indx.size)
-        scan_yp = np.array(scan_yp).reshape(scan_indy.size,scan_indx.size)
-        scan_r = np.array(scan_r).reshape(scan_indy.size,scan_indx.size)
-        # Optimize
-        result = leastsq(residuals,p1,args=(ref_subset_xp0,ref_subset_yp0,ref_subset_data,
-                                            trg_subset_xp0,trg_subset_yp0,trg_subset_data,trg_pmax),
-                                            epsfcn=args.feps,full_output=True)
-        p2 = result[0]
-        if not args.use_edge:
-            if np.abs(p2[0]-args.x0) >= np.abs(trg_xp_stp*(args.shift_width-0.5)):
-                continue
-            if np.abs(p2[1]-args.y0) >= np.abs(trg_yp_stp*(args.shift_height-0.5)):
-                continue
-        r = 1.0-result[2]['fvec'][0]
-        # Output results
-        if r > args.rthr:
-            cnd = (scan_r > r*0.90)
-            xcnd = scan_xp[cnd]-p2[0]
-            ycnd = scan_yp[cnd]-p2[1]
-            if xcnd.size < 1:
-                r90 = 0.0
-            else:
-                r90 = np.sqrt((np.square(xcnd)+np.square(ycnd)).mean())
-            if args.exp:
-                line = '{:8.1f} {:8.1f} {:15.8e} {:15.8e} {:15.8e} {:15.8e} {:8.3f} {:8.3f}\n'.format(trg_indxc+0.5,trg_indyc+0.5,trg_xp0[trg_indxc]+p2[0],trg_yp0[trg_indyc]+p2[1],p2[0],p2[1],r,r90)
-            elif args.long:
-                line = '{:8.1f} {:8.1f} {:12.6f} {:12.6f} {:10.6f} {:10.6f} {:10.5f} {:10.5f}\n'.format(trg_indxc+0.5,trg_indyc+0.5,trg_xp0[trg_indxc]+p2[0],trg_yp0[trg_indyc]+p2[1],p2[0],p2[1],r,r90)
-            else:
-                line = '{:8.1f} {:8.1f} {:8.2f} {:8.2f} {:6.2f} {:6.2f} {:8.3f} {:8.3f}\n'.format(trg_indxc+0.5,trg_indyc+0.5,trg_xp0[trg_indxc]+p2[0],trg_yp0[trg_indyc]+p2[1],p2[0],p2[1],r,r90)
-            if args.out_fnam is not None:
-                with open(args.out_fnam,'a') as fp:
-                    fp.write(line)
-            else:
-                sys.stdout.write(line)
+        tiles.append((trg_indxc,trg_indyc,x0,y0,shift_width,shift_height,trg_indx1,trg_indx2,trg_indy1,trg_indy2,ref_indx1,ref_indx2,ref_indy1,ref_indy2))
+
+def get_level(i):
+    # Subsets on the grid with interval 2**level, visited from the coarsest grid in adaptive sampling mode
+    level = 0
+    while level < 30 and i%2**(level+1) == 0:
+        level += 1
+    return level
+
+tile_indx = [(tile[0]-args.trg_indx_start)//args.trg_indx_step for tile in tiles]
+tile_indy = [(tile[1]-args.trg_indy_start)//args.trg_indy_step for tile in tiles]
+order = list(range(len(tiles)))
+if args.gcp_nstop is not None and len(tiles) > 0:
+    order = sorted(order,key=lambda i:-min(get_level(tile_indx[i]),get_level(tile_indy[i])))
+    nx = max(tile_indx)+1
+    ny = max(tile_indy)+1
+    tile_cell = [(tile_indx[i]*args.cover_grid//nx,tile_indy[i]*args.cover_grid//ny) for i in range(len(tiles))]
+    ncell = len(set(tile_cell))
+
+# Subsets are independent, so they are processed in parallel and the results are written in the order of subsets.
+# Only a few subsets per thread are submitted ahead, so that little work is left when the search stops early.
+executor = None
+futures = deque()
+if args.nproc > 1:
+    executor = ThreadPoolExecutor(max_workers=args.nproc)
+results = {}
+cells = set()
+k = 0
+while k < len(order) or len(futures) > 0:
+    while executor is not None and k < len(order) and len(futures) < args.nproc*2:
+        futures.append((order[k],executor.submit(find_gcp,*tiles[order[k]])))
+        k += 1
+    if len(futures) > 0:
+        i,future = futures.popleft()
+        gcp = future.result()
+    else:
+        i = order[k]
+        gcp = find_gcp(*tiles[i])
+        k += 1
+    if gcp is None:
+        continue
+    results[i] = gcp
+    if args.verbose:
+        sys.stderr.write(format_gcp(gcp,exp=args.exp,long=args.long))
+    if args.gcp_nstop is not None:
+        # Stop when enough GCPs are found over the image
+        cells.add(tile_cell[i])
+        if len(results) >= args.gcp_nstop and len(cells) >= ncell*args.gcp_cover:
             if args.verbose:
-                sys.stderr.write(line)
-            if args.img_fnam is not None:
-                img_fnam = args.img_fnam.replace('.npz','_{:05d}_{:05d}.npz'.format(trg_indxc,trg_indyc))
-                ref_img,trg_img = interp_img(p2,ref_subset_xp0,ref_subset_yp0,ref_subset_data,trg_subset_xp0,trg_subset_yp0,trg_subset_data)
-                np.savez(img_fnam,ref_img=ref_img,trg_img=trg_img,xp0=ref_subset_xp0,yp0=ref_subset_yp0)
-if args.out_fnam is not None and args.out_empty:
-    if not os.path.exists(args.out_fnam):
-        with open(args.out_fnam,'w') as fp:
-            pass
+                sys.stderr.write('Stopped after {} GCPs in {} cells.\n'.format(len(results),len(cells)))
+            break
+if executor is not None:
+    for i,future in futures: # not started yet
+        future.cancel()
+    executor.shutdown()
+gcps = [results[i] for i in sorted(results)]
+if args.out_fnam is not None:
+    if len(gcps) > 0 or args.out_empty:
+        write_gcps(args.out_fnam,gcps,exp=args.exp,long=args.long)
+else:
+    for gcp in gcps:
+        sys.stdout.write(format_gcp(gcp,exp=args.exp,long=args.long))
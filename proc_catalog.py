@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+import sqlite3
+import threading
+
+MTIME_MARGIN = 2.0 # sec, listings taken shortly after the last change of the folder are not trusted
+
+# Catalog of folder listings shared by all stages and worker scripts.
+# A listing is reused as long as the modification time of the folder is unchanged,
+# which is the case unless a file is added, removed or renamed in the folder.
+# The catalog is used only in a satellite run (SATELLITE_CATALOG is set by satellite_config),
+# the worker scripts run by hand list the folders directly.
+catalog_lock = threading.Lock()
+catalog_conns = {} # catalog file -> connection
+
+def get_catalog_fnam():
+    # SATELLITE_CATALOG is passed from satellite_config to the worker scripts (not set, empty or none to disable)
+    fnam = os.environ.get('SATELLITE_CATALOG')
+    if fnam is None or fnam.strip() == '' or fnam.strip().lower() == 'none':
+        return None
+    return fnam
+
+def connect():
+    fnam = get_catalog_fnam()
+    if fnam is None:
+        return None
+    if fnam in catalog_conns:
+        return catalog_conns[fnam]
+    try:
+        conn = sqlite3.connect(fnam,timeout=60.0,check_same_thread=False)
+        conn.execute('CREATE TABLE IF NOT EXISTS dirs (dnam TEXT PRIMARY KEY,mtime INTEGER,scan REAL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS files (dnam TEXT,fnam TEXT,size INTEGER,mtime INTEGER,isdir INTEGER,PRIMARY KEY (dnam,fnam))')
+        conn.commit()
+    except Exception as e:
+        sys.stderr.write('Warning, cannot open catalog ({}) >>> {}\n'.format(e,fnam))
+        sys.stderr.flush()
+        conn = None
+    catalog_conns[fnam] = conn
+    return conn
+
+def scan_dir(dnam):
+    entries = []
+    with os.scandir(dnam) as it:
+        for entry in it:
+            try:
+                st = entry.stat()
+            except OSError: # removed while scanning
+                continue
+            entries.append((entry.name,st.st_size,st.st_mtime_ns,int(entry.is_dir())))
+    return sorted(entries)
+
+def list_entries(dnam):
+    # Return (name,size,mtime,isdir) of the entries in a folder sorted by name
+    dnam = os.path.abspath(dnam)
+    dir_mtime = os.stat(dnam).st_mtime_ns
+    with catalog_lock:
+        conn = connect()
+        if conn is not None:
+            try:
+                row = conn.execute('SELECT mtime,scan FROM dirs WHERE dnam=?',(dnam,)).fetchone()
+                if row is not None and row[0] == dir_mtime and row[1] > dir_mtime*1.0e-9+MTIME_MARGIN:
+                    return [tuple(r) for r in conn.execute('SELECT fnam,size,mtime,isdir FROM files WHERE dnam=? ORDER BY fnam',(dnam,))]
+            except sqlite3.Error as e:
+                sys.stderr.write('Warning, cannot read catalog ({}) >>> {}\n'.format(e,dnam))
+                sys.stderr.flush()
+    scan = time.time()
+    entries = scan_dir(dnam)
+    if conn is None:
+        return entries
+    with catalog_lock:
+        try:
+            with conn:
+                conn.execute('DELETE FROM files WHERE dnam=?',(dnam,))
+                conn.executemany('INSERT INTO files VALUES (?,?,?,?,?)',[(dnam,)+entry for entry in entries])
+                conn.execute('INSERT OR REPLACE INTO dirs VALUES (?,?,?)',(dnam,dir_mtime,scan))
+        except sqlite3.Error as e:
+            sys.stderr.write('Warning, cannot update catalog ({}) >>> {}\n'.format(e,dnam))
+            sys.stderr.flush()
+    return entries
+
+def list_dir(dnam):
+    # Replacement of sorted(os.listdir(dnam))
+    return [entry[0] for entry in list_entries(dnam)]
@@ -5,17 +5,98 @@ from datetime import datetime
 import tempfile
 import random
 import string
+import json
+import shlex
+import hashlib
+import atexit
+import threading
 import numpy as np
-import tkinter as tk
-from tkinter import ttk
-import tkfilebrowser
-from subprocess import call
-from custom_calendar import CustomDateEntry
+try:
+    import psutil
+except Exception:
+    psutil = None
+from collections import deque
+from subprocess import Popen,PIPE,TimeoutExpired
+from concurrent.futures import ThreadPoolExecutor
 from proc_func import *
+tk = None
+ttk = None
+tkfilebrowser = None
+CustomDateEntry = None
+
+def import_gui():
+    # GUI modules are imported when the GUI is opened, so that headless runs need no display libraries
+    global tk,ttk,tkfilebrowser,CustomDateEntry
+    if CustomDateEntry is not None:
+        return
+    import tkinter as tk
+    from tkinter import ttk
+    import tkfilebrowser
+    from custom_calendar import CustomDateEntry
+    return
 
 HOME = os.environ.get('USERPROFILE')
 if HOME is None:
     HOME = os.environ.get('HOME')
+INPROC_EXCLUDE = ['sentinel2_subset.py','snap_bandname.py'] # JVM options must be given before importing snappy
+SNAP_SCRIPTS = ['sentinel2_subset.py'] # scripts that can be run in a persistent SNAP session (--server)
+SNAP_OPTIONS = ['-T','--tmp_dnam','--max_memory'] # options used to start the JVM
+TRACE_INTERVAL = 0.5 # sec
+trace_lock = threading.Lock()
+MANIFEST_CHUNK = 1048576 # bytes
+MEMORY_RATIO = 0.8 # ratio of total memory used as the default memory budget
+MEMORY_MARGIN = 1.2 # safety factor for the measured peak memory
+MEMORY_WINDOW = 10 # number of recent runs used to estimate the peak memory
+
+# Memory budget shared by all commands (see acquire_memory)
+mem_cond = threading.Condition()
+mem_state = {'used':0.0,'running':0}
+mem_peaks = {} # memory key (see get_mem_key) -> peak RSS in bytes of the recent runs
+mem_traces = set() # trace files already read
+hash_cache = {} # (path,size,mtime) -> sha256
+hash_lock = threading.Lock()
+
+# Persistent interpreters for in-process execution (see proc_worker.py)
+workers = {}
+worker_lock = threading.Lock()
+
+# Persistent SNAP sessions (see sentinel2_subset.py)
+snap_cond = threading.Condition()
+snap_sessions = {} # (python_path,script,JVM options) -> idle sessions
+snap_state = {'busy':0}
+
+def stop_worker(worker):
+    try:
+        worker.stdin.close()
+        worker.wait()
+    except Exception:
+        pass
+    return
+
+def close_workers():
+    with worker_lock:
+        for python_path in workers:
+            for worker in workers[python_path]:
+                stop_worker(worker)
+        workers.clear()
+    stop_sessions()
+    return
+
+def stop_sessions():
+    # Stop the idle SNAP sessions
+    with snap_cond:
+        for key in snap_sessions:
+            for session in snap_sessions[key]:
+                stop_worker(session)
+        snap_sessions.clear()
+    return
+
+def get_idle_memory():
+    # Memory kept by the idle SNAP sessions (the JVM heap is not returned to the system)
+    with snap_cond:
+        return sum([getattr(session,'rss',None) or 0 for key in snap_sessions for session in snap_sessions[key]])
+
+atexit.register(close_workers)
 
 class Process:
 
@@ -58,6 +139,12 @@ class Process:
 
         self.python_path = sys.executable
         self.scr_dir = os.path.join(HOME,'Script')
+        self.inproc = False
+        self.snap_nproc = 0 # number of persistent SNAP sessions, 0:start SNAP for each command
+        self.trace_flag = False
+        self.mem_budget = 0.0 # GB, 0:auto, <0:no limit
+        self.cache_dir = None # folder for read-only inputs shared by the jobs (see satellite_batch.py), None:not shared
+        self.pipeline_nproc = 1 # number of pipeline workers running the processes at the same time (see proc_pipeline.py)
         self.date_format = 'yyyy-mm&mmm-dd'
         self.obs_block = None
         self.obs_date = None
@@ -101,6 +188,7 @@ class Process:
         self.__isfrozen = True
 
     def ask_file(self,pnam,dnam=None):
+        import_gui()
         if dnam is None:
             if self.center_var is not None:
                 fnam = self.center_var[pnam].get().strip()
@@ -153,6 +241,7 @@ class Process:
         return
 
     def ask_files(self,pnam,dnam=None):
+        import_gui()
         if dnam is None:
             if self.center_var is not None:
                 lines = self.center_var[pnam].get().strip().splitlines()
@@ -219,6 +308,7 @@ class Process:
         return
 
     def ask_folder(self,pnam,dnam=None):
+        import_gui()
         if dnam is None:
             if self.center_var is not None:
                 fnam = self.center_var[pnam].get().strip()
@@ -234,6 +324,7 @@ class Process:
         return
 
     def ask_folders(self,pnam,dnam=None):
+        import_gui()
         if dnam is None:
             if self.center_var is not None:
                 lines = self.center_var[pnam].get().strip().splitlines()
@@ -306,28 +397,427 @@ class Process:
         sys.stderr.flush()
         return
 
-    def run_command(self,command,message=None,print_command=True,print_time=True):
+    def run_command(self,command,message=None,print_command=True,print_time=True,dstr=None):
         if message is not None:
             sys.stderr.write('\n'+message+'\n')
             sys.stderr.flush()
         if print_command:
             sys.stderr.write('\n'+command+'\n')
             sys.stderr.flush()
+        t1 = datetime.now()
         if print_time:
-            t1 = datetime.now()
             sys.stderr.write('\nStart: {}\n'.format(t1))
             sys.stderr.flush()
-        ret = call(command,shell=True)
+        args = self.get_script(command) if self.inproc else None
+        snap_args = self.get_snap_script(command) if self.snap_nproc > 0 else None
+        step = self.get_mem_key(command)
+        size = self.acquire_memory(step)
+        usage = {}
+        try:
+            if args is not None:
+                ret,usage = self.run_inproc(args)
+            elif snap_args is not None:
+                ret,usage = self.run_snap(snap_args)
+            else:
+                ret,usage = self.run_shell(command)
+        finally:
+            self.release_memory(step,size,usage)
+        t2 = datetime.now()
         if print_time:
-            t2 = datetime.now()
             sys.stderr.write('\nEnd: {} ({})\n'.format(t2,t2-t1))
             sys.stderr.flush()
+        self.write_trace(command,t1,t2,ret,usage,dstr=dstr,inproc=(args is not None or snap_args is not None))
         if ret != 0:
             sys.stderr.write('\nTerminated command in process {}.\n\n'.format(self.proc_name))
             sys.stderr.flush()
             raise ValueError('ERROR')
         return ret
 
+    def split_command(self,command):
+        lex = shlex.shlex(command,posix=True)
+        lex.whitespace_split = True
+        if os.name == 'nt':
+            lex.escape = '' # keep backslashes in Windows paths
+        try:
+            return list(lex)
+        except ValueError:
+            return []
+
+    def get_script(self,command):
+        # Return the arguments of a Python script that can be run in-process, otherwise None
+        if not command.startswith(self.python_path):
+            return None
+        args = self.split_command(command[len(self.python_path):])
+        if len(args) < 1 or os.path.splitext(args[0])[1].lower() != '.py':
+            return None
+        if os.path.basename(args[0]) in INPROC_EXCLUDE:
+            return None
+        return args
+
+    def get_snap_script(self,command):
+        # Return the arguments of a SNAP script that can be run in a persistent session, otherwise None
+        if not command.startswith(self.python_path):
+            return None
+        args = self.split_command(command[len(self.python_path):])
+        if len(args) < 1 or not os.path.basename(args[0]) in SNAP_SCRIPTS:
+            return None
+        return args
+
+    def get_step(self,command):
+        if command.startswith(self.python_path):
+            args = self.split_command(command[len(self.python_path):])
+        else:
+            args = self.split_command(command)
+        if len(args) < 1:
+            return None
+        return os.path.basename(args[0])
+
+    def get_mem_key(self,command):
+        # The peak memory is learned for each step and JVM heap limit, as the limit depends on the number of workers
+        step = self.get_step(command)
+        args = self.split_command(command)
+        if step is not None and '--max_memory' in args[:-1]:
+            return '{} --max_memory {}'.format(step,args[args.index('--max_memory')+1])
+        return step
+
+    def run_shell(self,command):
+        # Run command and measure the resources used by it and its descendants
+        usage = {}
+        proc = Popen(command,shell=True)
+        if hasattr(os,'wait4'):
+            pid,status,rusage = os.wait4(proc.pid,0)
+            if os.WIFEXITED(status):
+                proc.returncode = os.WEXITSTATUS(status)
+            else:
+                proc.returncode = -os.WTERMSIG(status)
+            usage['user'] = rusage.ru_utime
+            usage['sys'] = rusage.ru_stime
+            usage['max_rss'] = rusage.ru_maxrss*(1 if sys.platform == 'darwin' else 1024)
+            usage['read_bytes'] = rusage.ru_inblock*512
+            usage['write_bytes'] = rusage.ru_oublock*512
+            return proc.returncode,usage
+        if psutil is None:
+            return proc.wait(),usage
+        # Sample the process tree (approximate, short-lived children may be missed)
+        totals = {}
+        max_rss = 0
+        try:
+            parent = psutil.Process(proc.pid)
+        except psutil.Error:
+            parent = None
+        while True:
+            try:
+                ret = proc.wait(timeout=TRACE_INTERVAL)
+                break
+            except TimeoutExpired:
+                pass
+            if parent is None:
+                continue
+            rss = 0
+            try:
+                children = [parent]+parent.children(recursive=True)
+            except psutil.Error:
+                continue
+            for p in children:
+                try:
+                    with p.oneshot():
+                        t = p.cpu_times()
+                        io = p.io_counters()
+                        rss += p.memory_info().rss
+                        totals[p.pid] = (t.user,t.system,io.read_bytes,io.write_bytes)
+                except psutil.Error:
+                    pass
+            max_rss = max(max_rss,rss)
+        if len(totals) > 0:
+            values = np.sum(list(totals.values()),axis=0)
+            usage['user'] = float(values[0])
+            usage['sys'] = float(values[1])
+            usage['max_rss'] = max_rss
+            usage['read_bytes'] = int(values[2])
+            usage['write_bytes'] = int(values[3])
+        return ret,usage
+
+    def get_mem_budget(self):
+        # Return the memory budget in bytes, or None if not limited
+        if self.mem_budget < 0.0:
+            return None
+        elif self.mem_budget > 0.0:
+            return self.mem_budget*1.0e9
+        elif psutil is not None:
+            return psutil.virtual_memory().total*MEMORY_RATIO
+        return None
+
+    def load_mem_peaks(self):
+        # Learn the peak memory of each step from the recent runs in the trace
+        trace_fnam = self.get_trace_fnam()
+        if trace_fnam is None or not os.path.exists(trace_fnam):
+            return
+        with mem_cond:
+            if trace_fnam in mem_traces:
+                return
+            mem_traces.add(trace_fnam)
+            try:
+                with open(trace_fnam,'r') as fp:
+                    for line in fp:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue
+                        command = record.get('command')
+                        max_rss = record.get('max_rss')
+                        if command is None or max_rss is None or record.get('status') != 0:
+                            continue
+                        step = self.get_mem_key(command)
+                        if step is not None:
+                            mem_peaks.setdefault(step,deque(maxlen=MEMORY_WINDOW)).append(max_rss)
+            except Exception:
+                pass
+        return
+
+    def acquire_memory(self,step):
+        # Wait until the expected peak memory of step fits in the budget.
+        # A step with unknown footprint runs alone until it has been measured.
+        # Idle SNAP sessions are stopped only for a measured step that does not fit otherwise,
+        # as an unknown step sized at the whole budget would stop them every time.
+        budget = self.get_mem_budget()
+        if budget is None:
+            return None
+        self.load_mem_peaks()
+        with mem_cond:
+            while True:
+                measured = step in mem_peaks # may be measured while waiting
+                size = min(max(mem_peaks[step])*MEMORY_MARGIN,budget) if measured else budget
+                idle = get_idle_memory()
+                if mem_state['running'] < 1 and (idle <= 0 or not measured):
+                    break
+                if mem_state['used']+idle+size <= budget:
+                    break
+                if measured and idle > 0 and mem_state['used']+size <= budget: # stop the idle sessions rather than wait
+                    stop_sessions()
+                    continue
+                mem_cond.wait()
+            mem_state['used'] += size
+            mem_state['running'] += 1
+        return size
+
+    def release_memory(self,step,size,usage):
+        with mem_cond:
+            if step is not None and usage.get('max_rss') is not None:
+                mem_peaks.setdefault(step,deque(maxlen=MEMORY_WINDOW)).append(usage['max_rss'])
+            if size is not None:
+                mem_state['used'] -= size
+                mem_state['running'] -= 1
+                mem_cond.notify_all()
+        return
+
+    def get_trace_fnam(self):
+        return None
+
+    def write_trace(self,command,t1,t2,ret,usage,dstr=None,inproc=False):
+        trace_fnam = self.get_trace_fnam()
+        if trace_fnam is None:
+            return
+        record = {'start':t1.isoformat(),
+                  'stage':self.proc_name,
+                  'date':dstr,
+                  'step':self.get_step(command),
+                  'command':command,
+                  'inproc':inproc,
+                  'wall':(t2-t1).total_seconds(),
+                  'user':usage.get('user'),
+                  'sys':usage.get('sys'),
+                  'max_rss':usage.get('max_rss'),
+                  'read_bytes':usage.get('read_bytes'),
+                  'write_bytes':usage.get('write_bytes'),
+                  'status':ret}
+        try:
+            with trace_lock:
+                dnam = os.path.dirname(trace_fnam)
+                if not os.path.exists(dnam):
+                    os.makedirs(dnam)
+                with open(trace_fnam,'a') as fp:
+                    fp.write(json.dumps(record)+'\n')
+        except Exception as e:
+            sys.stderr.write('Warning, failed in writing trace >>> {} ({})\n'.format(trace_fnam,e))
+            sys.stderr.flush()
+        return
+
+    def run_inproc(self,args):
+        worker = None
+        with worker_lock:
+            pool = workers.setdefault(self.python_path,[])
+            while len(pool) > 0:
+                worker = pool.pop()
+                if worker.poll() is None:
+                    break
+                worker = None
+        if worker is None:
+            command = self.python_path
+            command += ' "{}"'.format(os.path.join(self.scr_dir,'proc_worker.py'))
+            worker = Popen(command,shell=True,stdin=PIPE,stdout=PIPE,universal_newlines=True)
+        try:
+            worker.stdin.write(json.dumps({'argv':args,'cwd':os.getcwd()})+'\n')
+            worker.stdin.flush()
+            line = worker.stdout.readline()
+        except Exception:
+            line = ''
+        if len(line) < 1: # the interpreter died
+            worker.kill()
+            worker.wait()
+            return -1,{}
+        with worker_lock:
+            workers.setdefault(self.python_path,[]).append(worker)
+        result = json.loads(line)
+        return result['ret'],result['usage']
+
+    def run_snap(self,args):
+        # Run a SNAP script in a persistent session. Sessions are shared by the commands with the same
+        # JVM options and at most snap_nproc of them run at a time.
+        jvm_args = []
+        for i in range(1,len(args)-1):
+            if args[i] in SNAP_OPTIONS:
+                jvm_args.extend(args[i:i+2])
+        key = (self.python_path,os.path.abspath(args[0]),tuple(jvm_args))
+        session = None
+        with snap_cond:
+            while True:
+                pool = snap_sessions.setdefault(key,[])
+                while len(pool) > 0:
+                    session = pool.pop()
+                    if session.poll() is None:
+                        break
+                    session = None
+                if session is not None:
+                    break
+                if snap_state['busy'] < self.snap_nproc:
+                    if snap_state['busy']+sum([len(v) for v in snap_sessions.values()]) >= self.snap_nproc:
+                        for v in snap_sessions.values(): # replace an idle session with other JVM options
+                            if len(v) > 0:
+                                stop_worker(v.pop())
+                                break
+                    break
+                snap_cond.wait()
+            snap_state['busy'] += 1
+        try:
+            if session is None:
+                command = self.python_path
+                command += ' "{}"'.format(key[1])
+                for arg in jvm_args:
+                    command += ' "{}"'.format(arg)
+                command += ' --server'
+                session = Popen(command,shell=True,stdin=PIPE,stdout=PIPE,universal_newlines=True)
+            try:
+                session.stdin.write(json.dumps({'argv':args[1:],'cwd':os.getcwd()})+'\n')
+                session.stdin.flush()
+                line = session.stdout.readline()
+            except Exception:
+                line = ''
+            if len(line) < 1: # the session died
+                session.kill()
+                session.wait()
+                session = None
+                return -1,{}
+            result = json.loads(line)
+            session.rss = result['usage'].get('max_rss') # kept while idle
+            return result['ret'],result['usage']
+        finally:
+            with snap_cond:
+                snap_state['busy'] -= 1
+                if session is not None:
+                    snap_sessions.setdefault(key,[]).append(session)
+                snap_cond.notify_all()
+
+    def file_hash(self,fnam):
+        # Return the SHA-256 of a file, or of the file list of a folder (e.g. .SAFE)
+        st = os.stat(fnam)
+        key = (os.path.abspath(fnam),st.st_size,st.st_mtime_ns)
+        with hash_lock:
+            if key in hash_cache:
+                return hash_cache[key]
+        h = hashlib.sha256()
+        if os.path.isdir(fnam):
+            for root,dirs,files in sorted(os.walk(fnam)):
+                dirs.sort()
+                for f in sorted(files):
+                    gnam = os.path.join(root,f)
+                    h.update('{}:{}\n'.format(os.path.relpath(gnam,fnam).replace(os.sep,'/'),os.path.getsize(gnam)).encode())
+        else:
+            with open(fnam,'rb') as fp:
+                for chunk in iter(lambda: fp.read(MANIFEST_CHUNK),b''):
+                    h.update(chunk)
+        value = h.hexdigest()
+        with hash_lock:
+            hash_cache[key] = value
+        return value
+
+    def check_manifest(self,fnam,inputs,params):
+        # Return True if fnam exists and was made from the same inputs and parameters.
+        # Products without manifest (made by older versions) are trusted.
+        # Inputs that are None or missing (e.g. removed L2A data) are not checked.
+        if not os.path.exists(fnam):
+            return False
+        mnam = fnam+'.json'
+        if not os.path.exists(mnam):
+            return True
+        try:
+            with open(mnam,'r') as fp:
+                manifest = json.load(fp)
+        except Exception:
+            return False
+        if json.dumps(manifest['params'],sort_keys=True) != json.dumps(params,sort_keys=True):
+            return False
+        if len(manifest['inputs']) != len(inputs):
+            return False
+        for inp,item in zip(inputs,manifest['inputs']):
+            if inp is None or item is None or not os.path.exists(inp):
+                continue
+            st = os.stat(inp)
+            if st.st_size == item['size'] and st.st_mtime_ns == item['mtime']:
+                continue
+            if self.file_hash(inp) != item['sha256']:
+                return False
+        return True
+
+    def write_manifest(self,fnam,inputs,params):
+        items = []
+        for inp in inputs:
+            if inp is None or not os.path.exists(inp):
+                items.append(None)
+            else:
+                st = os.stat(inp)
+                items.append({'fnam':inp,'size':st.st_size,'mtime':st.st_mtime_ns,'sha256':self.file_hash(inp)})
+        manifest = {'product':os.path.basename(fnam),'created':datetime.now().isoformat(),'inputs':items,'params':params}
+        mnam = fnam+'.json'
+        tmp_mnam = mnam+'.tmp'
+        with open(tmp_mnam,'w') as fp:
+            json.dump(manifest,fp,indent=1)
+        os.replace(tmp_mnam,mnam)
+        return
+
+    def get_part_fnam(self,fnam):
+        # Temporary name used while fnam is being written
+        root,ext = os.path.splitext(fnam)
+        return root+'.part'+ext
+
+    def remove_part(self,fnam):
+        part_fnam = self.get_part_fnam(fnam)
+        if os.path.exists(part_fnam):
+            os.remove(part_fnam)
+        return
+
+    def commit_part(self,fnam):
+        # Move a completely written file to its final name
+        part_fnam = self.get_part_fnam(fnam)
+        if os.path.exists(part_fnam):
+            os.replace(part_fnam,fnam)
+        return os.path.exists(fnam)
+
+    def run_pool(self,func,*iterables,nproc=1):
+        if nproc < 2:
+            return [func(*items) for items in zip(*iterables)]
+        with ThreadPoolExecutor(max_workers=nproc) as executor:
+            return list(executor.map(func,*iterables))
+
     def finish(self):
         self.run_t2 = datetime.now()
         sys.stderr.write('\nFinished process {} at {} ({})\n\n'.format(self.proc_name,self.run_t2,self.run_t2-self.run_t1))
@@ -588,6 +1078,7 @@ class Process:
         return check_values,check_errors
 
     def set(self,parent,chk_btn):
+        import_gui()
         if self.root is not None and self.root.winfo_exists():
             return
         for x in parent.winfo_children():
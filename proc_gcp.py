@@ -0,0 +1,48 @@
+import os
+import numpy as np
+
+# GCPs exchanged by find_gcps_cc, select_gcps, auto_geocor_cc and the geocor process.
+# xc,yc: target pixel coordinates, xp,yp: corrected target coordinates, xd,yd: shifts,
+# r: correlation coefficient, r90: spread of the scan with r > 0.9*rmax
+# GCPs are kept in a structured array and stored in binary (.npy) or text (others) format.
+GCP_DTYPE = np.dtype([('xc',np.float64),('yc',np.float64),('xp',np.float64),('yp',np.float64),
+                      ('xd',np.float64),('yd',np.float64),('r',np.float64),('r90',np.float64)])
+
+def make_gcps(size=0):
+    return np.zeros(size,dtype=GCP_DTYPE)
+
+def read_gcps(fnam):
+    # fnam can be a file name or a file object with text data
+    if isinstance(fnam,str):
+        if fnam.lower().endswith('.npy'):
+            gcps = np.load(fnam)
+            if gcps.dtype != GCP_DTYPE:
+                raise ValueError('Error, unexpected dtype {} >>> {}'.format(gcps.dtype,fnam))
+            return gcps
+        if os.path.getsize(fnam) < 1:
+            return make_gcps()
+    data = np.loadtxt(fnam,ndmin=2)
+    gcps = make_gcps(len(data))
+    if data.size > 0:
+        if data.shape[1] != len(GCP_DTYPE.names):
+            raise ValueError('Error, unexpected number of columns {} >>> {}'.format(data.shape[1],fnam))
+        for i,name in enumerate(GCP_DTYPE.names):
+            gcps[name] = data[:,i]
+    return gcps
+
+def format_gcp(gcp,exp=False,long=False):
+    if exp:
+        return '{:8.1f} {:8.1f} {:15.8e} {:15.8e} {:15.8e} {:15.8e} {:8.3f} {:8.3f}\n'.format(*gcp)
+    elif long:
+        return '{:8.1f} {:8.1f} {:12.6f} {:12.6f} {:10.6f} {:10.6f} {:10.5f} {:10.5f}\n'.format(*gcp)
+    return '{:8.1f} {:8.1f} {:8.2f} {:8.2f} {:6.2f} {:6.2f} {:8.3f} {:8.3f}\n'.format(*gcp)
+
+def write_gcps(fnam,gcps,exp=False,long=False):
+    gcps = np.asarray(gcps,dtype=GCP_DTYPE)
+    if fnam.lower().endswith('.npy'):
+        with open(fnam,'wb') as fp: # np.save(fnam) would append .npy to other names
+            np.save(fp,gcps)
+    else:
+        with open(fnam,'w') as fp:
+            fp.write(''.join([format_gcp(gcp,exp=exp,long=long) for gcp in gcps]))
+    return
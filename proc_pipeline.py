@@ -0,0 +1,144 @@
+import sys
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor,FIRST_COMPLETED,wait
+from proc_class import Process
+
+class Pipeline:
+
+    def __init__(self,pnams=None,modules=None,flags=None,nproc=1):
+        self.jobs = []
+        self.nproc = nproc
+        self.date_procs = ['geocor','indices','parcel'] # processes with one product per date
+        self.nodes = {}
+        self.run_t1 = None
+        self.run_t2 = None
+        if pnams is not None:
+            self.add_job(pnams,modules,flags)
+
+    def add_job(self,pnams,modules,flags,name=None):
+        if name is None:
+            name = '{}'.format(len(self.jobs))
+        for job in self.jobs:
+            if job[0] == name:
+                raise ValueError('Error, duplicate job >>> {}'.format(name))
+        self.jobs.append((name,pnams,modules,flags))
+        for proc in modules: # used to share the cores with the other workers
+            modules[proc].pipeline_nproc = self.nproc
+        return
+
+    def add_node(self,key,func,args=(),depends=[],after=[]):
+        # The node runs after the nodes in depends succeeded and the nodes in after finished (succeeded or not)
+        if key in self.nodes:
+            raise ValueError('Error, duplicate node >>> {}'.format(key))
+        for dep in depends+after:
+            if not dep in self.nodes:
+                raise ValueError('Error, unknown dependency >>> {} for {}'.format(dep,key))
+        self.nodes[key] = (func,args,list(depends),list(after))
+        return key
+
+    def start_date_proc(self,module):
+        # Start process and list the dates already available for it
+        Process.run(module)
+        return module.list_dates()
+
+    def build_job(self,name,pnams,modules,flags):
+        # Return the keys of the job in the order of execution
+        keys = []
+        procs = [proc for proc in pnams if flags[proc]]
+        # Global processes before the first date process (i.e. download) are run beforehand
+        # because the dates are not known until they finish.
+        while len(procs) > 0 and not procs[0] in self.date_procs:
+            modules[procs[0]].run()
+            procs = procs[1:]
+        barrier = []
+        while len(procs) > 0:
+            if procs[0] in self.date_procs:
+                # Date processes are chained for each date
+                chain = []
+                while len(procs) > 0 and procs[0] in self.date_procs:
+                    chain.append(procs[0])
+                    procs = procs[1:]
+                dstrs = {}
+                all_dstrs = set()
+                for proc in chain:
+                    dstrs[proc] = self.start_date_proc(modules[proc])
+                    all_dstrs.update(dstrs[proc])
+                units = {proc:[] for proc in chain}
+                for dstr in sorted(all_dstrs):
+                    prev = None
+                    for proc in chain:
+                        if prev is None and not dstr in dstrs[proc]:
+                            continue
+                        depends = barrier if prev is None else [prev]
+                        # Earlier dates whose products are used by this date (e.g. geocor priors)
+                        after = [(name,proc,d) for d in modules[proc].list_depends(dstr) if (name,proc,d) in self.nodes]
+                        prev = self.add_node((name,proc,dstr),modules[proc].run_date,args=(dstr,),depends=depends,after=after)
+                        units[proc].append(prev)
+                        keys.append(prev)
+                finish = []
+                for proc in chain:
+                    finish.append(self.add_node((name,proc,None),modules[proc].finish,depends=units[proc]+barrier))
+                    keys.append(finish[-1])
+                barrier = finish
+            else:
+                proc = procs[0]
+                procs = procs[1:]
+                barrier = [self.add_node((name,proc,None),modules[proc].run,depends=barrier)]
+                keys.append(barrier[0])
+        return keys
+
+    def build(self):
+        # Nodes of different jobs are interleaved so that they share the workers
+        self.nodes = {}
+        job_keys = [self.build_job(*job) for job in self.jobs]
+        order = []
+        for i in range(max([len(keys) for keys in job_keys]+[0])):
+            for keys in job_keys:
+                if i < len(keys):
+                    order.append(keys[i])
+        self.nodes = {key:self.nodes[key] for key in order}
+        return
+
+    def run(self):
+        self.run_t1 = datetime.now()
+        sys.stderr.write('\nRunning pipeline with {} process(es) at {}\n'.format(self.nproc,self.run_t1))
+        sys.stderr.flush()
+        self.build()
+        # Run nodes as soon as their dependencies are satisfied. Nodes are submitted in the
+        # order of insertion, so that the earlier dates go through the chain first.
+        done = set()
+        failed = set()
+        waiting = list(self.nodes.keys())
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.nproc) as executor:
+            while len(waiting) > 0 or len(running) > 0:
+                for key in waiting[:]:
+                    if len(running) >= self.nproc:
+                        break
+                    func,args,depends,after = self.nodes[key]
+                    if any([dep in failed for dep in depends]):
+                        sys.stderr.write('Skipped {} because of a failed dependency.\n'.format(key))
+                        sys.stderr.flush()
+                        failed.add(key)
+                        waiting.remove(key)
+                    elif all([dep in done for dep in depends]) and all([dep in done or dep in failed for dep in after]):
+                        running[executor.submit(func,*args)] = key
+                        waiting.remove(key)
+                if len(running) < 1: # nodes are inserted after their dependencies
+                    break
+                finished,not_finished = wait(running,return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(key)
+                    except Exception as e:
+                        sys.stderr.write('Error in {} >>> {}\n'.format(key,e))
+                        sys.stderr.flush()
+                        failed.add(key)
+        self.run_t2 = datetime.now()
+        sys.stderr.write('\nFinished pipeline at {} ({})\n\n'.format(self.run_t2,self.run_t2-self.run_t1))
+        sys.stderr.flush()
+        if len(failed) > 0:
+            raise ValueError('Error, {} node(s) failed >>> {}'.format(len(failed),sorted(failed,key=str)))
+        return
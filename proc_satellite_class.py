@@ -1,4 +1,13 @@
+import os
+import sys
+import re
+import json
+import threading
+from datetime import datetime
 from proc_class import Process
+from proc_catalog import list_dir
+
+journal_lock = threading.Lock()
 
 class Satellite_Process(Process):
 
@@ -13,3 +22,78 @@ class Satellite_Process(Process):
         self.s1_analysis = None
         self.s2_data = None
         self.s2_analysis = None
+        self.journal = None
+
+    def get_trace_fnam(self):
+        if not self.trace_flag or self.s2_analysis is None:
+            return None
+        return os.path.join(self.s2_analysis,'trace','command_trace.jsonl')
+
+    def get_journal_fnam(self):
+        return os.path.join(self.s2_data,self.proc_name,'journal.jsonl')
+
+    def check_journal(self,dstr,fnam):
+        # Return True if fnam was completed by an interrupted run of this process
+        with journal_lock:
+            if self.journal is None:
+                self.journal = set()
+                journal_fnam = self.get_journal_fnam()
+                if os.path.exists(journal_fnam):
+                    with open(journal_fnam,'r') as fp:
+                        for line in fp:
+                            try:
+                                record = json.loads(line)
+                            except ValueError: # incomplete line
+                                continue
+                            self.journal.add((record['date'],record['product']))
+                    sys.stderr.write('\nResume {} ({} unit(s) completed) >>> {}\n'.format(self.proc_name,len(self.journal),journal_fnam))
+                    sys.stderr.flush()
+            return (dstr,os.path.basename(fnam)) in self.journal and os.path.exists(fnam)
+
+    def add_journal(self,dstr,fnam):
+        record = {'stage':self.proc_name,'date':dstr,'product':os.path.basename(fnam),'time':datetime.now().isoformat()}
+        with journal_lock:
+            if self.journal is None:
+                self.journal = set()
+            self.journal.add((dstr,record['product']))
+            journal_fnam = self.get_journal_fnam()
+            with open(journal_fnam,'a') as fp:
+                fp.write(json.dumps(record)+'\n')
+                fp.flush()
+                os.fsync(fp.fileno())
+        return
+
+    def get_gis_fnams(self,fnam):
+        # Shapefile and its attribute table
+        return [fnam,os.path.splitext(fnam)[0]+'.dbf']
+
+    def list_products(self,dnam,suffix,d1,d2):
+        # Return the products (YYYYMMDD+suffix) in the year folders of dnam between d1 and d2
+        fnams = []
+        for year in range(d1.year,d2.year+1):
+            ynam = os.path.join(dnam,'{}'.format(year))
+            if not os.path.isdir(ynam):
+                continue
+            for f in list_dir(ynam):
+                m = re.search('^('+'\d'*8+')'+re.escape(suffix)+'$',f)
+                if not m:
+                    continue
+                d = datetime.strptime(m.group(1),'%Y%m%d')
+                if d < d1 or d > d2:
+                    continue
+                fnams.append(os.path.join(ynam,f))
+        return fnams
+
+    def list_depends(self,dstr):
+        # Return the dates to be finished before dstr (see proc_pipeline.py)
+        return []
+
+    def finish(self):
+        # All units are completed, start from scratch next time
+        with journal_lock:
+            journal_fnam = self.get_journal_fnam()
+            if os.path.exists(journal_fnam):
+                os.remove(journal_fnam)
+            self.journal = None
+        super().finish()
+        return
@@ -2,7 +2,7 @@ import os
 import shutil
 import re
 from datetime import datetime
-import tkinter as tk
+from proc_catalog import list_dir
 
 def read_month(s):
     s_low = s.lower()
@@ -34,6 +34,7 @@ def read_month(s):
         raise ValueError('Error, cannot read month >>> {}'.format(s))
 
 def ask_question():
+    import tkinter as tk
     win = tk.Tk()
     canvas = tk.Canvas(win,width=300,height=300)
     canvas.pack()
@@ -44,7 +45,7 @@ def set_obs_fnam(block,dstr,field_dir,date_format='yyyy-mm&mmm-dd'):
     if not os.path.isdir(field_dir):
         return -1
     date_fmt = date_format.replace('yyyy','%Y').replace('yy','%y').replace('mmm','%b').replace('mm','%m').replace('dd','%d').replace('&','')
-    for f in sorted(os.listdir(field_dir)):
+    for f in list_dir(field_dir):
         obs_block = None
         obs_date = None
         try:
@@ -102,7 +103,7 @@ def set_drone_dnam(block,dstr,drone_dir,date_format='yyyy-mm&mmm-dd'):
     elif not os.path.isdir(drone_dir):
         return -1
     date_fmt = date_format.replace('yyyy','%Y').replace('yy','%y').replace('mmm','%b').replace('mm','%m').replace('dd','%d').replace('&','')
-    for d in sorted(os.listdir(drone_dir)):
+    for d in list_dir(drone_dir):
         dnam = os.path.join(drone_dir,d)
         if not os.path.isdir(dnam):
             continue
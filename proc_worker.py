@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import runpy
+import warnings
+import traceback
+try:
+    import resource
+except Exception:
+    resource = None
+try:
+    import psutil
+except Exception:
+    psutil = None
+
+def get_usage():
+    # The peak RSS is given only where it can be reset for each step (see reset_peak), as the lifetime peak
+    # of the interpreter (ru_maxrss, peak_wset) would be taken for the footprint of all later steps.
+    usage = {'max_rss':None}
+    if resource is not None:
+        r = resource.getrusage(resource.RUSAGE_SELF)
+        usage['user'] = r.ru_utime
+        usage['sys'] = r.ru_stime
+        usage['read_bytes'] = r.ru_inblock*512
+        usage['write_bytes'] = r.ru_oublock*512
+    elif psutil is not None:
+        p = psutil.Process()
+        with p.oneshot():
+            t = p.cpu_times()
+            io = p.io_counters()
+            usage['user'] = t.user
+            usage['sys'] = t.system
+            usage['read_bytes'] = io.read_bytes
+            usage['write_bytes'] = io.write_bytes
+    if os.path.exists('/proc/self/status'):
+        with open('/proc/self/status','r') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    usage['max_rss'] = int(line.split()[1])*1024
+                    break
+    return usage
+
+def reset_peak():
+    # Reset the peak RSS so that it is measured for each step (Linux only), return False if not possible
+    try:
+        with open('/proc/self/clear_refs','w') as fp:
+            fp.write('5')
+    except Exception:
+        return False
+    return True
+
+def reset_state():
+    # Undo the global settings made by the scripts, as the interpreter is shared by the following steps
+    # (the warning filters are restored by catch_warnings)
+    for mnam in ['osgeo.gdal','osgeo.ogr','osgeo.osr']:
+        module = sys.modules.get(mnam)
+        if module is not None and module.GetUseExceptions():
+            module.DontUseExceptions()
+    gdal = sys.modules.get('osgeo.gdal')
+    if gdal is not None and hasattr(gdal,'GetConfigOptions'): # GDAL>=3.7, older versions cannot list the options
+        for key in gdal.GetConfigOptions():
+            gdal.SetConfigOption(key,None)
+    if 'matplotlib' in sys.modules:
+        sys.modules['matplotlib'].rc_file_defaults()
+    return
+
+# Persistent interpreter to run worker scripts without paying the startup and import cost for each step.
+# Requests are read from stdin as JSON lines ({"argv":[script,arg1,...],"cwd":folder}) and the exit status
+# and resource usage of each script are written to the original stdout. Anything printed by the scripts goes to stderr.
+proto = os.fdopen(os.dup(sys.stdout.fileno()),'w')
+os.dup2(sys.stderr.fileno(),sys.stdout.fileno())
+
+sys_path = sys.path[:]
+for line in sys.stdin:
+    line = line.strip()
+    if len(line) < 1:
+        continue
+    request = json.loads(line)
+    argv = request['argv']
+    cwd = os.getcwd()
+    sys.argv = argv
+    sys.path = [os.path.dirname(os.path.abspath(argv[0]))]+sys_path
+    peak_flag = reset_peak()
+    usage1 = get_usage()
+    try:
+        os.chdir(request['cwd'])
+        with warnings.catch_warnings():
+            runpy.run_path(argv[0],run_name='__main__')
+        ret = 0
+    except SystemExit as e:
+        if e.code is None:
+            ret = 0
+        elif isinstance(e.code,int):
+            ret = e.code
+        else:
+            sys.stderr.write('{}\n'.format(e.code))
+            ret = 1
+    except BaseException:
+        traceback.print_exc()
+        ret = 1
+    finally:
+        if 'matplotlib.pyplot' in sys.modules:
+            sys.modules['matplotlib.pyplot'].close('all')
+        reset_state()
+        os.chdir(cwd)
+        sys.stdout.flush()
+        sys.stderr.flush()
+    usage2 = get_usage()
+    usage = {}
+    for key in usage2:
+        if usage2[key] is None or usage1.get(key) is None:
+            usage[key] = None
+        elif key == 'max_rss':
+            usage[key] = usage2[key] if peak_flag else None
+        else:
+            usage[key] = usage2[key]-usage1[key]
+    proto.write(json.dumps({'ret':ret,'usage':usage})+'\n')
+    proto.flush()
@@ -10,6 +10,7 @@ from glob import glob
 import numpy as np
 from subprocess import call
 from proc_satellite_class import Satellite_Process
+from proc_catalog import list_dir
 
 class Atcor(Satellite_Process):
 
@@ -44,6 +45,10 @@ class Atcor(Satellite_Process):
         iflag = self.list_labels['oflag'].index('mask')
         flag_parcel = self.values['oflag'][iflag]
         flag_studyarea = self.values['oflag'][iflag]
+        gis_fnams = self.get_gis_fnams(self.values['gis_fnam'])
+        mask_params = {'buffer_parcel':self.values['buffer_parcel']} # same as parcel
+        studyarea_params = {pnam:self.values[pnam] for pnam in ['p1_studyarea','p2_studyarea']}
+        atcor_params = {pnam:self.values[pnam] for pnam in ['atcor_refs','atcor_nrefs','atcor_inds']}
 
         # Check Indices
         indices_fnams = []
@@ -53,7 +58,7 @@ class Atcor(Satellite_Process):
             dnam = os.path.join(self.values['indices_dir'],ystr)
             if not os.path.isdir(dnam):
                 continue
-            for f in sorted(os.listdir(dnam)):
+            for f in list_dir(dnam):
                 m = re.search('^('+'\d'*8+')_indices\.tif$',f)
                 if not m:
                     continue
@@ -75,23 +80,17 @@ class Atcor(Satellite_Process):
             ystr = '{}'.format(year)
             dnam = os.path.join(wrk_dir,ystr)
             inds_npz = os.path.join(dnam,'nearest_inds.npz')
+            d1,d2 = self.get_stat_period(year)
+            inputs = gis_fnams+self.list_products(self.values['geocor_dir'],'_geocor.tif',d1,d2)
+            params = {pnam:self.values[pnam] for pnam in ['stat_period','stat_nmin','n_ref','ref_band','ref_thr']}
             iflag = self.list_labels['oflag'].index('index')
-            if os.path.exists(inds_npz) and self.values['oflag'][iflag]:
+            if os.path.exists(inds_npz) and (self.values['oflag'][iflag] or not self.check_manifest(inds_npz,inputs,params)):
                 os.remove(inds_npz)
             if not os.path.exists(inds_npz):
                 if not os.path.exists(dnam):
                     os.makedirs(dnam)
                 if not os.path.isdir(dnam):
                     raise IOError('Error, no such folder >>> {}'.format(dnam))
-                if self.values['stat_period'] < 0:
-                    d1 = datetime(year,1,1)
-                    d2 = d1+timedelta(days=abs(self.values['stat_period']))
-                else:
-                    d2 = datetime(year,1,1)-timedelta(days=1)
-                    d1 = d2-timedelta(days=self.values['stat_period'])
-                if d1 < datetime(2017,1,1):
-                    d1 = datetime(2017,1,1)
-                    d2 = d1+timedelta(days=abs(self.values['stat_period']))
                 command = self.python_path
                 command += ' "{}"'.format(os.path.join(self.scr_dir,'atcor_select_reference.py'))
                 command += ' --shp_fnam "{}"'.format(self.values['gis_fnam'])
@@ -107,6 +106,8 @@ class Atcor(Satellite_Process):
                 command += ' --n_nearest {}'.format(self.values['n_ref'])
                 command += ' --use_index'
                 self.run_command(command,message='<<< Select nearest pixels for {} >>>'.format(ystr))
+                if os.path.exists(inds_npz):
+                    self.write_manifest(inds_npz,inputs,params)
 
         # Calculate stats
         for year in data_years:
@@ -115,8 +116,12 @@ class Atcor(Satellite_Process):
             stat_tif = os.path.join(dnam,'atcor_stat.tif')
             bnam,enam = os.path.splitext(stat_tif)
             stat_pdf = bnam+'.pdf'
+            d1,d2 = self.get_stat_period(year)
+            inputs = [self.values['mask_studyarea']]+self.list_products(self.values['indices_dir'],'_indices.tif',d1,d2)
+            params = {pnam:self.values[pnam] for pnam in ['stat_period','clean_nmin','clean_band','clean_thr']}
+            params.update(atcor_params)
             iflag = self.list_labels['oflag'].index('stats')
-            if os.path.exists(stat_tif) and self.values['oflag'][iflag]:
+            if os.path.exists(stat_tif) and (self.values['oflag'][iflag] or flag_studyarea or not self.check_manifest(stat_tif,inputs,params)):
                 os.remove(stat_tif)
             if not os.path.exists(stat_tif):
                 if not os.path.exists(dnam):
@@ -125,7 +130,7 @@ class Atcor(Satellite_Process):
                     raise IOError('Error, no such folder >>> {}'.format(dnam))
                 # Make mask
                 mask_studyarea = self.values['mask_studyarea']
-                if os.path.exists(mask_studyarea) and flag_studyarea:
+                if os.path.exists(mask_studyarea) and (flag_studyarea or not self.check_manifest(mask_studyarea,[self.values['mask_parcel']],studyarea_params)):
                     os.remove(mask_studyarea)
                 if not os.path.exists(mask_studyarea):
                     mask_dnam = os.path.dirname(mask_studyarea)
@@ -134,7 +139,7 @@ class Atcor(Satellite_Process):
                     if not os.path.isdir(mask_dnam):
                         raise IOError('Error, no such folder >>> {}'.format(mask_dnam))
                     mask_parcel = self.values['mask_parcel']
-                    if os.path.exists(mask_parcel) and flag_parcel:
+                    if os.path.exists(mask_parcel) and (flag_parcel or not self.check_manifest(mask_parcel,gis_fnams,mask_params)):
                         os.remove(mask_parcel)
                     if not os.path.exists(mask_parcel):
                         mask_dnam = os.path.dirname(mask_parcel)
@@ -153,6 +158,8 @@ class Atcor(Satellite_Process):
                             command += ' --buffer="{}"'.format(-abs(self.values['buffer_parcel']))
                         command += ' --use_index'
                         self.run_command(command,message='<<< Make parcel mask >>>')
+                        if os.path.exists(mask_parcel):
+                            self.write_manifest(mask_parcel,gis_fnams,mask_params)
                     if not os.path.exists(mask_parcel):
                         raise ValueError('Error, no such file >>> {}'.format(mask_parcel))
                     else:
@@ -183,20 +190,13 @@ class Atcor(Satellite_Process):
                         command += ' --fcc'
                     command += ' --athr {}'.format(athr)
                     self.run_command(command,message='<<< Make studyarea mask >>>')
+                    if os.path.exists(mask_studyarea):
+                        self.write_manifest(mask_studyarea,[mask_parcel],studyarea_params)
                 if not os.path.exists(mask_studyarea):
                     raise ValueError('Error, no such file >>> {}'.format(mask_studyarea))
                 else:
                     flag_studyarea = False
                 # Stats
-                if self.values['stat_period'] < 0:
-                    d1 = datetime(year,1,1)
-                    d2 = d1+timedelta(days=abs(self.values['stat_period']))
-                else:
-                    d2 = datetime(year,1,1)-timedelta(days=1)
-                    d1 = d2-timedelta(days=self.values['stat_period'])
-                if d1 < datetime(2017,1,1):
-                    d1 = datetime(2017,1,1)
-                    d2 = d1+timedelta(days=abs(self.values['stat_period']))
                 command = self.python_path
                 command += ' "{}"'.format(os.path.join(self.scr_dir,'atcor_calc_stat.py'))
                 command += ' --inpdir "{}"'.format(self.values['indices_dir'])
@@ -230,6 +230,8 @@ class Atcor(Satellite_Process):
                         raise IOError('No indices data to calculate stats for {}'.format(ystr))
                     else:
                         self.run_command(command,message='<<< Calculate stats for {} >>>'.format(ystr))
+                        if os.path.exists(stat_tif):
+                            self.write_manifest(stat_tif,inputs,params)
                 else:
                     self.print_message('No parameters to be corrected for {}.'.format(ystr),print_time=False)
 
@@ -242,8 +244,11 @@ class Atcor(Satellite_Process):
             stat_tif = os.path.join(dnam,'atcor_stat.tif')
             fact_npz = os.path.join(dnam,'{}_factor.npz'.format(dstr))
             fact_pdf = os.path.join(dnam,'{}_factor.pdf'.format(dstr))
+            inputs = [fnam,inds_npz,stat_tif]
+            params = {pnam:self.values[pnam] for pnam in ['cloud_band','cloud_thr','nstp','rel_thr']}
+            params.update(atcor_params)
             iflag = self.list_labels['oflag'].index('factor')
-            if os.path.exists(fact_npz) and self.values['oflag'][iflag]:
+            if os.path.exists(fact_npz) and (self.values['oflag'][iflag] or not self.check_manifest(fact_npz,inputs,params)):
                 os.remove(fact_npz)
             if not os.path.exists(fact_npz):
                 if not os.path.exists(dnam):
@@ -279,7 +284,9 @@ class Atcor(Satellite_Process):
                 command += ' --debug'
                 command += ' --batch'
                 if atcor_flag:
-                    self.run_command(command,message='<<< Calculate correction factor for {} >>>'.format(dstr))
+                    self.run_command(command,message='<<< Calculate correction factor for {} >>>'.format(dstr),dstr=dstr)
+                    if os.path.exists(fact_npz):
+                        self.write_manifest(fact_npz,inputs,params)
 
         # Atmospheric correction
         for fnam,dstr in zip(indices_fnams,indices_dstrs):
@@ -294,8 +301,11 @@ class Atcor(Satellite_Process):
             atcor_npz = os.path.join(dnam,'{}_atcor.npz'.format(dstr))
             atcor_shp = os.path.join(dnam,'{}_atcor.shp'.format(dstr))
             atcor_pdf = os.path.join(dnam,'{}_atcor.pdf'.format(dstr))
+            inputs = [fnam,data_npz,fact_npz,self.values['mask_parcel']]+gis_fnams
+            params = {pnam:self.values[pnam] for pnam in ['out_refs','out_nrefs','out_inds','cloud_band','cloud_thr','fit_thr']}
+            params.update(atcor_params)
             iflag = self.list_labels['oflag'].index('atcor')
-            if os.path.exists(atcor_npz) and self.values['oflag'][iflag]:
+            if os.path.exists(atcor_npz) and (self.values['oflag'][iflag] or not self.check_manifest(atcor_npz,inputs,params)):
                 os.remove(atcor_npz)
             if self.values['csv_flag']:
                 atcor_csv = os.path.join(dnam,'{}_atcor.csv'.format(dstr))
@@ -311,7 +321,7 @@ class Atcor(Satellite_Process):
                     raise IOError('Error, no such folder >>> {}'.format(dnam))
                 # Make mask
                 mask_parcel = self.values['mask_parcel']
-                if os.path.exists(mask_parcel) and flag_parcel:
+                if os.path.exists(mask_parcel) and (flag_parcel or not self.check_manifest(mask_parcel,gis_fnams,mask_params)):
                     os.remove(mask_parcel)
                 if not os.path.exists(mask_parcel):
                     mask_dnam = os.path.dirname(mask_parcel)
@@ -330,6 +340,8 @@ class Atcor(Satellite_Process):
                         command += ' --buffer="{}"'.format(-abs(self.values['buffer_parcel']))
                     command += ' --use_index'
                     self.run_command(command,message='<<< Make parcel mask >>>')
+                    if os.path.exists(mask_parcel):
+                        self.write_manifest(mask_parcel,gis_fnams,mask_params)
                 if not os.path.exists(mask_parcel):
                     raise ValueError('Error, no such file >>> {}'.format(mask_parcel))
                 else:
@@ -404,8 +416,22 @@ class Atcor(Satellite_Process):
                 command += ' --debug'
                 command += ' --batch'
                 if atcor_flag:
-                    self.run_command(command,message='<<< Atmospheric correction for {} >>>'.format(dstr))
+                    self.run_command(command,message='<<< Atmospheric correction for {} >>>'.format(dstr),dstr=dstr)
+                    if os.path.exists(atcor_npz):
+                        self.write_manifest(atcor_npz,inputs,params)
 
         # Finish process
         super().finish()
         return
+
+    def get_stat_period(self,year):
+        if self.values['stat_period'] < 0:
+            d1 = datetime(year,1,1)
+            d2 = d1+timedelta(days=abs(self.values['stat_period']))
+        else:
+            d2 = datetime(year,1,1)-timedelta(days=1)
+            d1 = d2-timedelta(days=self.values['stat_period'])
+        if d1 < datetime(2017,1,1):
+            d1 = datetime(2017,1,1)
+            d2 = d1+timedelta(days=abs(self.values['stat_period']))
+        return d1,d2
@@ -2,6 +2,7 @@ import os
 import sys
 import shutil
 import re
+import json
 from datetime import datetime
 import zipfile
 try:
@@ -11,6 +12,10 @@ except Exception:
 from glob import glob
 import numpy as np
 from proc_satellite_class import Satellite_Process
+from proc_catalog import list_dir,list_entries
+from proc_gcp import read_gcps,write_gcps
+
+SCL_FLAGS = [0,1,3,8,9,10] # SCL no data, saturated, cloud shadow, cloud medium/high probability, cirrus
 
 def calc_mean(x,y,emax=2.0,nrpt=10,nmin=1,selected=None):
     if selected is not None:
@@ -35,12 +40,65 @@ class Geocor(Satellite_Process):
 
     def __init__(self):
         super().__init__()
+        self.l2a_fnams = {}
         self._freeze()
 
     def run(self):
         # Start process
         super().run()
 
+        # Check Sentinel-2 L2A
+        first_dtim = datetime.strptime(self.first_date,self.date_fmt)
+        last_dtim = datetime.strptime(self.last_date,self.date_fmt)
+        data_years = np.arange(first_dtim.year,last_dtim.year+1,1)
+        wrk_dir = os.path.join(self.s2_data,self.proc_name)
+        l2a_dstrs = self.list_dates()
+        l2a_fnams = [self.l2a_fnams[dstr] for dstr in l2a_dstrs]
+
+        # Subset
+        subset_fnams = []
+        subset_dstrs = []
+        for gnam,dstr in zip(self.run_pool(self.run_subset,l2a_fnams,l2a_dstrs,nproc=self.values['n_proc']),l2a_dstrs):
+            if gnam is not None:
+                subset_fnams.append(gnam)
+                subset_dstrs.append(dstr)
+        if len(subset_dstrs) < 1:
+            self.print_message('No subset data for process.',print_time=False)
+        iflag = self.list_labels['oflag'].index('geocor')
+        if not self.values['oflag'][iflag]:
+            for year in data_years:
+                ystr = '{}'.format(year)
+                dnam = os.path.join(wrk_dir,ystr)
+                if not os.path.isdir(dnam):
+                    continue
+                for f in list_dir(dnam):
+                    m = re.search('^('+'\d'*8+')_geocor\.tif$',f)
+                    if not m:
+                        continue
+                    dstr = m.group(1)
+                    d = datetime.strptime(dstr,'%Y%m%d')
+                    if d < first_dtim or d > last_dtim:
+                        continue
+                    if not dstr in subset_dstrs:
+                        subset_fnams.append(None)
+                        subset_dstrs.append(dstr)
+        inds = np.argsort(subset_dstrs)#[::-1]
+        subset_fnams = [subset_fnams[i] for i in inds]
+        subset_dstrs = [subset_dstrs[i] for i in inds]
+
+        # Geometric correction, the dates in the same relative orbit are processed in order
+        # when the GCPs of the earlier dates are used as priors (see get_prior_fnams)
+        chains = {}
+        for fnam,dstr in zip(subset_fnams,subset_dstrs):
+            orbit = self.get_orbit(dstr) if self.values['prior_days'] > 0.0 else None
+            chains.setdefault(dstr if orbit is None else orbit,[]).append((fnam,dstr))
+        self.run_pool(self.run_chain,list(chains.values()),nproc=self.values['n_proc'])
+
+        # Finish process
+        super().finish()
+        return
+
+    def list_dates(self):
         # Check files/folders
         start_dtim = datetime.strptime(self.start_date,self.date_fmt)
         end_dtim = datetime.strptime(self.end_date,self.date_fmt)
@@ -70,7 +128,7 @@ class Geocor(Satellite_Process):
             dnam = os.path.join(self.values['l2a_dir'],ystr)
             if not os.path.isdir(dnam):
                 continue
-            for f in sorted(os.listdir(dnam)):
+            for f,size,mtime,isdir in list_entries(dnam):
                 m = re.search('^S2[AB]_MSIL2A_('+'\d'*8+')T\S+\.zip$',f)
                 if not m:
                     m = re.search('^S2[AB]_MSIL2A_('+'\d'*8+')T\S+\.SAFE$',f)
@@ -91,7 +149,7 @@ class Geocor(Satellite_Process):
                 fnam = os.path.join(dnam,f)
                 l2a_fnams.append(fnam)
                 l2a_dstrs.append(dstr)
-                l2a_sizes.append(os.path.getsize(fnam))
+                l2a_sizes.append(size)
         if len(l2a_dstrs) < 1:
             self.print_message('No L2A data for process.',print_time=False)
         iflag = self.list_labels['oflag'].index('subset')
@@ -101,7 +159,7 @@ class Geocor(Satellite_Process):
                 dnam = os.path.join(wrk_dir,ystr)
                 if not os.path.isdir(dnam):
                     continue
-                for f in sorted(os.listdir(dnam)):
+                for f in list_dir(dnam):
                     m = re.search('^('+'\d'*8+')_subset\.tif$',f)
                     if not m:
                         continue
@@ -121,259 +179,424 @@ class Geocor(Satellite_Process):
         dup = [dstr for dstr in set(l2a_dstrs) if l2a_dstrs.count(dstr) > 1]
         for dstr in dup:
             inds = np.array([i for i,d in enumerate(l2a_dstrs) if d == dstr])
+            for i in inds: # the catalog may hold the size of a file still being written
+                if l2a_fnams[i] is not None and os.path.exists(l2a_fnams[i]):
+                    l2a_sizes[i] = os.path.getsize(l2a_fnams[i])
             fs = [l2a_fnams[j] for j in inds[np.argsort([l2a_sizes[i] for i in inds])[-2::-1]]]
             for fnam in fs:
                 i = l2a_fnams.index(fnam)
                 del l2a_fnams[i]
                 del l2a_dstrs[i]
                 del l2a_sizes[i]
+        self.l2a_fnams = dict(zip(l2a_dstrs,l2a_fnams))
+        return l2a_dstrs
 
-        # Subset
-        subset_fnams = []
-        subset_dstrs = []
-        for fnam,dstr in zip(l2a_fnams,l2a_dstrs):
-            d = datetime.strptime(dstr,'%Y%m%d')
-            ystr = '{}'.format(d.year)
-            dnam = os.path.join(wrk_dir,ystr)
-            gnam = os.path.join(dnam,'{}_subset.tif'.format(dstr))
-            tmp_gnam = os.path.join(dnam,'{}_subset_tmp.tif'.format(dstr))
-            if os.path.exists(tmp_gnam):
-                os.remove(tmp_gnam)
-            iflag = self.list_labels['oflag'].index('subset')
-            if self.values['oflag'][iflag]:
-                if os.path.exists(gnam):
-                    os.remove(gnam)
-            if not os.path.exists(gnam):
-                if not os.path.exists(dnam):
-                    os.makedirs(dnam)
-                if not os.path.isdir(dnam):
-                    raise IOError('Error, no such folder >>> {}'.format(dnam))
-                unzip_flag = False
-                use_zip = False
+    def run_chain(self,items):
+        for fnam,dstr in items:
+            self.run_geocor(fnam,dstr)
+        return
+
+    def run_date(self,dstr):
+        gnam = self.run_subset(self.l2a_fnams[dstr],dstr)
+        if gnam is not None:
+            self.run_geocor(gnam,dstr)
+        return
+
+    def run_subset(self,fnam,dstr):
+        wrk_dir = os.path.join(self.s2_data,self.proc_name)
+        d = datetime.strptime(dstr,'%Y%m%d')
+        ystr = '{}'.format(d.year)
+        dnam = os.path.join(wrk_dir,ystr)
+        gnam = os.path.join(dnam,'{}_subset.tif'.format(dstr))
+        tmp_gnam = os.path.join(dnam,'{}_subset_tmp.tif'.format(dstr))
+        if os.path.exists(tmp_gnam):
+            os.remove(tmp_gnam)
+        self.remove_part(gnam)
+        params = {pnam:self.values[pnam] for pnam in ['trg_subset','trg_pixel']}
+        if self.values['subset_tool'] != 'SNAP': # keep the products made by SNAP valid
+            params['subset_tool'] = self.values['subset_tool']
+        iflag = self.list_labels['oflag'].index('subset')
+        # Units completed before interruption are not overwritten again, but still checked by the manifest
+        if (self.values['oflag'][iflag] and not self.check_journal(dstr,gnam)) or not self.check_manifest(gnam,[fnam],params):
+            if os.path.exists(gnam):
+                os.remove(gnam)
+        if not os.path.exists(gnam):
+            if not os.path.exists(dnam):
+                os.makedirs(dnam,exist_ok=True) # may be created by another worker
+            if not os.path.isdir(dnam):
+                raise IOError('Error, no such folder >>> {}'.format(dnam))
+            if self.values['subset_tool'] == 'GDAL':
+                # Read the L2A product with GDAL, no unzip is needed
                 rnam = os.path.splitext(fnam)[0]+'.SAFE'
-                if not os.path.exists(rnam):
-                    try:
-                        with zipfile.ZipFile(fnam,'r') as z:
-                            for d in z.namelist():
-                                dnam = os.path.dirname(d)
-                                if re.search('\.SAFE$',dnam):
-                                    if os.path.basename(rnam) != dnam:
-                                        raise ValueError('Error, rnam={}, dnam={}'.format(rnam,dnam))
-                                    break
-                            command = self.values['unzip'].strip()
-                            if command.lower() == 'none':
-                                os.makedirs(rnam)
-                                if not os.path.isdir(rnam):
-                                    raise IOError('Error, no such folder >>> {}'.format(rnam))
-                                use_zip = True
-                            elif command != '':
-                                if '@' in command:
-                                    command = command.replace('@',os.path.dirname(fnam))
-                                command += ' "{}"'.format(fnam)
-                                self.run_command(command,message='<<< Unzip for {} >>>'.format(dstr))
-                            else:
-                                z.extractall(os.path.dirname(fnam))
-                        unzip_flag = True
-                    except Exception as e:
-                        sys.stderr.write(str(e)+'\n')
-                        sys.stderr.flush()
-                        continue
                 command = self.python_path
-                command += ' {}'.format(os.path.join(self.scr_dir,'sentinel2_subset.py'))
-                if use_zip:
+                command += ' {}'.format(os.path.join(self.scr_dir,'sentinel2_subset_gdal.py'))
+                command += ' --inp_fnam "{}"'.format(rnam if os.path.isdir(rnam) else fnam)
+                command += ' --out_fnam "{}"'.format(self.get_part_fnam(gnam))
+                command += ' --polygon "{}"'.format(self.get_polygon())
+                command += ' --resolution {}'.format(int(self.values['trg_pixel']+0.5))
+                command += ' --overwrite'
+                self.run_command(command,message='<<< Subset for {} >>>'.format(dstr),dstr=dstr)
+                if self.commit_part(gnam):
+                    self.write_manifest(gnam,[fnam],params)
+                    self.add_journal(dstr,gnam)
+                if os.path.exists(gnam):
+                    return gnam
+                return None
+            unzip_flag = False
+            use_zip = False
+            rnam = os.path.splitext(fnam)[0]+'.SAFE'
+            if not os.path.exists(rnam):
+                try:
+                    with zipfile.ZipFile(fnam,'r') as z:
+                        for d in z.namelist():
+                            dnam = os.path.dirname(d)
+                            if re.search('\.SAFE$',dnam):
+                                if os.path.basename(rnam) != dnam:
+                                    raise ValueError('Error, rnam={}, dnam={}'.format(rnam,dnam))
+                                break
+                        command = self.values['unzip'].strip()
+                        if command.lower() == 'none':
+                            os.makedirs(rnam)
+                            if not os.path.isdir(rnam):
+                                raise IOError('Error, no such folder >>> {}'.format(rnam))
+                            use_zip = True
+                        elif command != '':
+                            if '@' in command:
+                                command = command.replace('@',os.path.dirname(fnam))
+                            command += ' "{}"'.format(fnam)
+                            self.run_command(command,message='<<< Unzip for {} >>>'.format(dstr),dstr=dstr)
+                        else:
+                            z.extractall(os.path.dirname(fnam))
+                    unzip_flag = True
+                except Exception as e:
+                    sys.stderr.write(str(e)+'\n')
+                    sys.stderr.flush()
+                    return None
+            command = self.python_path
+            command += ' {}'.format(os.path.join(self.scr_dir,'sentinel2_subset.py'))
+            if use_zip:
+                if self.snap_nproc < 1: # a persistent session keeps its own temporary directory
                     command += ' --tmp_dnam "{}"'.format(rnam)
-                    command += ' --inp_fnam "{}"'.format(fnam)
+                command += ' --inp_fnam "{}"'.format(fnam)
+            else:
+                command += ' --inp_fnam "{}"'.format(rnam)
+            command += ' --out_fnam "{}"'.format(tmp_gnam)
+            command += ' --polygon "{}"'.format(self.get_polygon())
+            command += ' --resolution {}'.format(int(self.values['trg_pixel']+0.5))
+            mem_budget = self.get_mem_budget()
+            if mem_budget is not None and self.values['n_proc'] > 1: # share the budget with the other workers
+                command += ' --max_memory {}'.format(int(mem_budget*1.0e-6/self.values['n_proc']))
+            command += ' --geotiff'
+            self.run_command(command,message='<<< Subset for {} >>>'.format(dstr),dstr=dstr)
+            if unzip_flag:
+                if os.name == 'nt':
+                    modified_path = r'\\?\ '.strip()+rnam # for long file/folder name
                 else:
-                    command += ' --inp_fnam "{}"'.format(rnam)
-                command += ' --out_fnam "{}"'.format(tmp_gnam)
-                command += ' --polygon "POLYGON(({} {},{} {},{} {},{} {},{} {}))"'.format(self.values['trg_subset'][0],self.values['trg_subset'][2],
-                                                                                          self.values['trg_subset'][1],self.values['trg_subset'][2],
-                                                                                          self.values['trg_subset'][1],self.values['trg_subset'][3],
-                                                                                          self.values['trg_subset'][0],self.values['trg_subset'][3],
-                                                                                          self.values['trg_subset'][0],self.values['trg_subset'][2])
-                command += ' --resolution {}'.format(int(self.values['trg_pixel']+0.5))
-                command += ' --geotiff'
-                self.run_command(command,message='<<< Subset for {} >>>'.format(dstr))
-                if unzip_flag:
-                    if os.name == 'nt':
-                        modified_path = r'\\?\ '.strip()+rnam # for long file/folder name
-                    else:
-                        modified_path = rnam
-                    shutil.rmtree(modified_path)
-                # Remove cache
-                command = self.python_path
-                command += ' {}'.format(os.path.join(self.scr_dir,'remove_snap_cache.py'))
-                self.run_command(command,print_command=False,print_time=False)
-                if os.path.exists(tmp_gnam):
-                    # Append bandname
-                    command = self.python_path
-                    command += ' {}'.format(os.path.join(self.scr_dir,'sentinel2_bandname.py'))
-                    command += ' --inp_fnam "{}"'.format(tmp_gnam)
-                    command += ' --out_fnam "{}"'.format(gnam)
-                    command += ' --date {}'.format(dstr)
-                    command += ' --replace_no_data'
-                    command += ' --add_offset'
-                    self.run_command(command,message='<<< Append bandname for {} >>>'.format(dstr))
+                    modified_path = rnam
+                shutil.rmtree(modified_path)
+            # Remove cache
+            command = self.python_path
+            command += ' {}'.format(os.path.join(self.scr_dir,'remove_snap_cache.py'))
+            self.run_command(command,print_command=False,print_time=False,dstr=dstr)
             if os.path.exists(tmp_gnam):
-                os.remove(tmp_gnam)
-            if os.path.exists(gnam):
-                subset_fnams.append(gnam)
-                subset_dstrs.append(dstr)
-        if len(subset_dstrs) < 1:
-            self.print_message('No subset data for process.',print_time=False)
-        iflag = self.list_labels['oflag'].index('geocor')
-        if not self.values['oflag'][iflag]:
-            for year in data_years:
-                ystr = '{}'.format(year)
-                dnam = os.path.join(wrk_dir,ystr)
-                if not os.path.isdir(dnam):
-                    continue
-                for f in sorted(os.listdir(dnam)):
-                    m = re.search('^('+'\d'*8+')_geocor\.tif$',f)
-                    if not m:
-                        continue
-                    dstr = m.group(1)
-                    d = datetime.strptime(dstr,'%Y%m%d')
-                    if d < first_dtim or d > last_dtim:
-                        continue
-                    if not dstr in subset_dstrs:
-                        subset_fnams.append(None)
-                        subset_dstrs.append(dstr)
-        inds = np.argsort(subset_dstrs)#[::-1]
-        subset_fnams = [subset_fnams[i] for i in inds]
-        subset_dstrs = [subset_dstrs[i] for i in inds]
+                # Append bandname
+                command = self.python_path
+                command += ' {}'.format(os.path.join(self.scr_dir,'sentinel2_bandname.py'))
+                command += ' --inp_fnam "{}"'.format(tmp_gnam)
+                command += ' --out_fnam "{}"'.format(self.get_part_fnam(gnam))
+                command += ' --date {}'.format(dstr)
+                command += ' --replace_no_data'
+                command += ' --add_offset'
+                self.run_command(command,message='<<< Append bandname for {} >>>'.format(dstr),dstr=dstr)
+                if self.commit_part(gnam):
+                    self.write_manifest(gnam,[fnam],params)
+                    self.add_journal(dstr,gnam)
+        if os.path.exists(tmp_gnam):
+            os.remove(tmp_gnam)
+        if os.path.exists(gnam):
+            return gnam
+        return None
 
-        # Geometric correction
-        S2_BAND = {'b':'B2','g':'B3','r':'B4','e1':'B5','e2':'B6','e3':'B7','n1':'B8','n2':'B8A','s1':'B11','s2':'B12'}
-        orders = {'1st':1,'2nd':2,'3rd':3}
-        for fnam,dstr in zip(subset_fnams,subset_dstrs):
+    def get_polygon(self):
+        return 'POLYGON(({} {},{} {},{} {},{} {},{} {}))'.format(self.values['trg_subset'][0],self.values['trg_subset'][2],
+                                                             self.values['trg_subset'][1],self.values['trg_subset'][2],
+                                                             self.values['trg_subset'][1],self.values['trg_subset'][3],
+                                                             self.values['trg_subset'][0],self.values['trg_subset'][3],
+                                                             self.values['trg_subset'][0],self.values['trg_subset'][2])
+
+    def get_orbit(self,dstr):
+        # Relative orbit number in the L2A file name (e.g. S2A_MSIL2A_20190105T025101_N0211_R132_T48MYT_...)
+        fnam = self.l2a_fnams.get(dstr)
+        if fnam is None: # L2A used for the subset
             d = datetime.strptime(dstr,'%Y%m%d')
-            ystr = '{}'.format(d.year)
-            dnam = os.path.join(wrk_dir,ystr)
-            gnam = os.path.join(dnam,'{}_geocor.tif'.format(dstr))
-            tmp_gnam = os.path.join(dnam,'{}_geocor_tmp.tif'.format(dstr))
-            dat_fnam = os.path.join(dnam,'{}_geocor.dat'.format(dstr))
-            if os.path.exists(tmp_gnam):
-                os.remove(tmp_gnam)
-            iflag = self.list_labels['oflag'].index('geocor')
-            if self.values['oflag'][iflag]:
-                if os.path.exists(dat_fnam):
-                    os.remove(dat_fnam)
-            if not os.path.exists(dat_fnam):
-                if not os.path.exists(dnam):
-                    os.makedirs(dnam)
-                if not os.path.isdir(dnam):
-                    raise IOError('Error, no such folder >>> {}'.format(dnam))
-                if os.path.exists(gnam):
-                    os.remove(gnam)
-                se1_fnam = os.path.join(dnam,'{}_geocor_selected1.dat'.format(dstr))
-                se2_fnam = os.path.join(dnam,'{}_geocor_selected2.dat'.format(dstr))
-                tmp_fnam = os.path.join(dnam,'{}_geocor_temp.dat'.format(dstr))
-                ds = gdal.Open(fnam)
-                trg_trans = ds.GetGeoTransform()
-                ds = None
-                trg_xstp = trg_trans[1]
-                trg_pixel_size = abs(trg_xstp)
-                size = np.int64(self.values['part_size']/trg_pixel_size+0.5)
-                step = np.int64(self.values['gcp_interval']/trg_pixel_size+0.5)
-                shift = np.int64(self.values['max_shift']/trg_pixel_size+0.5)
-                margin = np.int64(self.values['margin']/trg_pixel_size+0.5)
-                command = self.python_path
-                command += ' "{}"'.format(os.path.join(self.scr_dir,'find_gcps_cc.py'))
-                command += ' "{}"'.format(fnam)
-                command += ' "{}"'.format(self.values['ref_fnam'])
-                command += ' --out_fnam "{}"'.format(dat_fnam)
-                command += ' --x0 {:.4f}'.format(self.values['init_shifts'][0])
-                command += ' --y0 {:.4f}'.format(self.values['init_shifts'][1])
-                command += ' --subset_width {}'.format(size)
-                command += ' --subset_height {}'.format(size)
-                command += ' --trg_indx_step {}'.format(step)
-                command += ' --trg_indy_step {}'.format(step)
-                command += ' --shift_width {}'.format(shift)
-                command += ' --shift_height {}'.format(shift)
-                command += ' --margin_width {}'.format(margin)
-                command += ' --margin_height {}'.format(margin)
-                command += ' --scan_indx_step {}'.format(self.values['scan_step'])
-                command += ' --scan_indy_step {}'.format(self.values['scan_step'])
-                if self.values['ref_bands'][0] < 0: # panchromatic
-                    command += ' --ref_band -1'
-                elif self.values['ref_bands'][1] < 0: # single band
-                    command += ' --ref_band {}'.format(self.values['ref_bands'][0])
-                elif self.values['ref_bands'][2] < 0: # dual band
-                    command += ' --ref_multi_band {}'.format(self.values['ref_bands'][0])
-                    command += ' --ref_multi_band {}'.format(self.values['ref_bands'][1])
-                    command += ' --ref_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['ref_factors'][0]) else self.values['ref_factors'][0])
-                    command += ' --ref_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['ref_factors'][1]) else self.values['ref_factors'][1])
-                else: # triple band
-                    command += ' --ref_multi_band {}'.format(self.values['ref_bands'][0])
-                    command += ' --ref_multi_band {}'.format(self.values['ref_bands'][1])
-                    command += ' --ref_multi_band {}'.format(self.values['ref_bands'][2])
-                    command += ' --ref_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['ref_factors'][0]) else self.values['ref_factors'][0])
-                    command += ' --ref_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['ref_factors'][1]) else self.values['ref_factors'][1])
-                    command += ' --ref_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['ref_factors'][2]) else self.values['ref_factors'][2])
-                trg_bands = []
-                for band in self.values['trg_bands']:
-                    band_name = band.strip()
-                    if len(band_name) < 1:
-                        band_name = '-1'
-                    elif band_name in S2_BAND:
-                        band_name = S2_BAND[band_name]
-                    trg_bands.append(band_name)
-                if trg_bands[0][0] == '-': # panchromatic
-                    command += ' --trg_band -1'
-                elif trg_bands[1][0] == '-': # single band
-                    command += ' --trg_band_name "{}"'.format(trg_bands[0])
-                elif trg_bands[2][0] == '-': # dual band
-                    command += ' --trg_multi_band_name "{}"'.format(trg_bands[0])
-                    command += ' --trg_multi_band_name "{}"'.format(trg_bands[1])
-                    command += ' --trg_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['trg_factors'][0]) else self.values['trg_factors'][0])
-                    command += ' --trg_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['trg_factors'][1]) else self.values['trg_factors'][1])
-                else: # triple band
-                    command += ' --trg_multi_band_name "{}"'.format(trg_bands[0])
-                    command += ' --trg_multi_band_name "{}"'.format(trg_bands[1])
-                    command += ' --trg_multi_band_name "{}"'.format(trg_bands[2])
-                    command += ' --trg_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['trg_factors'][0]) else self.values['trg_factors'][0])
-                    command += ' --trg_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['trg_factors'][1]) else self.values['trg_factors'][1])
-                    command += ' --trg_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['trg_factors'][2]) else self.values['trg_factors'][2])
-                if not np.isnan(self.values['ref_range'][0]):
-                    command += ' --ref_data_min="{}"'.format(self.values['ref_range'][0])
-                if not np.isnan(self.values['ref_range'][1]):
-                    command += ' --ref_data_max="{}"'.format(self.values['ref_range'][1])
-                if not np.isnan(self.values['trg_range'][0]):
-                    command += ' --trg_data_min="{}"'.format(self.values['trg_range'][0])
-                if not np.isnan(self.values['trg_range'][1]):
-                    command += ' --trg_data_max="{}"'.format(self.values['trg_range'][1])
-                command += ' --rthr {}'.format(self.values['cmin'])
-                command += ' --feps 0.01'
-                command += ' --exp'
-                command += ' --out_empty'
-                try:
-                    self.run_command(command,message='<<< Find GCPs for {} >>>'.format(dstr))
-                except Exception:
+            mnam = os.path.join(self.s2_data,self.proc_name,'{}'.format(d.year),'{}_subset.tif.json'.format(dstr))
+            try:
+                with open(mnam,'r') as fp:
+                    fnam = json.load(fp)['inputs'][0]['fnam']
+            except Exception:
+                return None
+        m = re.search('_R(\d\d\d)_',os.path.basename(fnam))
+        if not m:
+            return None
+        return m.group(1)
+
+    def list_depends(self,dstr):
+        # Earlier dates of this run whose GCPs may be used as priors, they are finished before dstr
+        # so that the priors do not depend on which dates finish first
+        dstrs = []
+        if self.values['prior_days'] <= 0.0:
+            return dstrs
+        orbit = self.get_orbit(dstr)
+        if orbit is None:
+            return dstrs
+        d = datetime.strptime(dstr,'%Y%m%d')
+        for dstr_prior in sorted(self.l2a_fnams):
+            dif = (d-datetime.strptime(dstr_prior,'%Y%m%d')).days
+            if dif < 1 or dif > self.values['prior_days']:
+                continue
+            if self.get_orbit(dstr_prior) != orbit:
+                continue
+            dstrs.append(dstr_prior)
+        return dstrs
+
+    def get_made_inputs(self,fnam):
+        # Return the inputs recorded in the manifest of fnam, or None
+        try:
+            with open(fnam+'.json','r') as fp:
+                return [None if item is None else item['fnam'] for item in json.load(fp)['inputs']]
+        except Exception:
+            return None
+
+    def get_prior_fnams(self,dstr):
+        # GCPs of the earlier acquisitions in the same relative orbit within prior_days
+        # Later acquisitions are not used, as they would use this one in turn and never settle down
+        # The earlier acquisitions of this run are finished before (see list_depends and run)
+        fnams = []
+        if self.values['prior_days'] <= 0.0:
+            return fnams
+        orbit = self.get_orbit(dstr)
+        if orbit is None:
+            return fnams
+        wrk_dir = os.path.join(self.s2_data,self.proc_name)
+        d = datetime.strptime(dstr,'%Y%m%d')
+        difs = []
+        for year in range(d.year-1,d.year+1):
+            dnam = os.path.join(wrk_dir,'{}'.format(year))
+            if not os.path.isdir(dnam):
+                continue
+            for f in list_dir(dnam):
+                m = re.search('^('+'\d'*8+')_geocor\.dat$',f)
+                if not m:
                     continue
-                if not os.path.exists(dat_fnam):
-                    self.print_message('No GCPs found.',print_time=False)
+                d_prior = datetime.strptime(m.group(1),'%Y%m%d')
+                dif = (d-d_prior).days
+                if dif < 1 or dif > self.values['prior_days']:
                     continue
-                elif os.path.getsize(dat_fnam) < 1:
-                    self.print_message('No GCPs found.',print_time=False)
+                if self.get_orbit(m.group(1)) != orbit:
                     continue
-                x,y,r,r90 = np.loadtxt(dat_fnam,usecols=(4,5,6,7),unpack=True)
-                if not np.iterable(x):
-                    self.print_message('Not enough GCPs were found >>> {}'.format(x.size),print_time=False)
+                dat_fnam = os.path.join(dnam,f)
+                if not os.path.exists(dat_fnam+'.json') and not self.check_journal(m.group(1),dat_fnam): # not committed
                     continue
+                # Use the GCPs after selection if available
+                fnam = os.path.join(dnam,'{}_geocor_selected2.npy'.format(m.group(1)))
+                if not os.path.exists(fnam):
+                    fnam = os.path.join(dnam,'{}_geocor_selected2.dat'.format(m.group(1))) # older versions
+                if not os.path.exists(fnam):
+                    fnam = dat_fnam
+                fnams.append(fnam)
+                difs.append(dif)
+        return [fnams[i] for i in np.argsort(difs,kind='stable')]
+
+    def get_flag_band(self):
+        # Scene classification band used to skip cloudy subsets
+        for band in self.values['trg_flags']:
+            if 'scene_classification' in band:
+                return band.strip()
+        return None
+
+    def run_geocor(self,fnam,dstr):
+        S2_BAND = {'b':'B2','g':'B3','r':'B4','e1':'B5','e2':'B6','e3':'B7','n1':'B8','n2':'B8A','s1':'B11','s2':'B12'}
+        orders = {'1st':1,'2nd':2,'3rd':3}
+        wrk_dir = os.path.join(self.s2_data,self.proc_name)
+        d = datetime.strptime(dstr,'%Y%m%d')
+        ystr = '{}'.format(d.year)
+        dnam = os.path.join(wrk_dir,ystr)
+        gnam = os.path.join(dnam,'{}_geocor.tif'.format(dstr))
+        tmp_gnam = os.path.join(dnam,'{}_geocor_tmp.tif'.format(dstr))
+        dat_fnam = os.path.join(dnam,'{}_geocor.dat'.format(dstr))
+        if os.path.exists(tmp_gnam):
+            os.remove(tmp_gnam)
+        self.remove_part(gnam)
+        self.remove_part(dat_fnam)
+        params = {pnam:self.values[pnam] for pnam in ['ref_bands','ref_factors','ref_range','trg_resample','trg_pixel','trg_bands','trg_factors',
+                                                      'trg_flags','trg_range','init_shifts','part_size','gcp_interval','max_shift','margin',
+                                                      'scan_step','geocor_order','nmin','cmin','rmax','emaxs','smooth_fact','smooth_dmax']}
+        prior_fnams = self.get_prior_fnams(dstr)
+        if self.values['prior_days'] > 0.0: # keep the products made without priors valid
+            params.update({pnam:self.values[pnam] for pnam in ['prior_days','prior_shift']})
+        if self.values['ref_pixel'] > 0.0: # keep the products made with the original reference valid
+            params['ref_pixel'] = self.values['ref_pixel']
+        if self.values['trg_flag_max'] > 0.0: # keep the products made without the screening valid
+            params['trg_flag_max'] = self.values['trg_flag_max']
+            if self.get_flag_band() is not None:
+                params['trg_flag_values'] = SCL_FLAGS
+        if self.values['trg_std_min'] > 0.0: # keep the products made without the screening valid
+            params['trg_std_min'] = self.values['trg_std_min']
+        if self.values['gcp_nstop'] > 0: # keep the products made with the full search valid
+            params['gcp_nstop'] = self.values['gcp_nstop']
+        inputs = [fnam,self.values['ref_fnam']]+prior_fnams
+        # Priors committed after the product do not invalidate it, the priors it was made from are checked
+        made_inputs = self.get_made_inputs(dat_fnam)
+        check_inputs = inputs if made_inputs is None else inputs[:2]+made_inputs[2:]
+        iflag = self.list_labels['oflag'].index('geocor')
+        # Units completed before interruption are not overwritten again, but still checked by the manifest
+        if (self.values['oflag'][iflag] and not self.check_journal(dstr,dat_fnam)) or (fnam is not None and not self.check_manifest(dat_fnam,check_inputs,params)):
+            if os.path.exists(dat_fnam):
+                os.remove(dat_fnam)
+        if not os.path.exists(dat_fnam):
+            if not os.path.exists(dnam):
+                os.makedirs(dnam,exist_ok=True) # may be created by another worker
+            if not os.path.isdir(dnam):
+                raise IOError('Error, no such folder >>> {}'.format(dnam))
+            if os.path.exists(gnam):
+                os.remove(gnam)
+            # GCPs are exchanged in binary format, only the final list is written in text format
+            gcp_fnam = os.path.join(dnam,'{}_geocor_found.npy'.format(dstr))
+            se1_fnam = os.path.join(dnam,'{}_geocor_selected1.npy'.format(dstr))
+            se2_fnam = os.path.join(dnam,'{}_geocor_selected2.npy'.format(dstr))
+            tmp_fnam = os.path.join(dnam,'{}_geocor_temp.dat'.format(dstr))
+            dat_part = self.get_part_fnam(dat_fnam) # renamed to dat_fnam when the correction is finished
+            ds = gdal.Open(fnam)
+            trg_trans = ds.GetGeoTransform()
+            ds = None
+            trg_xstp = trg_trans[1]
+            trg_pixel_size = abs(trg_xstp)
+            size = np.int64(self.values['part_size']/trg_pixel_size+0.5)
+            step = np.int64(self.values['gcp_interval']/trg_pixel_size+0.5)
+            shift = np.int64(self.values['max_shift']/trg_pixel_size+0.5)
+            margin = np.int64(self.values['margin']/trg_pixel_size+0.5)
+            command = self.python_path
+            command += ' "{}"'.format(os.path.join(self.scr_dir,'find_gcps_cc.py'))
+            command += ' "{}"'.format(fnam)
+            command += ' "{}"'.format(self.values['ref_fnam'])
+            command += ' --out_fnam "{}"'.format(gcp_fnam)
+            if self.cache_dir is not None: # shared by the jobs
+                command += ' --ref_cache_dir "{}"'.format(os.path.join(self.cache_dir,'ref_cache'))
+            else:
+                command += ' --ref_cache_dir "{}"'.format(os.path.join(self.s2_data,self.proc_name,'ref_cache'))
+            if self.values['ref_pixel'] > 0.0: # block average the reference (e.g. to the Sentinel-2 pixel size)
+                command += ' --ref_pixel {}'.format(self.values['ref_pixel'])
+            command += ' --x0 {:.4f}'.format(self.values['init_shifts'][0])
+            command += ' --y0 {:.4f}'.format(self.values['init_shifts'][1])
+            command += ' --subset_width {}'.format(size)
+            command += ' --subset_height {}'.format(size)
+            command += ' --trg_indx_step {}'.format(step)
+            command += ' --trg_indy_step {}'.format(step)
+            command += ' --shift_width {}'.format(shift)
+            command += ' --shift_height {}'.format(shift)
+            command += ' --margin_width {}'.format(margin)
+            command += ' --margin_height {}'.format(margin)
+            command += ' --scan_indx_step {}'.format(self.values['scan_step'])
+            command += ' --scan_indy_step {}'.format(self.values['scan_step'])
+            n_workers = self.pipeline_nproc*self.values['n_proc'] # workers of the pipeline and of this process
+            command += ' --nproc {}'.format(max(1,(os.cpu_count() or 1)//n_workers)) # cores left by the other workers
+            if len(prior_fnams) > 0:
+                for prior_fnam in prior_fnams:
+                    command += ' --prior_fnam "{}"'.format(prior_fnam)
+                command += ' --prior_shift {}'.format(max(1,int(np.ceil(self.values['prior_shift']/trg_pixel_size))))
+            if self.values['ref_bands'][0] < 0: # panchromatic
+                command += ' --ref_band -1'
+            elif self.values['ref_bands'][1] < 0: # single band
+                command += ' --ref_band {}'.format(self.values['ref_bands'][0])
+            elif self.values['ref_bands'][2] < 0: # dual band
+                command += ' --ref_multi_band {}'.format(self.values['ref_bands'][0])
+                command += ' --ref_multi_band {}'.format(self.values['ref_bands'][1])
+                command += ' --ref_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['ref_factors'][0]) else self.values['ref_factors'][0])
+                command += ' --ref_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['ref_factors'][1]) else self.values['ref_factors'][1])
+            else: # triple band
+                command += ' --ref_multi_band {}'.format(self.values['ref_bands'][0])
+                command += ' --ref_multi_band {}'.format(self.values['ref_bands'][1])
+                command += ' --ref_multi_band {}'.format(self.values['ref_bands'][2])
+                command += ' --ref_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['ref_factors'][0]) else self.values['ref_factors'][0])
+                command += ' --ref_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['ref_factors'][1]) else self.values['ref_factors'][1])
+                command += ' --ref_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['ref_factors'][2]) else self.values['ref_factors'][2])
+            trg_bands = []
+            for band in self.values['trg_bands']:
+                band_name = band.strip()
+                if len(band_name) < 1:
+                    band_name = '-1'
+                elif band_name in S2_BAND:
+                    band_name = S2_BAND[band_name]
+                trg_bands.append(band_name)
+            if trg_bands[0][0] == '-': # panchromatic
+                command += ' --trg_band -1'
+            elif trg_bands[1][0] == '-': # single band
+                command += ' --trg_band_name "{}"'.format(trg_bands[0])
+            elif trg_bands[2][0] == '-': # dual band
+                command += ' --trg_multi_band_name "{}"'.format(trg_bands[0])
+                command += ' --trg_multi_band_name "{}"'.format(trg_bands[1])
+                command += ' --trg_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['trg_factors'][0]) else self.values['trg_factors'][0])
+                command += ' --trg_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['trg_factors'][1]) else self.values['trg_factors'][1])
+            else: # triple band
+                command += ' --trg_multi_band_name "{}"'.format(trg_bands[0])
+                command += ' --trg_multi_band_name "{}"'.format(trg_bands[1])
+                command += ' --trg_multi_band_name "{}"'.format(trg_bands[2])
+                command += ' --trg_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['trg_factors'][0]) else self.values['trg_factors'][0])
+                command += ' --trg_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['trg_factors'][1]) else self.values['trg_factors'][1])
+                command += ' --trg_multi_ratio="{}"'.format(1.0 if np.isnan(self.values['trg_factors'][2]) else self.values['trg_factors'][2])
+            if not np.isnan(self.values['ref_range'][0]):
+                command += ' --ref_data_min="{}"'.format(self.values['ref_range'][0])
+            if not np.isnan(self.values['ref_range'][1]):
+                command += ' --ref_data_max="{}"'.format(self.values['ref_range'][1])
+            if not np.isnan(self.values['trg_range'][0]):
+                command += ' --trg_data_min="{}"'.format(self.values['trg_range'][0])
+            if not np.isnan(self.values['trg_range'][1]):
+                command += ' --trg_data_max="{}"'.format(self.values['trg_range'][1])
+            # Skip cloudy or featureless subsets
+            if self.values['trg_flag_max'] > 0.0:
+                command += ' --flag_max {}'.format(self.values['trg_flag_max'])
+                band = self.get_flag_band()
+                if band is not None:
+                    command += ' --trg_flag_band_name "{}"'.format(band)
+                    for value in SCL_FLAGS:
+                        command += ' --trg_flag_value {}'.format(value)
+            if self.values['trg_std_min'] > 0.0:
+                command += ' --trg_std_min {}'.format(self.values['trg_std_min'])
+            if self.values['gcp_nstop'] > 0: # adaptive sampling
+                command += ' --gcp_nstop {}'.format(self.values['gcp_nstop'])
+            command += ' --rthr {}'.format(self.values['cmin'])
+            command += ' --feps 0.01'
+            command += ' --exp'
+            command += ' --out_empty'
+            try:
+                self.run_command(command,message='<<< Find GCPs for {} >>>'.format(dstr),dstr=dstr)
+            except Exception:
+                return
+            if not os.path.exists(gcp_fnam):
+                self.print_message('No GCPs found.',print_time=False)
+                return
+            try:
+                gcps = read_gcps(gcp_fnam)
+                write_gcps(dat_part,gcps,exp=True)
+                os.remove(gcp_fnam)
+                if gcps.size < 1:
+                    self.print_message('No GCPs found.',print_time=False)
+                    return
+                if gcps.size < 2:
+                    self.print_message('Not enough GCPs were found >>> {}'.format(gcps.size),print_time=False)
+                    return
+                x = gcps['xd']
+                y = gcps['yd']
+                r = gcps['r']
+                r90 = gcps['r90']
                 indx0 = np.arange(r.size)[(r90<self.values['rmax'])]
                 x_diff1,y_diff1,e1,n1,indx1 = calc_mean(x,y,emax=self.values['emaxs'][0],selected=indx0)
                 x_diff2,y_diff2,e2,n2,indx2 = calc_mean(x,y,emax=self.values['emaxs'][1],selected=indx1)
                 x_diff3,y_diff3,e3,n3,indx3 = calc_mean(x,y,emax=self.values['emaxs'][2],selected=indx2)
                 if indx3.size < self.values['nmin']:
                     self.print_message('Not enough GCPs were found >>> {}'.format(indx3.size),print_time=False)
-                    continue
-                with open(dat_fnam,'r') as fp:
-                    lines = fp.readlines()
-                with open(se1_fnam,'w') as fp:
-                    for i,line in enumerate(lines):
-                        if i in indx3:
-                            fp.write(line)
+                    return
+                write_gcps(se1_fnam,gcps[np.sort(indx3)])
                 command = self.python_path
                 command += ' "{}"'.format(os.path.join(self.scr_dir,'select_gcps.py'))
                 command += ' --inp_fnam "{}"'.format(se1_fnam)
@@ -387,17 +610,24 @@ class Geocor(Satellite_Process):
                 command += ' --replace'
                 command += ' --exp'
                 try:
-                    self.run_command(command,message='<<< Select GCPs for {} >>>'.format(dstr))
+                    self.run_command(command,message='<<< Select GCPs for {} >>>'.format(dstr),dstr=dstr)
                 except Exception:
-                    continue
+                    return
                 command = self.python_path
                 command += ' "{}"'.format(os.path.join(self.scr_dir,'auto_geocor_cc.py'))
                 command += ' "{}"'.format(fnam)
                 command += ' "{}"'.format(self.values['ref_fnam'])
-                command += ' --out_fnam "{}"'.format(tmp_gnam)
+                command += ' --out_fnam "{}"'.format(self.get_part_fnam(gnam))
                 command += ' --scrdir "{}"'.format(self.scr_dir)
                 command += ' --use_gcps "{}"'.format(se2_fnam) # use
+                # Warp into the resample grid directly (trg_resample is given for pixel centers)
                 command += ' --tr {}'.format(self.values['trg_pixel'])
+                command += ' --te {} {} {} {}'.format(self.values['trg_resample'][0]-0.5*self.values['trg_pixel'],
+                                                      self.values['trg_resample'][2]-0.5*self.values['trg_pixel'],
+                                                      self.values['trg_resample'][1]+0.5*self.values['trg_pixel'],
+                                                      self.values['trg_resample'][3]+0.5*self.values['trg_pixel'])
+                command += ' --ot Float32'
+                command += ' --dstnodata nan'
                 if self.values['geocor_order'] != 'Auto':
                     command += ' --npoly {}'.format(orders[self.values['geocor_order']])
                 trg_flags = [band.strip() for band in self.values['trg_flags']]
@@ -407,21 +637,11 @@ class Geocor(Satellite_Process):
                 command += ' --minimum_number {}'.format(self.values['nmin'])
                 command += ' --optfile "{}"'.format(tmp_fnam)
                 try:
-                    self.run_command(command,message='<<< Geometric Correction for {} >>>'.format(dstr))
+                    self.run_command(command,message='<<< Geometric Correction for {} >>>'.format(dstr),dstr=dstr)
                 except Exception:
-                    continue
-                if os.path.exists(tmp_gnam):
-                    # Resample
-                    command = self.python_path
-                    command += ' "{}"'.format(os.path.join(self.scr_dir,'sentinel_resample.py'))
-                    command += ' --inp_fnam "{}"'.format(tmp_gnam)
-                    command += ' --out_fnam "{}"'.format(gnam)
-                    command += ' --xmin {}'.format(self.values['trg_resample'][0])
-                    command += ' --xmax {}'.format(self.values['trg_resample'][1])
-                    command += ' --ymin {}'.format(self.values['trg_resample'][2])
-                    command += ' --ymax {}'.format(self.values['trg_resample'][3])
-                    command += ' --read_comments'
-                    self.run_command(command,message='<<< Resampling for {} >>>'.format(dstr))
+                    return
+                if os.path.exists(self.get_part_fnam(gnam)):
+                    self.commit_part(gnam)
                     # Draw figure
                     if os.path.exists(gnam):
                         command = self.python_path
@@ -430,12 +650,16 @@ class Geocor(Satellite_Process):
                         command += ' --fignam "{}"'.format(os.path.join(dnam,'{}_geocor.pdf'.format(dstr)))
                         command += ' --ax1_title "{}"'.format(dstr)
                         command += ' --batch'
-                        self.run_command(command,message='<<< Draw figure for {} >>>'.format(dstr))
-            #if os.path.exists(se2_fnam):
-            #    os.rename(se2_fnam,dat_fnam)
-            if os.path.exists(tmp_gnam):
-                os.remove(tmp_gnam)
-
-        # Finish process
-        super().finish()
+                        self.run_command(command,message='<<< Draw figure for {} >>>'.format(dstr),dstr=dstr)
+            except BaseException: # incomplete, try again next time
+                self.remove_part(dat_fnam)
+                raise
+            finally:
+                if self.commit_part(dat_fnam):
+                    self.write_manifest(dat_fnam,inputs,params)
+                    self.add_journal(dstr,dat_fnam)
+        #if os.path.exists(se2_fnam):
+        #    os.rename(se2_fnam,dat_fnam)
+        if os.path.exists(tmp_gnam):
+            os.remove(tmp_gnam)
         return
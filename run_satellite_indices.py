@@ -4,6 +4,7 @@ import re
 from datetime import datetime
 import numpy as np
 from proc_satellite_class import Satellite_Process
+from proc_catalog import list_dir
 
 class Indices(Satellite_Process):
 
@@ -25,6 +26,18 @@ class Indices(Satellite_Process):
         # Start process
         super().run()
 
+        # Check Geocor
+        geocor_dstrs = self.list_dates()
+
+        # Calculate indices
+        for dstr in geocor_dstrs:
+            self.run_date(dstr)
+
+        # Finish process
+        super().finish()
+        return
+
+    def list_dates(self):
         # Check files/folders
         start_dtim = datetime.strptime(self.start_date,self.date_fmt)
         end_dtim = datetime.strptime(self.end_date,self.date_fmt)
@@ -44,7 +57,7 @@ class Indices(Satellite_Process):
             dnam = os.path.join(self.values['geocor_dir'],ystr)
             if not os.path.isdir(dnam):
                 continue
-            for f in sorted(os.listdir(dnam)):
+            for f in list_dir(dnam):
                 m = re.search('^('+'\d'*8+')_geocor\.tif$',f)
                 if not m:
                     continue
@@ -60,72 +73,77 @@ class Indices(Satellite_Process):
         geocor_dstrs = [geocor_dstrs[i] for i in inds]
         if len(geocor_fnams) < 1:
             self.print_message('No geocor data for process.',print_time=False)
+        return geocor_dstrs
 
-        # Calculate indices
-        for fnam,dstr in zip(geocor_fnams,geocor_dstrs):
-            d = datetime.strptime(dstr,'%Y%m%d')
-            ystr = '{}'.format(d.year)
-            dnam = os.path.join(self.s2_data,'indices',ystr)
-            gnam = os.path.join(dnam,'{}_indices.tif'.format(dstr))
-            if os.path.exists(gnam) and self.values['oflag']:
-                os.remove(gnam)
-            if not os.path.exists(gnam):
-                if not os.path.exists(dnam):
-                    os.makedirs(dnam)
-                if not os.path.isdir(dnam):
-                    raise IOError('Error, no such folder >>> {}'.format(dnam))
-                command = self.python_path
-                command += ' "{}"'.format(os.path.join(self.scr_dir,'sentinel2_calc_indices.py'))
-                command += ' --src_geotiff "{}"'.format(fnam)
-                command += ' --dst_geotiff "{}"'.format(gnam)
-                command += ' --fignam "{}"'.format(os.path.join(dnam,'{}_indices.pdf'.format(dstr)))
-                for param,flag in zip(self.list_labels['out_refs'],self.values['out_refs']):
-                    if flag:
-                        command += ' --param S{}'.format(param.strip())
-                for param,flag in zip(self.list_labels['out_nrefs'],self.values['out_nrefs']):
-                    if flag:
-                        command += ' --param {}'.format(param.strip())
-                for param,flag in zip(self.list_labels['out_inds'],self.values['out_inds']):
-                    if flag:
-                        command += ' --param {}'.format(param.strip())
-                for band,flag in zip(self.list_labels['norm_bands'],self.values['norm_bands']):
-                    if flag:
-                        command += ' --norm_band {}'.format(band.strip())
-                command += ' --rgi_red_band {}'.format(self.values['rgi_red_band'])
-                for value,flag in zip(self.zmin_refs,self.values['out_refs']):
-                    if flag:
-                        command += ' --ax1_zmin="{}"'.format(value)
-                for value,flag in zip(self.zmin_nrefs,self.values['out_nrefs']):
-                    if flag:
-                        command += ' --ax1_zmin="{}"'.format(value)
-                for value,flag in zip(self.zmin_inds,self.values['out_inds']):
-                    if flag:
-                        command += ' --ax1_zmin="{}"'.format(value)
-                for value,flag in zip(self.zmax_refs,self.values['out_refs']):
-                    if flag:
-                        command += ' --ax1_zmax="{}"'.format(value)
-                for value,flag in zip(self.zmax_nrefs,self.values['out_nrefs']):
-                    if flag:
-                        command += ' --ax1_zmax="{}"'.format(value)
-                for value,flag in zip(self.zmax_inds,self.values['out_inds']):
-                    if flag:
-                        command += ' --ax1_zmax="{}"'.format(value)
-                for value,flag in zip(self.zstp_refs,self.values['out_refs']):
-                    if flag:
-                        command += ' --ax1_zstp="{}"'.format(value)
-                for value,flag in zip(self.zstp_nrefs,self.values['out_nrefs']):
-                    if flag:
-                        command += ' --ax1_zstp="{}"'.format(value)
-                for value,flag in zip(self.zstp_inds,self.values['out_inds']):
-                    if flag:
-                        command += ' --ax1_zstp="{}"'.format(value)
-                command += ' --ax1_title "{}"'.format(dstr)
-                #command += ' --fig_dpi {}'.format(self.fig_dpi)
-                command += ' --remove_nan'
-                command += ' --debug'
-                command += ' --batch'
-                self.run_command(command,message='<<< Calculate indices for {} >>>'.format(dstr))
-
-        # Finish process
-        super().finish()
+    def run_date(self,dstr):
+        d = datetime.strptime(dstr,'%Y%m%d')
+        ystr = '{}'.format(d.year)
+        fnam = os.path.join(self.values['geocor_dir'],ystr,'{}_geocor.tif'.format(dstr))
+        if not os.path.exists(fnam):
+            return
+        dnam = os.path.join(self.s2_data,'indices',ystr)
+        gnam = os.path.join(dnam,'{}_indices.tif'.format(dstr))
+        self.remove_part(gnam)
+        params = {pnam:self.values[pnam] for pnam in self.pnams if not pnam in ['geocor_dir','oflag']}
+        # Units completed before interruption are not overwritten again, but still checked by the manifest
+        if os.path.exists(gnam) and ((self.values['oflag'] and not self.check_journal(dstr,gnam)) or not self.check_manifest(gnam,[fnam],params)):
+            os.remove(gnam)
+        if not os.path.exists(gnam):
+            os.makedirs(dnam,exist_ok=True) # may be created by another worker
+            if not os.path.isdir(dnam):
+                raise IOError('Error, no such folder >>> {}'.format(dnam))
+            command = self.python_path
+            command += ' "{}"'.format(os.path.join(self.scr_dir,'sentinel2_calc_indices.py'))
+            command += ' --src_geotiff "{}"'.format(fnam)
+            command += ' --dst_geotiff "{}"'.format(self.get_part_fnam(gnam))
+            command += ' --fignam "{}"'.format(os.path.join(dnam,'{}_indices.pdf'.format(dstr)))
+            for param,flag in zip(self.list_labels['out_refs'],self.values['out_refs']):
+                if flag:
+                    command += ' --param S{}'.format(param.strip())
+            for param,flag in zip(self.list_labels['out_nrefs'],self.values['out_nrefs']):
+                if flag:
+                    command += ' --param {}'.format(param.strip())
+            for param,flag in zip(self.list_labels['out_inds'],self.values['out_inds']):
+                if flag:
+                    command += ' --param {}'.format(param.strip())
+            for band,flag in zip(self.list_labels['norm_bands'],self.values['norm_bands']):
+                if flag:
+                    command += ' --norm_band {}'.format(band.strip())
+            command += ' --rgi_red_band {}'.format(self.values['rgi_red_band'])
+            for value,flag in zip(self.zmin_refs,self.values['out_refs']):
+                if flag:
+                    command += ' --ax1_zmin="{}"'.format(value)
+            for value,flag in zip(self.zmin_nrefs,self.values['out_nrefs']):
+                if flag:
+                    command += ' --ax1_zmin="{}"'.format(value)
+            for value,flag in zip(self.zmin_inds,self.values['out_inds']):
+                if flag:
+                    command += ' --ax1_zmin="{}"'.format(value)
+            for value,flag in zip(self.zmax_refs,self.values['out_refs']):
+                if flag:
+                    command += ' --ax1_zmax="{}"'.format(value)
+            for value,flag in zip(self.zmax_nrefs,self.values['out_nrefs']):
+                if flag:
+                    command += ' --ax1_zmax="{}"'.format(value)
+            for value,flag in zip(self.zmax_inds,self.values['out_inds']):
+                if flag:
+                    command += ' --ax1_zmax="{}"'.format(value)
+            for value,flag in zip(self.zstp_refs,self.values['out_refs']):
+                if flag:
+                    command += ' --ax1_zstp="{}"'.format(value)
+            for value,flag in zip(self.zstp_nrefs,self.values['out_nrefs']):
+                if flag:
+                    command += ' --ax1_zstp="{}"'.format(value)
+            for value,flag in zip(self.zstp_inds,self.values['out_inds']):
+                if flag:
+                    command += ' --ax1_zstp="{}"'.format(value)
+            command += ' --ax1_title "{}"'.format(dstr)
+            #command += ' --fig_dpi {}'.format(self.fig_dpi)
+            command += ' --remove_nan'
+            command += ' --debug'
+            command += ' --batch'
+            self.run_command(command,message='<<< Calculate indices for {} >>>'.format(dstr),dstr=dstr)
+            if self.commit_part(gnam):
+                self.write_manifest(gnam,[fnam],params)
+                self.add_journal(dstr,gnam)
         return
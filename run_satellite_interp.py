@@ -33,6 +33,15 @@ class Interp(Satellite_Process):
             os.makedirs(dnam)
         if not os.path.isdir(dnam):
             raise IOError('Error, no such folder >>> {}'.format(dnam))
+        fignam = os.path.join(dnam,'{}_interp.pdf'.format(trg_bnam))
+        if self.values['atcor_flag']:
+            inputs = self.list_products(os.path.join(self.s2_data,'atcor'),'_atcor.npz',first_dtim,last_dtim)
+            pnams = ['tmgn','cflag_thr','p_smooth','atcor_flag','nmax','rthr','csv_flag','eflag']
+        else:
+            inputs = self.list_products(os.path.join(self.s2_data,'parcel'),'_parcel.npz',first_dtim,last_dtim)
+            pnams = ['tmgn','cflag_thr','p_smooth','atcor_flag','csv_flag','eflag']
+        params = {pnam:self.values[pnam] for pnam in pnams}
+        mflag = not self.check_manifest(fignam,inputs,params) # overwrite all outputs if inputs or parameters have changed
         command = self.python_path
         if self.values['atcor_flag']:
             command += ' "{}"'.format(os.path.join(self.scr_dir,'sentinel2_interp_atcor.py'))
@@ -53,18 +62,20 @@ class Interp(Satellite_Process):
         if self.values['csv_flag']:
             command += ' --out_csv'
         iflag = self.list_labels['oflag'].index('interp')
-        if self.values['oflag'][iflag]:
+        if self.values['oflag'][iflag] or mflag:
             command += ' --overwrite'
         iflag = self.list_labels['oflag'].index('tentative interp')
-        if self.values['oflag'][iflag]:
+        if self.values['oflag'][iflag] or mflag:
             command += ' --tentative_overwrite'
         if self.values['eflag']:
             command += ' --extrapolate'
-        command += ' --fignam "{}"'.format(os.path.join(dnam,'{}_interp.pdf'.format(trg_bnam)))
+        command += ' --fignam "{}"'.format(fignam)
         command += ' --nfig 10'
         command += ' --debug'
         command += ' --batch'
         self.run_command(command,message='<<< Interpolate data between {:%Y-%m-%d} - {:%Y-%m-%d} >>>'.format(first_dtim,last_dtim))
+        if os.path.exists(fignam):
+            self.write_manifest(fignam,inputs,params)
 
         # Finish process
         super().finish()
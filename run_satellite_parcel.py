@@ -1,9 +1,21 @@
 import os
 import sys
 import re
+import json
+import hashlib
+import shutil
+import tempfile
+import threading
 from datetime import datetime
+try:
+    import gdal
+except Exception:
+    from osgeo import gdal
 import numpy as np
 from proc_satellite_class import Satellite_Process
+from proc_catalog import list_dir
+
+mask_lock = threading.Lock()
 
 class Parcel(Satellite_Process):
 
@@ -19,12 +31,25 @@ class Parcel(Satellite_Process):
         self.zmax_inds = None
         self.zstp_inds = None
         self.fig_dpi = None
+        self.flag_parcel = None
         self._freeze()
 
     def run(self):
         # Start process
         super().run()
 
+        # Check Indices
+        indices_dstrs = self.list_dates()
+
+        # Parcellate data
+        for dstr in indices_dstrs:
+            self.run_date(dstr)
+
+        # Finish process
+        super().finish()
+        return
+
+    def list_dates(self):
         # Check files/folders
         start_dtim = datetime.strptime(self.start_date,self.date_fmt)
         end_dtim = datetime.strptime(self.end_date,self.date_fmt)
@@ -36,7 +61,7 @@ class Parcel(Satellite_Process):
         if not os.path.isdir(self.s2_data):
             raise ValueError('{}: error, no such folder >>> {}'.format(self.proc_name,self.s2_data))
         iflag = self.list_labels['oflag'].index('mask')
-        flag_parcel = self.values['oflag'][iflag]
+        self.flag_parcel = self.values['oflag'][iflag]
 
         # Check Indices
         indices_fnams = []
@@ -47,7 +72,7 @@ class Parcel(Satellite_Process):
             dnam = os.path.join(self.values['indices_dir'],ystr)
             if not os.path.isdir(dnam):
                 continue
-            for f in sorted(os.listdir(dnam)):
+            for f in list_dir(dnam):
                 m = re.search('^('+'\d'*8+')_indices\.tif$',f)
                 if not m:
                     continue
@@ -67,31 +92,43 @@ class Parcel(Satellite_Process):
         indices_dstrs = [indices_dstrs[i] for i in inds]
         if len(indices_fnams) < 1:
             self.print_message('No indices data for process.',print_time=False)
+        return indices_dstrs
 
-        # Parcellate data
-        for fnam,rnam,dstr in zip(indices_fnams,indices_rnams,indices_dstrs):
-            d = datetime.strptime(dstr,'%Y%m%d')
-            ystr = '{}'.format(d.year)
-            dnam = os.path.join(self.s2_data,'parcel',ystr)
-            data_npz = os.path.join(dnam,'{}_parcel.npz'.format(dstr))
-            iflag = self.list_labels['oflag'].index('parcel')
-            if os.path.exists(data_npz) and self.values['oflag'][iflag]:
+    def run_date(self,dstr):
+        d = datetime.strptime(dstr,'%Y%m%d')
+        ystr = '{}'.format(d.year)
+        fnam = os.path.join(self.values['indices_dir'],ystr,'{}_indices.tif'.format(dstr))
+        rnam = os.path.join(self.values['geocor_dir'],ystr,'{}_geocor.tif'.format(dstr))
+        if not os.path.exists(fnam) or not os.path.exists(rnam):
+            return
+        dnam = os.path.join(self.s2_data,'parcel',ystr)
+        data_npz = os.path.join(dnam,'{}_parcel.npz'.format(dstr))
+        self.remove_part(data_npz)
+        gis_fnams = self.get_gis_fnams(self.values['gis_fnam'])
+        inputs = [fnam,rnam]+gis_fnams+[self.values['mask_parcel']]
+        params = {pnam:self.values[pnam] for pnam in self.pnams if not pnam in ['geocor_dir','indices_dir','gis_fnam','mask_parcel','csv_flag','oflag']}
+        iflag = self.list_labels['oflag'].index('parcel')
+        # Units completed before interruption are not overwritten again, but still checked by the manifest
+        oflag = self.values['oflag'][iflag] and not self.check_journal(dstr,data_npz)
+        if os.path.exists(data_npz) and (oflag or not self.check_manifest(data_npz,inputs,params)):
+            os.remove(data_npz)
+        if self.values['csv_flag']:
+            data_csv = os.path.join(dnam,'{}_parcel.csv'.format(dstr))
+            self.remove_part(data_csv)
+            if os.path.exists(data_csv):
+                if oflag:
+                    os.remove(data_csv)
+            elif os.path.exists(data_npz):
                 os.remove(data_npz)
-            if self.values['csv_flag']:
-                data_csv = os.path.join(dnam,'{}_parcel.csv'.format(dstr))
-                if os.path.exists(data_csv):
-                    if self.values['oflag'][iflag]:
-                        os.remove(data_csv)
-                elif os.path.exists(data_npz):
-                    os.remove(data_npz)
-            if not os.path.exists(data_npz):
-                if not os.path.exists(dnam):
-                    os.makedirs(dnam)
-                if not os.path.isdir(dnam):
-                    raise IOError('Error, no such folder >>> {}'.format(dnam))
-                # Make mask
-                mask_parcel = self.values['mask_parcel']
-                if os.path.exists(mask_parcel) and flag_parcel:
+        if not os.path.exists(data_npz):
+            os.makedirs(dnam,exist_ok=True) # may be created by another worker
+            if not os.path.isdir(dnam):
+                raise IOError('Error, no such folder >>> {}'.format(dnam))
+            # Make mask
+            mask_parcel = self.values['mask_parcel']
+            with mask_lock: # shared by all dates
+                mask_params = {'buffer_parcel':self.values['buffer_parcel']}
+                if os.path.exists(mask_parcel) and (self.flag_parcel or not self.check_manifest(mask_parcel,gis_fnams,mask_params)):
                     os.remove(mask_parcel)
                 if not os.path.exists(mask_parcel):
                     mask_dnam = os.path.dirname(mask_parcel)
@@ -99,96 +136,127 @@ class Parcel(Satellite_Process):
                         os.makedirs(mask_dnam)
                     if not os.path.isdir(mask_dnam):
                         raise IOError('Error, no such folder >>> {}'.format(mask_dnam))
-                    command = self.python_path
-                    command += ' "{}"'.format(os.path.join(self.scr_dir,'make_mask.py'))
-                    command += ' --shp_fnam "{}"'.format(self.values['gis_fnam'])
-                    command += ' --src_geotiff "{}"'.format(fnam)
-                    command += ' --dst_geotiff "{}"'.format(mask_parcel)
-                    if abs(self.values['buffer_parcel']) < 1.0e-6:
-                        command += ' --buffer 0.0'
+                    self.remove_part(mask_parcel)
+                    shared_fnam = self.get_shared_fnam(fnam,gis_fnams,mask_params)
+                    if shared_fnam is not None and os.path.exists(shared_fnam): # made by another job
+                        shutil.copy2(shared_fnam,self.get_part_fnam(mask_parcel))
                     else:
-                        command += ' --buffer="{}"'.format(-abs(self.values['buffer_parcel']))
-                    command += ' --use_index'
-                    self.run_command(command,message='<<< Make mask >>>')
+                        command = self.python_path
+                        command += ' "{}"'.format(os.path.join(self.scr_dir,'make_mask.py'))
+                        command += ' --shp_fnam "{}"'.format(self.values['gis_fnam'])
+                        command += ' --src_geotiff "{}"'.format(fnam)
+                        command += ' --dst_geotiff "{}"'.format(self.get_part_fnam(mask_parcel))
+                        if abs(self.values['buffer_parcel']) < 1.0e-6:
+                            command += ' --buffer 0.0'
+                        else:
+                            command += ' --buffer="{}"'.format(-abs(self.values['buffer_parcel']))
+                        command += ' --use_index'
+                        self.run_command(command,message='<<< Make mask >>>')
+                        if shared_fnam is not None and os.path.exists(self.get_part_fnam(mask_parcel)):
+                            self.put_shared_fnam(self.get_part_fnam(mask_parcel),shared_fnam)
+                    if self.commit_part(mask_parcel):
+                        self.write_manifest(mask_parcel,gis_fnams,mask_params)
                 if not os.path.exists(mask_parcel):
                     raise ValueError('Error, no such file >>> {}'.format(mask_parcel))
                 else:
-                    flag_parcel = False
-                # Parcellate
-                command = self.python_path
-                command += ' "{}"'.format(os.path.join(self.scr_dir,'sentinel2_parcellate.py'))
-                command += ' --src_geotiff "{}"'.format(fnam)
-                command += ' --res_geotiff "{}"'.format(rnam)
-                command += ' --mask_geotiff "{}"'.format(mask_parcel)
-                command += ' --shp_fnam "{}"'.format(self.values['gis_fnam'])
-                command += ' --out_fnam "{}"'.format(data_npz)
-                command += ' --out_shp "{}"'.format(os.path.join(dnam,'{}_parcel.shp'.format(dstr)))
-                if self.values['csv_flag']:
-                    command += ' --out_csv "{}"'.format(data_csv)
-                for param,flag in zip(self.list_labels['out_refs'],self.values['out_refs']):
-                    if flag:
-                        command += ' --param S{}'.format(param.strip())
-                for param,flag in zip(self.list_labels['out_nrefs'],self.values['out_nrefs']):
-                    if flag:
-                        command += ' --param {}'.format(param.strip())
-                for param,flag in zip(self.list_labels['out_inds'],self.values['out_inds']):
-                    if flag:
-                        command += ' --param {}'.format(param.strip())
-                for param,flag,value in zip(self.list_labels['out_refs'],self.values['out_refs'],self.values['cr_sc_refs']):
-                    if flag:
-                        command += ' --cflag_sc "S{}:{}"'.format(param.strip(),value)
-                for param,flag,value in zip(self.list_labels['out_nrefs'],self.values['out_nrefs'],self.values['cr_sc_nrefs']):
-                    if flag:
-                        command += ' --cflag_sc "{}:{}"'.format(param.strip(),value)
-                for param,flag,value in zip(self.list_labels['out_inds'],self.values['out_inds'],self.values['cr_sc_inds']):
-                    if flag:
-                        command += ' --cflag_sc "{}:{}"'.format(param.strip(),value)
-                for param,flag,value in zip(self.list_labels['out_refs'],self.values['out_refs'],self.values['cr_ref_refs']):
-                    if flag:
-                        command += ' --cflag_ref "S{}:{}"'.format(param.strip(),value)
-                for param,flag,value in zip(self.list_labels['out_nrefs'],self.values['out_nrefs'],self.values['cr_ref_nrefs']):
-                    if flag:
-                        command += ' --cflag_ref "{}:{}"'.format(param.strip(),value)
-                for param,flag,value in zip(self.list_labels['out_inds'],self.values['out_inds'],self.values['cr_ref_inds']):
-                    if flag:
-                        command += ' --cflag_ref "{}:{}"'.format(param.strip(),value)
-                command += ' --cloud_band {}'.format(self.values['cloud_band'])
-                command += ' --cloud_thr {}'.format(self.values['cloud_thr'])
-                command += ' --fignam "{}"'.format(os.path.join(dnam,'{}_parcel.pdf'.format(dstr)))
-                for value,flag in zip(self.zmin_refs,self.values['out_refs']):
-                    if flag:
-                        command += ' --ax1_zmin="{}"'.format(value)
-                for value,flag in zip(self.zmin_nrefs,self.values['out_nrefs']):
-                    if flag:
-                        command += ' --ax1_zmin="{}"'.format(value)
-                for value,flag in zip(self.zmin_inds,self.values['out_inds']):
-                    if flag:
-                        command += ' --ax1_zmin="{}"'.format(value)
-                for value,flag in zip(self.zmax_refs,self.values['out_refs']):
-                    if flag:
-                        command += ' --ax1_zmax="{}"'.format(value)
-                for value,flag in zip(self.zmax_nrefs,self.values['out_nrefs']):
-                    if flag:
-                        command += ' --ax1_zmax="{}"'.format(value)
-                for value,flag in zip(self.zmax_inds,self.values['out_inds']):
-                    if flag:
-                        command += ' --ax1_zmax="{}"'.format(value)
-                for value,flag in zip(self.zstp_refs,self.values['out_refs']):
-                    if flag:
-                        command += ' --ax1_zstp="{}"'.format(value)
-                for value,flag in zip(self.zstp_nrefs,self.values['out_nrefs']):
-                    if flag:
-                        command += ' --ax1_zstp="{}"'.format(value)
-                for value,flag in zip(self.zstp_inds,self.values['out_inds']):
-                    if flag:
-                        command += ' --ax1_zstp="{}"'.format(value)
-                command += ' --ax1_title "{}"'.format(dstr)
-                command += ' --use_index'
-                command += ' --remove_nan'
-                command += ' --debug'
-                command += ' --batch'
-                self.run_command(command,message='<<< Parcellate data for {} >>>'.format(dstr))
+                    self.flag_parcel = False
+            # Parcellate
+            command = self.python_path
+            command += ' "{}"'.format(os.path.join(self.scr_dir,'sentinel2_parcellate.py'))
+            command += ' --src_geotiff "{}"'.format(fnam)
+            command += ' --res_geotiff "{}"'.format(rnam)
+            command += ' --mask_geotiff "{}"'.format(mask_parcel)
+            command += ' --shp_fnam "{}"'.format(self.values['gis_fnam'])
+            command += ' --out_fnam "{}"'.format(self.get_part_fnam(data_npz))
+            command += ' --out_shp "{}"'.format(os.path.join(dnam,'{}_parcel.shp'.format(dstr)))
+            if self.values['csv_flag']:
+                command += ' --out_csv "{}"'.format(self.get_part_fnam(data_csv))
+            for param,flag in zip(self.list_labels['out_refs'],self.values['out_refs']):
+                if flag:
+                    command += ' --param S{}'.format(param.strip())
+            for param,flag in zip(self.list_labels['out_nrefs'],self.values['out_nrefs']):
+                if flag:
+                    command += ' --param {}'.format(param.strip())
+            for param,flag in zip(self.list_labels['out_inds'],self.values['out_inds']):
+                if flag:
+                    command += ' --param {}'.format(param.strip())
+            for param,flag,value in zip(self.list_labels['out_refs'],self.values['out_refs'],self.values['cr_sc_refs']):
+                if flag:
+                    command += ' --cflag_sc "S{}:{}"'.format(param.strip(),value)
+            for param,flag,value in zip(self.list_labels['out_nrefs'],self.values['out_nrefs'],self.values['cr_sc_nrefs']):
+                if flag:
+                    command += ' --cflag_sc "{}:{}"'.format(param.strip(),value)
+            for param,flag,value in zip(self.list_labels['out_inds'],self.values['out_inds'],self.values['cr_sc_inds']):
+                if flag:
+                    command += ' --cflag_sc "{}:{}"'.format(param.strip(),value)
+            for param,flag,value in zip(self.list_labels['out_refs'],self.values['out_refs'],self.values['cr_ref_refs']):
+                if flag:
+                    command += ' --cflag_ref "S{}:{}"'.format(param.strip(),value)
+            for param,flag,value in zip(self.list_labels['out_nrefs'],self.values['out_nrefs'],self.values['cr_ref_nrefs']):
+                if flag:
+                    command += ' --cflag_ref "{}:{}"'.format(param.strip(),value)
+            for param,flag,value in zip(self.list_labels['out_inds'],self.values['out_inds'],self.values['cr_ref_inds']):
+                if flag:
+                    command += ' --cflag_ref "{}:{}"'.format(param.strip(),value)
+            command += ' --cloud_band {}'.format(self.values['cloud_band'])
+            command += ' --cloud_thr {}'.format(self.values['cloud_thr'])
+            command += ' --fignam "{}"'.format(os.path.join(dnam,'{}_parcel.pdf'.format(dstr)))
+            for value,flag in zip(self.zmin_refs,self.values['out_refs']):
+                if flag:
+                    command += ' --ax1_zmin="{}"'.format(value)
+            for value,flag in zip(self.zmin_nrefs,self.values['out_nrefs']):
+                if flag:
+                    command += ' --ax1_zmin="{}"'.format(value)
+            for value,flag in zip(self.zmin_inds,self.values['out_inds']):
+                if flag:
+                    command += ' --ax1_zmin="{}"'.format(value)
+            for value,flag in zip(self.zmax_refs,self.values['out_refs']):
+                if flag:
+                    command += ' --ax1_zmax="{}"'.format(value)
+            for value,flag in zip(self.zmax_nrefs,self.values['out_nrefs']):
+                if flag:
+                    command += ' --ax1_zmax="{}"'.format(value)
+            for value,flag in zip(self.zmax_inds,self.values['out_inds']):
+                if flag:
+                    command += ' --ax1_zmax="{}"'.format(value)
+            for value,flag in zip(self.zstp_refs,self.values['out_refs']):
+                if flag:
+                    command += ' --ax1_zstp="{}"'.format(value)
+            for value,flag in zip(self.zstp_nrefs,self.values['out_nrefs']):
+                if flag:
+                    command += ' --ax1_zstp="{}"'.format(value)
+            for value,flag in zip(self.zstp_inds,self.values['out_inds']):
+                if flag:
+                    command += ' --ax1_zstp="{}"'.format(value)
+            command += ' --ax1_title "{}"'.format(dstr)
+            command += ' --use_index'
+            command += ' --remove_nan'
+            command += ' --debug'
+            command += ' --batch'
+            self.run_command(command,message='<<< Parcellate data for {} >>>'.format(dstr),dstr=dstr)
+            if self.values['csv_flag']:
+                self.commit_part(data_csv)
+            if self.commit_part(data_npz):
+                self.write_manifest(data_npz,inputs,params)
+                self.add_journal(dstr,data_npz)
+        return
 
-        # Finish process
-        super().finish()
+    def get_shared_fnam(self,src_fnam,inputs,params):
+        # Mask in the cache shared by the jobs, keyed by the inputs, parameters and grid of src_fnam
+        if self.cache_dir is None:
+            return None
+        ds = gdal.Open(src_fnam)
+        grid = [ds.RasterXSize,ds.RasterYSize,list(ds.GetGeoTransform()),ds.GetProjection()]
+        ds = None
+        key = hashlib.md5(json.dumps([[self.file_hash(f) for f in inputs if os.path.exists(f)],params,grid],sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.cache_dir,'mask','mask_{}.tif'.format(key))
+
+    def put_shared_fnam(self,fnam,shared_fnam):
+        # Write through a temporary file, as other processes may read or write the same cache
+        dnam = os.path.dirname(shared_fnam)
+        os.makedirs(dnam,exist_ok=True)
+        fd,tmp_fnam = tempfile.mkstemp(suffix='.part',dir=dnam)
+        os.close(fd)
+        shutil.copy2(fnam,tmp_fnam)
+        os.replace(tmp_fnam,shared_fnam)
         return
@@ -6,6 +6,7 @@ from datetime import datetime,timedelta
 import numpy as np
 from subprocess import call
 from proc_satellite_class import Satellite_Process
+from proc_catalog import list_dir
 
 class Phenology(Satellite_Process):
 
@@ -35,6 +36,12 @@ class Phenology(Satellite_Process):
         iflag = self.list_labels['oflag'].index('mask')
         flag_paddy = self.values['oflag'][iflag]
         flag_parcel = self.values['oflag'][iflag]
+        gis_fnams = self.get_gis_fnams(self.values['gis_fnam'])
+        paddy_params = {'buffer_paddy':self.values['buffer_paddy']}
+        parcel_params = {'buffer_parcel':self.values['buffer_parcel']} # same as parcel and atcor
+        # S1 data folders are not listed, they are tracked by the parameters only
+        planting_params = {pnam:self.values[pnam] for pnam in ['buffer_paddy','buffer_parcel','trans_source','trans_select','trans_indicator',
+                           'trans_pref','trans_thr1','trans_thr2','trans_thr3','trans_thr4','trans_thr5']}
         list_labels = [s[0].split()[0] for s in self.list_labels['trans_source']]
         product = self.values['trans_source'][list_labels.index('Product')]
         version = self.values['trans_source'][list_labels.index('Version')]
@@ -50,7 +57,7 @@ class Phenology(Satellite_Process):
                 planting_csv = os.path.join(dnam,'{}_planting.csv'.format(trg_bnam))
                 planting_shp = os.path.join(dnam,'{}_planting.shp'.format(trg_bnam))
                 planting_pdf = os.path.join(dnam,'{}_planting.pdf'.format(trg_bnam))
-                if self.values['oflag'][iflag]:
+                if self.values['oflag'][iflag] or not self.check_manifest(planting_csv,[],planting_params):
                     if os.path.exists(planting_csv):
                         os.remove(planting_csv)
                     if os.path.exists(planting_shp):
@@ -88,13 +95,15 @@ class Phenology(Satellite_Process):
                     command += ' --debug'
                     command += ' --batch'
                     self.run_command(command,message='<<< Select planting >>>')
+                    if os.path.exists(planting_csv):
+                        self.write_manifest(planting_csv,[],planting_params)
                 else:
                     self.print_message('File exists >>> {}'.format(planting_csv),print_time=False)
             else:
                 # Select reference for planting
                 planting_ref = os.path.join(dnam,'{}_planting_ref.shp'.format(trg_bnam))
                 iflag = self.list_labels['oflag'].index('plant')
-                if self.values['oflag'][iflag]:
+                if self.values['oflag'][iflag] or not self.check_manifest(planting_ref,[mask_paddy],planting_params):
                     if os.path.exists(planting_ref):
                         os.remove(planting_ref)
                 if not os.path.exists(planting_ref):
@@ -119,6 +128,8 @@ class Phenology(Satellite_Process):
                     if product == 'preliminary':
                         command += ' --early'
                     self.run_command(command,message='<<< Select reference for planting >>>')
+                    if os.path.exists(planting_ref):
+                        self.write_manifest(planting_ref,[mask_paddy],planting_params)
                 else:
                     self.print_message('File exists >>> {}'.format(planting_ref),print_time=False)
 
@@ -126,7 +137,7 @@ class Phenology(Satellite_Process):
                 planting_csv = os.path.join(dnam,'{}_planting.csv'.format(trg_bnam))
                 planting_shp = os.path.join(dnam,'{}_planting.shp'.format(trg_bnam))
                 planting_pdf = os.path.join(dnam,'{}_planting.pdf'.format(trg_bnam))
-                if self.values['oflag'][iflag]:
+                if self.values['oflag'][iflag] or not self.check_manifest(planting_csv,[planting_ref],planting_params):
                     if os.path.exists(planting_csv):
                         os.remove(planting_csv)
                     if os.path.exists(planting_shp):
@@ -159,6 +170,8 @@ class Phenology(Satellite_Process):
                     command += ' --debug'
                     command += ' --batch'
                     self.run_command(command,message='<<< Select planting >>>')
+                    if os.path.exists(planting_csv):
+                        self.write_manifest(planting_csv,[planting_ref],planting_params)
                 else:
                     self.print_message('File exists >>> {}'.format(planting_csv),print_time=False)
         else: # Cihea
@@ -166,7 +179,7 @@ class Phenology(Satellite_Process):
             if 'indicator' in self.values['trans_select'].lower():
                 # Select planting
                 planting_sel = os.path.join(dnam,'{}_planting.tif'.format(trg_bnam))
-                if self.values['oflag'][iflag]:
+                if self.values['oflag'][iflag] or not self.check_manifest(planting_sel,[mask_paddy],planting_params):
                     if os.path.exists(planting_sel):
                         os.remove(planting_sel)
                 if not os.path.exists(planting_sel):
@@ -175,7 +188,7 @@ class Phenology(Satellite_Process):
                     if not os.path.isdir(dnam):
                         raise IOError('Error, no such folder >>> {}'.format(dnam))
                     # Make paddy mask
-                    if os.path.exists(mask_paddy) and flag_paddy:
+                    if os.path.exists(mask_paddy) and (flag_paddy or not self.check_manifest(mask_paddy,gis_fnams,paddy_params)):
                         os.remove(mask_paddy)
                     if not os.path.exists(mask_paddy):
                         mask_dnam = os.path.dirname(mask_paddy)
@@ -183,8 +196,9 @@ class Phenology(Satellite_Process):
                             os.makedirs(mask_dnam)
                         if not os.path.isdir(mask_dnam):
                             raise IOError('Error, no such folder >>> {}'.format(mask_dnam))
-                        if os.path.exists(mask_parcel) and not flag_parcel and (self.values['buffer_paddy'] == self.values['buffer_parcel']):
+                        if os.path.exists(mask_parcel) and not flag_parcel and (self.values['buffer_paddy'] == self.values['buffer_parcel']) and self.check_manifest(mask_parcel,gis_fnams,parcel_params):
                             shutil.copy2(mask_parcel,mask_paddy)
+                            self.write_manifest(mask_paddy,gis_fnams,paddy_params)
                         else:
                             src_fnam = None
                             years = np.arange(start_dtim.year,end_dtim.year+2,1)
@@ -193,14 +207,14 @@ class Phenology(Satellite_Process):
                                 ynam = os.path.join(s1_data,ystr)
                                 if not os.path.isdir(ynam):
                                     continue
-                                for d in sorted(os.listdir(ynam)):
+                                for d in list_dir(ynam):
                                     temp_dnam = os.path.join(ynam,d)
                                     if not os.path.isdir(temp_dnam):
                                         continue
                                     m = re.search('^('+'\d'*8+')$',d)
                                     if not m:
                                         continue
-                                    for f in sorted(os.listdir(temp_dnam)):
+                                    for f in list_dir(temp_dnam):
                                         if not re.search('_{}.tif'.format(product),f):
                                             continue
                                         bnam = os.path.basename(f)
@@ -232,6 +246,8 @@ class Phenology(Satellite_Process):
                                 command += ' --buffer="{}"'.format(-abs(self.values['buffer_paddy']))
                             command += ' --use_index'
                             self.run_command(command,message='<<< Make paddy mask >>>')
+                            if os.path.exists(mask_paddy):
+                                self.write_manifest(mask_paddy,gis_fnams,paddy_params)
                     if not os.path.exists(mask_paddy):
                         raise ValueError('Error, no such file >>> {}'.format(mask_paddy))
                     else:
@@ -266,13 +282,15 @@ class Phenology(Satellite_Process):
                     if product == 'preliminary':
                         command += ' --early'
                     self.run_command(command,message='<<< Select planting >>>')
+                    if os.path.exists(planting_sel):
+                        self.write_manifest(planting_sel,[mask_paddy],planting_params)
                 else:
                     self.print_message('File exists >>> {}'.format(planting_sel),print_time=False)
             else:
                 # Select reference for planting
                 planting_ref = os.path.join(dnam,'{}_planting_ref.tif'.format(trg_bnam))
                 iflag = self.list_labels['oflag'].index('plant')
-                if self.values['oflag'][iflag]:
+                if self.values['oflag'][iflag] or not self.check_manifest(planting_ref,[mask_paddy],planting_params):
                     if os.path.exists(planting_ref):
                         os.remove(planting_ref)
                 if not os.path.exists(planting_ref):
@@ -281,7 +299,7 @@ class Phenology(Satellite_Process):
                     if not os.path.isdir(dnam):
                         raise IOError('Error, no such folder >>> {}'.format(dnam))
                     # Make paddy mask
-                    if os.path.exists(mask_paddy) and flag_paddy:
+                    if os.path.exists(mask_paddy) and (flag_paddy or not self.check_manifest(mask_paddy,gis_fnams,paddy_params)):
                         os.remove(mask_paddy)
                     if not os.path.exists(mask_paddy):
                         mask_dnam = os.path.dirname(mask_paddy)
@@ -289,8 +307,9 @@ class Phenology(Satellite_Process):
                             os.makedirs(mask_dnam)
                         if not os.path.isdir(mask_dnam):
                             raise IOError('Error, no such folder >>> {}'.format(mask_dnam))
-                        if os.path.exists(mask_parcel) and not flag_parcel and (self.values['buffer_paddy'] == self.values['buffer_parcel']):
+                        if os.path.exists(mask_parcel) and not flag_parcel and (self.values['buffer_paddy'] == self.values['buffer_parcel']) and self.check_manifest(mask_parcel,gis_fnams,parcel_params):
                             shutil.copy2(mask_parcel,mask_paddy)
+                            self.write_manifest(mask_paddy,gis_fnams,paddy_params)
                         else:
                             src_fnam = None
                             years = np.arange(start_dtim.year,end_dtim.year+2,1)
@@ -299,14 +318,14 @@ class Phenology(Satellite_Process):
                                 ynam = os.path.join(s1_data,ystr)
                                 if not os.path.isdir(ynam):
                                     continue
-                                for d in sorted(os.listdir(ynam)):
+                                for d in list_dir(ynam):
                                     temp_dnam = os.path.join(ynam,d)
                                     if not os.path.isdir(temp_dnam):
                                         continue
                                     m = re.search('^('+'\d'*8+')$',d)
                                     if not m:
                                         continue
-                                    for f in sorted(os.listdir(temp_dnam)):
+                                    for f in list_dir(temp_dnam):
                                         if not re.search('_{}.tif'.format(product),f):
                                             continue
                                         bnam = os.path.basename(f)
@@ -338,6 +357,8 @@ class Phenology(Satellite_Process):
                                 command += ' --buffer="{}"'.format(-abs(self.values['buffer_paddy']))
                             command += ' --use_index'
                             self.run_command(command,message='<<< Make paddy mask >>>')
+                            if os.path.exists(mask_paddy):
+                                self.write_manifest(mask_paddy,gis_fnams,paddy_params)
                     if not os.path.exists(mask_paddy):
                         raise ValueError('Error, no such file >>> {}'.format(mask_paddy))
                     else:
@@ -365,12 +386,14 @@ class Phenology(Satellite_Process):
                     if product == 'preliminary':
                         command += ' --early'
                     self.run_command(command,message='<<< Select reference for planting >>>')
+                    if os.path.exists(planting_ref):
+                        self.write_manifest(planting_ref,[mask_paddy],planting_params)
                 else:
                     self.print_message('File exists >>> {}'.format(planting_ref),print_time=False)
 
                 # Calculate average for planting
                 planting_avg = os.path.join(dnam,'{}_planting_avg.tif'.format(trg_bnam))
-                if self.values['oflag'][iflag]:
+                if self.values['oflag'][iflag] or not self.check_manifest(planting_avg,[planting_ref],planting_params):
                     if os.path.exists(planting_avg):
                         os.remove(planting_avg)
                 if not os.path.exists(planting_avg):
@@ -381,17 +404,19 @@ class Phenology(Satellite_Process):
                     command += ' --tmin {:%Y%m%d}'.format(start_dtim)
                     command += ' --tmax {:%Y%m%d}'.format(end_dtim)
                     self.run_command(command,message='<<< Calculate average for planting >>>')
+                    if os.path.exists(planting_avg):
+                        self.write_manifest(planting_avg,[planting_ref],planting_params)
                 else:
                     self.print_message('File exists >>> {}'.format(planting_avg),print_time=False)
 
                 # Select planting
                 planting_sel = os.path.join(dnam,'{}_planting.tif'.format(trg_bnam))
-                if self.values['oflag'][iflag]:
+                if self.values['oflag'][iflag] or not self.check_manifest(planting_sel,[planting_avg,mask_paddy],planting_params):
                     if os.path.exists(planting_sel):
                         os.remove(planting_sel)
                 if not os.path.exists(planting_sel):
                     # Make paddy mask
-                    if os.path.exists(mask_paddy) and flag_paddy:
+                    if os.path.exists(mask_paddy) and (flag_paddy or not self.check_manifest(mask_paddy,gis_fnams,paddy_params)):
                         os.remove(mask_paddy)
                     if not os.path.exists(mask_paddy):
                         mask_dnam = os.path.dirname(mask_paddy)
@@ -399,8 +424,9 @@ class Phenology(Satellite_Process):
                             os.makedirs(mask_dnam)
                         if not os.path.isdir(mask_dnam):
                             raise IOError('Error, no such folder >>> {}'.format(mask_dnam))
-                        if os.path.exists(mask_parcel) and not flag_parcel and (self.values['buffer_paddy'] == self.values['buffer_parcel']):
+                        if os.path.exists(mask_parcel) and not flag_parcel and (self.values['buffer_paddy'] == self.values['buffer_parcel']) and self.check_manifest(mask_parcel,gis_fnams,parcel_params):
                             shutil.copy2(mask_parcel,mask_paddy)
+                            self.write_manifest(mask_paddy,gis_fnams,paddy_params)
                         else:
                             command = self.python_path
                             command += ' "{}"'.format(os.path.join(self.scr_dir,'make_mask.py'))
@@ -413,6 +439,8 @@ class Phenology(Satellite_Process):
                                 command += ' --buffer="{}"'.format(-abs(self.values['buffer_paddy']))
                             command += ' --use_index'
                             self.run_command(command,message='<<< Make paddy mask >>>')
+                            if os.path.exists(mask_paddy):
+                                self.write_manifest(mask_paddy,gis_fnams,paddy_params)
                     if not os.path.exists(mask_paddy):
                         raise ValueError('Error, no such file >>> {}'.format(mask_paddy))
                     else:
@@ -444,6 +472,8 @@ class Phenology(Satellite_Process):
                     if product == 'preliminary':
                         command += ' --early'
                     self.run_command(command,message='<<< Select planting >>>')
+                    if os.path.exists(planting_sel):
+                        self.write_manifest(planting_sel,[planting_avg,mask_paddy],planting_params)
                 else:
                     self.print_message('File exists >>> {}'.format(planting_sel),print_time=False)
 
@@ -451,7 +481,7 @@ class Phenology(Satellite_Process):
             planting_csv = os.path.join(dnam,'{}_planting.csv'.format(trg_bnam))
             planting_shp = os.path.join(dnam,'{}_planting.shp'.format(trg_bnam))
             planting_pdf = os.path.join(dnam,'{}_planting.pdf'.format(trg_bnam))
-            if self.values['oflag'][iflag]:
+            if self.values['oflag'][iflag] or not self.check_manifest(planting_csv,[planting_sel,mask_parcel]+gis_fnams,planting_params):
                 if os.path.exists(planting_csv):
                     os.remove(planting_csv)
                 if os.path.exists(planting_shp):
@@ -460,7 +490,7 @@ class Phenology(Satellite_Process):
                     os.remove(planting_pdf)
             if not os.path.exists(planting_csv):
                 # Make parcel mask
-                if os.path.exists(mask_parcel) and flag_parcel:
+                if os.path.exists(mask_parcel) and (flag_parcel or not self.check_manifest(mask_parcel,gis_fnams,parcel_params)):
                     os.remove(mask_parcel)
                 if not os.path.exists(mask_parcel):
                     mask_dnam = os.path.dirname(mask_parcel)
@@ -468,8 +498,9 @@ class Phenology(Satellite_Process):
                         os.makedirs(mask_dnam)
                     if not os.path.isdir(mask_dnam):
                         raise IOError('Error, no such folder >>> {}'.format(mask_dnam))
-                    if os.path.exists(mask_paddy) and not flag_paddy and (self.values['buffer_parcel'] == self.values['buffer_paddy']):
+                    if os.path.exists(mask_paddy) and not flag_paddy and (self.values['buffer_parcel'] == self.values['buffer_paddy']) and self.check_manifest(mask_paddy,gis_fnams,paddy_params):
                         shutil.copy2(mask_paddy,mask_parcel)
+                        self.write_manifest(mask_parcel,gis_fnams,parcel_params)
                     else:
                         command = self.python_path
                         command += ' "{}"'.format(os.path.join(self.scr_dir,'make_mask.py'))
@@ -482,6 +513,8 @@ class Phenology(Satellite_Process):
                             command += ' --buffer="{}"'.format(-abs(self.values['buffer_parcel']))
                         command += ' --use_index'
                         self.run_command(command,message='<<< Make parcel mask >>>')
+                        if os.path.exists(mask_parcel):
+                            self.write_manifest(mask_parcel,gis_fnams,parcel_params)
                 if not os.path.exists(mask_parcel):
                     raise ValueError('Error, no such file >>> {}'.format(mask_parcel))
                 else:
@@ -504,6 +537,8 @@ class Phenology(Satellite_Process):
                 command += ' --debug'
                 command += ' --batch'
                 self.run_command(command,message='<<< Parcellate planting >>>')
+                if os.path.exists(planting_csv):
+                    self.write_manifest(planting_csv,[planting_sel,mask_parcel]+gis_fnams,planting_params)
             else:
                 self.print_message('File exists >>> {}'.format(planting_csv),print_time=False)
 
@@ -512,8 +547,12 @@ class Phenology(Satellite_Process):
         assess_shp = os.path.join(wrk_dir,'{}_assess.shp'.format(trg_bnam))
         assess_pdf = os.path.join(wrk_dir,'{}_assess.pdf'.format(trg_bnam))
         phenology_pdf = os.path.join(wrk_dir,'{}_phenology.pdf'.format(trg_bnam))
+        inputs = gis_fnams+[planting_csv]+[self.values[pnam] for pnam in ['trans_fnam','head_fnam','harvest_fnam','assess_fnam'] if self.values[pnam] != '']
+        inputs += self.list_products(os.path.join(self.s2_data,'interp'),'_interp.npz',first_dtim,last_dtim)
+        inputs += self.list_products(os.path.join(self.s2_data,'tentative_interp'),'_interp.npz',first_dtim,last_dtim)
+        params = {pnam:self.values[pnam] for pnam in ['atc_params','assess_dthrs','y1_smooth','y1_thr']}
         iflag = self.list_labels['oflag'].index('assess')
-        if self.values['oflag'][iflag]:
+        if self.values['oflag'][iflag] or not self.check_manifest(assess_csv,inputs,params):
             if os.path.exists(assess_csv):
                 os.remove(assess_csv)
             if os.path.exists(assess_shp):
@@ -555,6 +594,8 @@ class Phenology(Satellite_Process):
             command += ' --debug'
             command += ' --batch'
             self.run_command(command,message='<<< Calculate assessment date >>>')
+            if os.path.exists(assess_csv):
+                self.write_manifest(assess_csv,inputs,params)
             if os.path.exists(assess_shp):
                 command = self.python_path
                 command += ' "{}"'.format(os.path.join(self.scr_dir,'draw_phenology.py'))
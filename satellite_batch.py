@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+import os
+import sys
+import copy
+import runpy
+from argparse import ArgumentParser,RawTextHelpFormatter
+from proc_pipeline import Pipeline
+
+# Default values
+CNF_FNAM = os.path.join(os.path.dirname(os.path.abspath(__file__)),'satellite_config.py')
+
+# Read options
+parser = ArgumentParser(formatter_class=lambda prog:RawTextHelpFormatter(prog,max_help_position=200,width=200))
+parser.add_argument('inp_list',nargs='+',help='Configuration file names (site, season, block, ...)')
+parser.add_argument('-n','--n_proc',default=None,type=int,help='Number of processes, the largest main.n_proc is used if not given (%(default)s)')
+parser.add_argument('-C','--cache_dir',default=None,help='Folder for read-only inputs shared by all configurations, s2_data/cache of the first one if not given (%(default)s)')
+args = parser.parse_args()
+
+# Read configurations
+jobs = []
+n_proc = 1
+argv = sys.argv
+for fnam in args.inp_list:
+    if not os.path.exists(fnam):
+        raise IOError('Error, no such file >>> {}'.format(fnam))
+    # satellite_config reads the configuration given as the first argument
+    sys.argv = [argv[0],fnam]
+    cnf = runpy.run_path(CNF_FNAM)
+    cnf['set_values'](cnf['obs_block'],cnf['obs_date'],cnf['start_date'],cnf['end_date'],cnf['first_date'],cnf['last_date'],
+                      cnf['field_data'],cnf['drone_analysis'],cnf['s1_data'],cnf['s1_analysis'],cnf['s2_data'],cnf['s2_analysis'])
+    # The process instances are shared by all configurations, so keep a copy for each of them.
+    modules = copy.deepcopy(cnf['modules'])
+    jobs.append((os.path.splitext(os.path.basename(fnam))[0],cnf['pnams'],modules,dict(cnf['defaults'])))
+    n_proc = max(n_proc,cnf['n_proc'])
+    if args.cache_dir is None:
+        args.cache_dir = os.path.join(cnf['s2_data'],'cache')
+sys.argv = argv
+if args.n_proc is not None:
+    n_proc = args.n_proc
+
+# The reference cache of geocor and the parcel masks are shared by all configurations
+for name,pnams,modules,flags in jobs:
+    for proc in modules:
+        modules[proc].cache_dir = args.cache_dir
+
+# Run all configurations in one pipeline
+pipeline = Pipeline(nproc=n_proc)
+for name,pnams,modules,flags in jobs:
+    pipeline.add_job(pnams,modules,flags,name=name)
+pipeline.run()
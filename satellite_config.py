@@ -4,17 +4,9 @@ import re
 import numpy as np
 from datetime import datetime,timedelta
 import configparser
+from glob import glob
+import importlib
 from proc_set_fnam import set_obs_fnam
-from proc_satellite_download import proc_download
-from proc_satellite_geocor import proc_geocor
-from proc_satellite_indices import proc_indices
-from proc_satellite_parcel import proc_parcel
-from proc_satellite_atcor import proc_atcor
-from proc_satellite_interp import proc_interp
-from proc_satellite_phenology import proc_phenology
-from proc_satellite_extract import proc_extract
-from proc_satellite_formula import proc_formula
-from proc_satellite_estimate import proc_estimate
 
 # Set folder&file names
 HOME = os.environ.get('USERPROFILE')
@@ -75,6 +67,13 @@ config_defaults.update({
 'main.formula'                        : False,
 'main.estimate'                       : True,
 'main.no_gui'                         : False,
+'main.pipeline'                       : False,
+'main.n_proc'                         : 1,
+'main.inproc'                         : False,
+'main.snap_nproc'                     : 0,
+'main.trace'                          : True,
+'main.mem_budget'                     : 0.0,
+'main.catalog'                        : os.path.join(HOME,'.satellite_catalog.db'),
 'main.window_width'                   : 650,
 'main.top_frame_height'               : 275,
 'main.left_frame_width'               : 30,
@@ -103,10 +102,12 @@ config_defaults.update({
 'geocor.l2a_dir'                      : os.path.join(main_s2_data,'L2A'),
 'geocor.search_key'                   : '',
 'geocor.unzip'                        : '',
+'geocor.subset_tool'                  : 'SNAP',
 'geocor.ref_fnam'                     : ref_fnam,
 'geocor.ref_bands'                    : [5,-1,-1],
 'geocor.ref_factors'                  : [np.nan,np.nan,np.nan],
 'geocor.ref_range'                    : [1.0e-5,np.nan],
+'geocor.ref_pixel'                    : 0.0,
 'geocor.trg_subset'                   : [107.201,107.367,-6.910,-6.750],
 'geocor.trg_resample'                 : [743805.0,757295.0,9235815.0,9251805.0],
 'geocor.trg_bands'                    : ['r','-1','-1'],
@@ -114,12 +115,17 @@ config_defaults.update({
 'geocor.trg_flags'                    : ['quality_scene_classification','-1','-1','-1','-1'],
 'geocor.trg_pixel'                    : 10.0,
 'geocor.trg_range'                    : [np.nan,np.nan],
+'geocor.trg_flag_max'                 : 0.0,
+'geocor.trg_std_min'                  : 0.0,
 'geocor.init_shifts'                  : [0.0,0.0],
 'geocor.part_size'                    : 1000.0,
 'geocor.gcp_interval'                 : 500.0,
 'geocor.max_shift'                    : 30.0,
 'geocor.margin'                       : 50.0,
 'geocor.scan_step'                    : 1,
+'geocor.prior_days'                   : 30.0,
+'geocor.prior_shift'                  : 20.0,
+'geocor.gcp_nstop'                    : 0,
 'geocor.geocor_order'                 : 'Auto',
 'geocor.nmin'                         : 20,
 'geocor.cmin'                         : 0.3,
@@ -127,6 +133,7 @@ config_defaults.update({
 'geocor.emaxs'                        : [3.0,2.0,2.0],
 'geocor.smooth_fact'                  : [1.0e4,1.0e4],
 'geocor.smooth_dmax'                  : [4.0,4.0],
+'geocor.n_proc'                       : 1,
 'geocor.oflag'                        : [False,False],
 'geocor.python_path'                  : python_path,
 'geocor.scr_dir'                      : scr_dir,
@@ -389,6 +396,14 @@ s2_data = os.path.normpath(config['main'].get('main.s2_data'))
 s2_analysis = os.path.normpath(config['main'].get('main.s2_analysis'))
 browse_image = os.path.normpath(config['main'].get('main.browse_image'))
 no_gui = config['main'].getboolean('main.no_gui')
+pipeline = config['main'].getboolean('main.pipeline')
+n_proc = config['main'].getint('main.n_proc')
+inproc = config['main'].getboolean('main.inproc')
+snap_nproc = config['main'].getint('main.snap_nproc')
+trace = config['main'].getboolean('main.trace')
+mem_budget = config['main'].getfloat('main.mem_budget')
+catalog = config['main'].get('main.catalog')
+os.environ['SATELLITE_CATALOG'] = catalog # used by proc_catalog in this process and in the worker scripts
 window_width = config['main'].getint('main.window_width')
 top_frame_height = config['main'].getint('main.top_frame_height')
 left_frame_width = config['main'].getint('main.left_frame_width')
@@ -411,9 +426,11 @@ modules = {}
 titles = {}
 defaults = {}
 for proc in pnams:
-    modules[proc] = eval('proc_{}'.format(proc))
-    titles[proc] = modules[proc].proc_title
     defaults[proc] = config['main'].getboolean('main.{}'.format(proc))
+    if no_gui and not defaults[proc]: # load the requested processes only
+        continue
+    modules[proc] = getattr(importlib.import_module('proc_satellite_{}'.format(proc)),'proc_{}'.format(proc))
+    titles[proc] = modules[proc].proc_title
     if not proc in config:
         config[proc] = {}
     for pnam in modules[proc].pnams:
@@ -483,6 +500,10 @@ for proc in pnams:
                 raise ValueError('{}: Error, unsupported parameter type ({}) >>> {}'.format(modules[proc].proc_name,pnam,modules[proc].param_types[pnam]))
     modules[proc].python_path = config[proc].get('{}.python_path'.format(proc))
     modules[proc].scr_dir = config[proc].get('{}.scr_dir'.format(proc))
+    modules[proc].inproc = inproc
+    modules[proc].snap_nproc = snap_nproc
+    modules[proc].trace_flag = trace
+    modules[proc].mem_budget = mem_budget
     modules[proc].date_fmt = date_fmt
     modules[proc].start_date = start_date
     modules[proc].end_date = end_date
@@ -506,3 +527,121 @@ for proc in pnams:
             if value is not None:
                 setattr(modules[proc],pnam,eval(value.replace('nan','np.nan').replace('NaN','np.nan')))
     modules[proc].middle_left_frame_width = config[proc].getint('{}.middle_left_frame_width'.format(proc))
+
+def set_values(block,dstr,start_date,end_date,first_date,last_date,field_data,drone_analysis,s1_data,s1_analysis,s2_data,s2_analysis):
+    for proc in modules:
+        modules[proc].start_date = start_date
+        modules[proc].end_date = end_date
+        modules[proc].first_date = first_date
+        modules[proc].last_date = last_date
+        modules[proc].obs_block = block
+        modules[proc].obs_date = dstr
+        modules[proc].field_data = field_data
+        modules[proc].drone_analysis = drone_analysis
+        modules[proc].s1_data = s1_data
+        modules[proc].s1_analysis = s1_analysis
+        modules[proc].s2_data = s2_data
+        modules[proc].s2_analysis = s2_analysis
+    now_dtim = datetime.now()
+    start_dtim = datetime.strptime(start_date,date_fmt)
+    end_dtim = datetime.strptime(end_date,date_fmt)
+    first_dtim = datetime.strptime(first_date,date_fmt)
+    last_dtim = datetime.strptime(last_date,date_fmt)
+    # set observation data
+    set_obs_fnam(block,dstr,field_data,date_format=date_format)
+    # geocor
+    proc = 'geocor'
+    if proc in modules:
+        proc_pnam = 'l2a_dir'
+        if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
+            modules[proc].values[proc_pnam] = os.path.join(s2_data,'L2A')
+            if modules[proc].center_var is not None:
+                modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
+    # indices
+    proc = 'indices'
+    if proc in modules:
+        proc_pnam = 'geocor_dir'
+        if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
+            modules[proc].values[proc_pnam] = os.path.join(s2_data,'geocor')
+            if modules[proc].center_var is not None:
+                modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
+    # parcel
+    proc = 'parcel'
+    if proc in modules:
+        for proc_pnam,dnam in zip(['geocor_dir','indices_dir'],['geocor','indices']):
+            if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
+                modules[proc].values[proc_pnam] = os.path.join(s2_data,dnam)
+                if modules[proc].center_var is not None:
+                    modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
+    # atcor
+    proc = 'atcor'
+    if proc in modules:
+        for proc_pnam,fnam in zip(['geocor_dir','indices_dir','mask_studyarea'],
+                                  ['geocor','indices','studyarea_mask.tif']):
+            if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
+                modules[proc].values[proc_pnam] = os.path.join(s2_data,fnam)
+                if modules[proc].center_var is not None:
+                    modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
+    # phenology
+    proc = 'phenology'
+    if proc in modules:
+        proc_pnam = 'trans_pref'
+        if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
+            dt = (end_dtim-start_dtim).total_seconds()
+            trans_pref = (start_dtim+timedelta(seconds=dt/2)).strftime(date_fmt)
+            modules[proc].values[proc_pnam] = trans_pref
+            if modules[proc].center_var is not None:
+                modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
+    # extract
+    proc = 'extract'
+    if proc in modules:
+        proc_pnam = 'obs_fnam'
+        if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
+            if 'Drone' in modules[proc].values['obs_src']:
+                modules[proc].values[proc_pnam] = os.path.join(drone_analysis,'extract','{}_{}_observation.csv'.format(block,dstr))
+            else:
+                modules[proc].values[proc_pnam] = os.path.join(field_data,block,'Excel_File','{}_{}.xls'.format(block,dstr))
+            if modules[proc].center_var is not None:
+                modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
+        proc_pnam = 'event_fnam'
+        if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
+            modules[proc].values[proc_pnam] = os.path.join(s2_analysis,'phenology','{:%Y%m%d}_{:%Y%m%d}_assess.csv'.format(start_dtim,end_dtim))
+            if modules[proc].center_var is not None:
+                modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
+        proc_pnam = 'spec_date'
+        if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
+            modules[proc].values[proc_pnam] = dstr
+            if modules[proc].center_var is not None:
+                modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
+    # formula
+    proc = 'formula'
+    if proc in modules:
+        proc_pnam = 'inp_fnams'
+        if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
+            dnam = os.path.join(s2_analysis,'extract')
+            fnams = glob(os.path.join(dnam,'*_extract.csv'))
+            if len(fnams) > 0:
+                modules[proc].values[proc_pnam] = '\n'.join(sorted(fnams))
+            else:
+                modules[proc].values[proc_pnam] = os.path.join(dnam,'{}_{}_extract.csv'.format(block,dstr))
+            if modules[proc].center_var is not None:
+                try:
+                    modules[proc].center_inp[proc_pnam].delete('1.0','end')
+                    modules[proc].center_inp[proc_pnam].insert('1.0',modules[proc].values[proc_pnam])
+                except Exception:
+                    pass
+                modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
+    # estimate
+    proc = 'estimate'
+    if proc in modules:
+        proc_pnam = 'event_fnam'
+        if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
+            modules[proc].values[proc_pnam] = os.path.join(s2_analysis,'phenology','{:%Y%m%d}_{:%Y%m%d}_assess.csv'.format(start_dtim,end_dtim))
+            if modules[proc].center_var is not None:
+                modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
+        proc_pnam = 'spec_date'
+        if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
+            modules[proc].values[proc_pnam] = dstr
+            if modules[proc].center_var is not None:
+                modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
+    return
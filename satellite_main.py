@@ -1,13 +1,8 @@
 import os
 import sys
-from glob import glob
 from datetime import datetime,timedelta
 from dateutil.relativedelta import relativedelta
-import tkinter as tk
-from tkinter import ttk
-import tkinter.font as font
-import tkfilebrowser
-from custom_calendar import CustomDateEntry
+from proc_pipeline import Pipeline
 from satellite_config import *
 
 def set_title(pnam):
@@ -37,113 +32,7 @@ def set_title(pnam):
         s1_analysis = top_var['s1_analysis'].get()
         s2_data = top_var['s2_data'].get()
         s2_analysis = top_var['s2_analysis'].get()
-    for proc in pnams:
-        modules[proc].start_date = start_date
-        modules[proc].end_date = end_date
-        modules[proc].first_date = first_date
-        modules[proc].last_date = last_date
-        modules[proc].obs_block = block
-        modules[proc].obs_date = dstr
-        modules[proc].field_data = field_data
-        modules[proc].drone_analysis = drone_analysis
-        modules[proc].s1_data = s1_data
-        modules[proc].s1_analysis = s1_analysis
-        modules[proc].s2_data = s2_data
-        modules[proc].s2_analysis = s2_analysis
-    now_dtim = datetime.now()
-    start_dtim = datetime.strptime(start_date,date_fmt)
-    end_dtim = datetime.strptime(end_date,date_fmt)
-    first_dtim = datetime.strptime(first_date,date_fmt)
-    last_dtim = datetime.strptime(last_date,date_fmt)
-    # set observation data
-    set_obs_fnam(block,dstr,field_data,date_format=date_format)
-    # geocor
-    proc = 'geocor'
-    proc_pnam = 'l2a_dir'
-    if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
-        modules[proc].values[proc_pnam] = os.path.join(s2_data,'L2A')
-        if modules[proc].center_var is not None:
-            modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
-    # indices
-    proc = 'indices'
-    proc_pnam = 'geocor_dir'
-    if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
-        modules[proc].values[proc_pnam] = os.path.join(s2_data,'geocor')
-        if modules[proc].center_var is not None:
-            modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
-    # parcel
-    proc = 'parcel'
-    for proc_pnam,dnam in zip(['geocor_dir','indices_dir'],['geocor','indices']):
-        if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
-            modules[proc].values[proc_pnam] = os.path.join(s2_data,dnam)
-            if modules[proc].center_var is not None:
-                modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
-    # atcor
-    proc = 'atcor'
-    for proc_pnam,fnam in zip(['geocor_dir','indices_dir','mask_studyarea'],
-                              ['geocor','indices','studyarea_mask.tif']):
-        if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
-            modules[proc].values[proc_pnam] = os.path.join(s2_data,fnam)
-            if modules[proc].center_var is not None:
-                modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
-    # phenology
-    proc = 'phenology'
-    proc_pnam = 'trans_pref'
-    if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
-        dt = (end_dtim-start_dtim).total_seconds()
-        trans_pref = (start_dtim+timedelta(seconds=dt/2)).strftime(date_fmt)
-        modules[proc].values[proc_pnam] = trans_pref
-        if modules[proc].center_var is not None:
-            modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
-    # extract
-    proc = 'extract'
-    proc_pnam = 'obs_fnam'
-    if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
-        if 'Drone' in modules[proc].values['obs_src']:
-            modules[proc].values[proc_pnam] = os.path.join(drone_analysis,'extract','{}_{}_observation.csv'.format(block,dstr))
-        else:
-            modules[proc].values[proc_pnam] = os.path.join(field_data,block,'Excel_File','{}_{}.xls'.format(block,dstr))
-        if modules[proc].center_var is not None:
-            modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
-    proc_pnam = 'event_fnam'
-    if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
-        modules[proc].values[proc_pnam] = os.path.join(s2_analysis,'phenology','{:%Y%m%d}_{:%Y%m%d}_assess.csv'.format(start_dtim,end_dtim))
-        if modules[proc].center_var is not None:
-            modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
-    proc_pnam = 'spec_date'
-    if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
-        modules[proc].values[proc_pnam] = dstr
-        if modules[proc].center_var is not None:
-            modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
-    # formula
-    proc = 'formula'
-    proc_pnam = 'inp_fnams'
-    if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
-        dnam = os.path.join(s2_analysis,'extract')
-        fnams = glob(os.path.join(dnam,'*_extract.csv'))
-        if len(fnams) > 0:
-            modules[proc].values[proc_pnam] = '\n'.join(sorted(fnams))
-        else:
-            modules[proc].values[proc_pnam] = os.path.join(dnam,'{}_{}_extract.csv'.format(block,dstr))
-        if modules[proc].center_var is not None:
-            try:
-                modules[proc].center_inp[proc_pnam].delete('1.0',tk.END)
-                modules[proc].center_inp[proc_pnam].insert('1.0',modules[proc].values[proc_pnam])
-            except Exception:
-                pass
-            modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
-    # estimate
-    proc = 'estimate'
-    proc_pnam = 'event_fnam'
-    if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
-        modules[proc].values[proc_pnam] = os.path.join(s2_analysis,'phenology','{:%Y%m%d}_{:%Y%m%d}_assess.csv'.format(start_dtim,end_dtim))
-        if modules[proc].center_var is not None:
-            modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
-    proc_pnam = 'spec_date'
-    if (not proc_pnam in modules[proc].flag_fix) or (not modules[proc].flag_fix[proc_pnam]):
-        modules[proc].values[proc_pnam] = dstr
-        if modules[proc].center_var is not None:
-            modules[proc].center_var[proc_pnam].set(modules[proc].values[proc_pnam])
+    set_values(block,dstr,start_date,end_date,first_date,last_date,field_data,drone_analysis,s1_data,s1_analysis,s2_data,s2_analysis)
     if pnam is None:
         return
     # change color
@@ -253,10 +142,20 @@ def exit():
 
 if no_gui:
     set_title(None)
-    for pnam in pnams:
-        if defaults[pnam]:
-            modules[pnam].run()
+    if pipeline:
+        Pipeline(pnams,modules,defaults,nproc=n_proc).run()
+    else:
+        for pnam in pnams:
+            if defaults[pnam]:
+                modules[pnam].run()
     exit()
+
+# GUI modules are imported after the headless run
+import tkinter as tk
+from tkinter import ttk
+import tkinter.font as font
+import tkfilebrowser
+from custom_calendar import CustomDateEntry
 root = tk.Tk()
 root.title('BLB Damage Estimation - Satellite version')
 root.geometry('{}x{}'.format(window_width,305+30*len(pnams)))
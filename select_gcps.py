@@ -4,6 +4,7 @@ import sys
 import numpy as np
 from scipy.interpolate import bisplrep,bisplev
 from argparse import ArgumentParser,RawTextHelpFormatter
+from proc_gcp import read_gcps,format_gcp,write_gcps
 
 # Default values
 XTHR = 4.0
@@ -14,8 +15,8 @@ SMOOTH = 1.0e4
 
 # Read options
 parser = ArgumentParser(formatter_class=lambda prog:RawTextHelpFormatter(prog,max_help_position=200,width=200))
-parser.add_argument('-I','--inp_fnam',default=None,help='Input file name (%(default)s)')
-parser.add_argument('-O','--out_fnam',default=None,help='Output file name (%(default)s)')
+parser.add_argument('-I','--inp_fnam',default=None,help='Input file name, binary if the extension is .npy (%(default)s)')
+parser.add_argument('-O','--out_fnam',default=None,help='Output file name, binary if the extension is .npy (%(default)s)')
 parser.add_argument('--xthr',default=XTHR,type=float,help='Max difference in X (%(default)s)')
 parser.add_argument('--ythr',default=YTHR,type=float,help='Max difference in Y (%(default)s)')
 parser.add_argument('-s','--trg_indx_step',default=TRG_INDX_STEP,type=int,help='Target step x index (%(default)s)')
@@ -31,11 +32,19 @@ args = parser.parse_args()
 if args.inp_fnam is None:
     raise ValueError('Error, args.inp_fnam={} >>> {}'.format(args.inp_fnam,sys.argv[0]))
 if args.out_fnam is None:
-    args.out_fnam = '{}_selected.dat'.format(os.path.splitext(args.inp_fnam)[0])
+    args.out_fnam = '{}_selected{}'.format(*os.path.splitext(args.inp_fnam))
 if args.smooth_y is None:
     args.smooth_y = args.smooth_x
 
-xc,yc,xp,yp,xd,yd,rr,r90 = np.loadtxt(args.inp_fnam,unpack=True)
+gcps = read_gcps(args.inp_fnam)
+xc = gcps['xc']
+yc = gcps['yc']
+xp = gcps['xp']
+yp = gcps['yp']
+xd = gcps['xd']
+yd = gcps['yd']
+rr = gcps['r']
+r90 = gcps['r90']
 xc_uniq = np.unique(xc)
 yc_uniq = np.unique(yc)
 xi = xc.astype(np.int32)
@@ -92,26 +101,26 @@ ys_grid[cnd] = np.nan
 xr_grid = xd_grid-xs_grid
 yr_grid = yd_grid-ys_grid
 
-with open(args.out_fnam,'w') as fp:
-    for ix,iy in zip(indx,indy):
-        if (np.abs(xr_grid[iy,ix]) > args.xthr) or (np.abs(yr_grid[iy,ix]) > args.ythr):
-            continue
-        if args.replace:
-            xp_out = xp_grid[iy,ix]-xd_grid[iy,ix]+xs_grid[iy,ix]
-            yp_out = yp_grid[iy,ix]-yd_grid[iy,ix]+ys_grid[iy,ix]
-            xd_out = xs_grid[iy,ix]
-            yd_out = ys_grid[iy,ix]
-        else:
-            xp_out = xp_grid[iy,ix]
-            yp_out = yp_grid[iy,ix]
-            xd_out = xd_grid[iy,ix]
-            yd_out = yd_grid[iy,ix]
-        if args.exp:
-            line = '{:8.1f} {:8.1f} {:15.8e} {:15.8e} {:15.8e} {:15.8e} {:8.3f} {:8.3f}\n'.format(xc_grid[iy,ix],yc_grid[iy,ix],xp_out,yp_out,xd_out,yd_out,rr_grid[iy,ix],r90_grid[iy,ix])
-        elif args.long:
-            line = '{:8.1f} {:8.1f} {:12.6f} {:12.6f} {:10.6f} {:10.6f} {:10.5f} {:10.5f}\n'.format(xc_grid[iy,ix],yc_grid[iy,ix],xp_out,yp_out,xd_out,yd_out,rr_grid[iy,ix],r90_grid[iy,ix])
-        else:
-            line = '{:8.1f} {:8.1f} {:8.2f} {:8.2f} {:6.2f} {:6.2f} {:8.3f} {:8.3f}\n'.format(xc_grid[iy,ix],yc_grid[iy,ix],xp_out,yp_out,xd_out,yd_out,rr_grid[iy,ix],r90_grid[iy,ix])
-        fp.write(line)
-        if args.verbose:
-            sys.stdout.write(line)
+gcps = []
+for ix,iy in zip(indx,indy):
+    if (np.abs(xr_grid[iy,ix]) > args.xthr) or (np.abs(yr_grid[iy,ix]) > args.ythr):
+        continue
+    if args.replace:
+        xp_out = xp_grid[iy,ix]-xd_grid[iy,ix]+xs_grid[iy,ix]
+        yp_out = yp_grid[iy,ix]-yd_grid[iy,ix]+ys_grid[iy,ix]
+        xd_out = xs_grid[iy,ix]
+        yd_out = ys_grid[iy,ix]
+    else:
+        xp_out = xp_grid[iy,ix]
+        yp_out = yp_grid[iy,ix]
+        xd_out = xd_grid[iy,ix]
+        yd_out = yd_grid[iy,ix]
+    gcp = (xc_grid[iy,ix],yc_grid[iy,ix],xp_out,yp_out,xd_out,yd_out,rr_grid[iy,ix],r90_grid[iy,ix])
+    gcps.append(gcp)
+    if args.verbose:
+        sys.stdout.write(format_gcp(gcp,exp=args.exp,long=args.long))
+# Write through a temporary file, as the output may be read by other processes as prior GCPs
+root,ext = os.path.splitext(args.out_fnam)
+tmp_fnam = root+'.part'+ext
+write_gcps(tmp_fnam,gcps,exp=args.exp,long=args.long)
+os.replace(tmp_fnam,args.out_fnam)
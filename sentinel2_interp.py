@@ -9,6 +9,7 @@ from matplotlib.dates import date2num,num2date,YearLocator,MonthLocator,DayLocat
 from csaps import csaps
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
+from proc_catalog import list_dir
 from argparse import ArgumentParser,RawTextHelpFormatter
 
 # Constants
@@ -77,7 +78,7 @@ for year in data_years:
     dnam = os.path.join(args.inpdir,ystr)
     if not os.path.isdir(dnam):
         continue
-    for f in sorted(os.listdir(dnam)):
+    for f in list_dir(dnam):
         m = re.search('^('+'\d'*8+')'+tnam+ext,f)
         if not m:
             continue
@@ -10,6 +10,7 @@ from csaps import csaps
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 from matplotlib.backends.backend_pdf import PdfPages
+from proc_catalog import list_dir
 from argparse import ArgumentParser,RawTextHelpFormatter
 
 # Constants
@@ -73,7 +74,7 @@ for year in data_years:
     dnam = os.path.join(args.inpdir,ystr)
     if not os.path.isdir(dnam):
         continue
-    for f in sorted(os.listdir(dnam)):
+    for f in list_dir(dnam):
         m = re.search('^('+'\d'*8+')_atcor\.npz$',f)
         if not m:
             continue
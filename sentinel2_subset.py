@@ -2,8 +2,18 @@
 import os
 import psutil
 import tempfile
+import shutil
+import atexit
 import sys
 import re
+import json
+import shlex
+import threading
+import traceback
+try:
+    import resource
+except Exception:
+    resource = None
 from argparse import ArgumentParser,RawTextHelpFormatter
 
 # Default values
@@ -12,6 +22,7 @@ DATDIR = os.curdir
 POLYGON_CIHEA = 'POLYGON((107.201 -6.910,107.367 -6.910,107.367 -6.750,107.201 -6.750,107.201 -6.910))' # Cihea
 POLYGON_BOJONGSOANG = 'POLYGON((107.54 -7.04,107.75 -7.04,107.75 -6.95,107.54 -6.95,107.54 -7.04))' # Bojongsoang
 RESOLUTION = 10 # m
+TRACE_INTERVAL = 0.5 # sec
 
 # Read options
 parser = ArgumentParser(formatter_class=lambda prog:RawTextHelpFormatter(prog,max_help_position=200,width=200))
@@ -23,10 +34,19 @@ parser.add_argument('--site',default=None,help='Site name for preset coordinates
 parser.add_argument('--polygon',default=None,help='Polygon of ROI in WKT format (%(default)s)')
 parser.add_argument('-r','--resolution',default=RESOLUTION,type=int,help='Spatial resolution in m (%(default)s)')
 parser.add_argument('-G','--geotiff',default=False,action='store_true',help='GeoTiff mode (%(default)s)')
+parser.add_argument('--max_memory',default=None,type=int,help='Maximum heap size of JAVA in MB (%(default)s)')
 parser.add_argument('--overwrite',default=False,action='store_true',help='Overwrite mode (%(default)s)')
+parser.add_argument('--inp_list',default=None,help='Input list file name, input and optional output file names in each line (%(default)s)')
+parser.add_argument('--server',default=False,action='store_true',help='Server mode, read requests from stdin (%(default)s)')
 args = parser.parse_args()
 
-mem_size = int(psutil.virtual_memory().available*0.8e-6)
+if args.max_memory is not None:
+    mem_size = args.max_memory
+else:
+    mem_size = int(psutil.virtual_memory().available*0.8e-6)
+if args.server or args.inp_list is not None: # use a private temporary directory, cleaned after each scene
+    args.tmp_dnam = tempfile.mkdtemp(prefix='snap_',dir=args.tmp_dnam)
+    atexit.register(shutil.rmtree,args.tmp_dnam,ignore_errors=True)
 options = '-Xmx{}m'.format(mem_size) # Save memory for JAVA
 options += ' -Djava.io.tmpdir={}'.format(args.tmp_dnam) # Temporary directory
 os.environ['_JAVA_OPTIONS'] = options
@@ -36,54 +56,174 @@ else:
     os.system('export _JAVA_OPTIONS="{}"'.format(options))
 from snappy import Product,ProductIO,ProductUtils,GPF,HashMap,WKTReader,jpy
 
-safe_flag = False
-m = re.search('^[^_]+_[^_]+_([^_]+)_.*.zip$',os.path.basename(args.inp_fnam))
-if not m:
-    m = re.search('^[^_]+_[^_]+_([^_]+)_.*.SAFE$',os.path.basename(args.inp_fnam))
+def run_subset(opts):
+    safe_flag = False
+    m = re.search('^[^_]+_[^_]+_([^_]+)_.*.zip$',os.path.basename(opts.inp_fnam))
     if not m:
-        raise ValueError('Error in file name >>> '+args.inp_fnam)
-    safe_flag = True
-dstr = m.group(1)[:8]
-if args.out_fnam is None:
-    if args.geotiff:
-        args.out_fnam = os.path.join(args.datdir,'{}.tif'.format(dstr))
+        m = re.search('^[^_]+_[^_]+_([^_]+)_.*.SAFE$',os.path.basename(opts.inp_fnam))
+        if not m:
+            raise ValueError('Error in file name >>> '+opts.inp_fnam)
+        safe_flag = True
+    dstr = m.group(1)[:8]
+    if opts.out_fnam is None:
+        if opts.geotiff:
+            opts.out_fnam = os.path.join(opts.datdir,'{}.tif'.format(dstr))
+        else:
+            opts.out_fnam = os.path.join(opts.datdir,'{}.dim'.format(dstr))
+    if os.path.exists(opts.out_fnam) and not opts.overwrite:
+        sys.stderr.write('input: {}, output: {} ... exists, skip!\n'.format(opts.inp_fnam,opts.out_fnam))
+        return
+    if opts.site is not None:
+        if opts.site.lower() == 'cihea':
+            opts.polygon = POLYGON_CIHEA
+        elif opts.site.lower() == 'bojongsoang':
+            opts.polygon = POLYGON_BOJONGSOANG
+        else:
+            raise ValueError('Error, unknown site >>> '+opts.site)
+    # Read original product
+    if safe_flag:
+        data = ProductIO.readProduct(os.path.join(opts.inp_fnam,'MTD_MSIL2A.xml'))
     else:
-        args.out_fnam = os.path.join(args.datdir,'{}.dim'.format(dstr))
-if os.path.exists(args.out_fnam) and not args.overwrite:
-    sys.stderr.write('input: {}, output: {} ... exists, skip!\n'.format(args.inp_fnam,args.out_fnam))
-    sys.exit()
-if args.site is not None:
-    if args.site.lower() == 'cihea':
-        args.polygon = POLYGON_CIHEA
-    elif args.site.lower() == 'bojongsoang':
-        args.polygon = POLYGON_BOJONGSOANG
+        data = ProductIO.readProduct(opts.inp_fnam)
+    products = [data]
+    try:
+        # Resample (ResamplingOp.java)
+        params = HashMap()
+        params.put('sourceProduct',data)
+        params.put('upsampling','Bilinear')
+        params.put('downsampling','Mean')
+        params.put('targetResolution',opts.resolution)
+        data_tmp = GPF.createProduct('Resample',params,data)
+        data = data_tmp
+        products.append(data)
+        # Subset (SubsetOp.java)
+        wkt = opts.polygon
+        geom = WKTReader().read(wkt)
+        params = HashMap()
+        params.put('copyMetadata',True)
+        params.put('geoRegion',geom)
+        data_tmp = GPF.createProduct('Subset',params,data)
+        data = data_tmp
+        products.append(data)
+        if opts.geotiff:
+            ProductIO.writeProduct(data,opts.out_fnam,'GeoTiff')
+        else:
+            ProductIO.writeProduct(data,opts.out_fnam,'BEAM-DIMAP')
+    finally:
+        for product in products[::-1]:
+            product.dispose()
+    return
+
+def get_usage():
+    # CPU time used by the session
+    usage = {}
+    if resource is not None:
+        r = resource.getrusage(resource.RUSAGE_SELF)
+        usage['user'] = r.ru_utime
+        usage['sys'] = r.ru_stime
     else:
-        raise ValueError('Error, unknown site >>> '+args.site)
+        t = psutil.Process().cpu_times()
+        usage['user'] = t.user
+        usage['sys'] = t.system
+    return usage
+
+def trace_rss(state):
+    # Sample the RSS of the session (JVM included) during a request, as the peak of the session is not reset
+    p = psutil.Process()
+    while True:
+        try:
+            state['max_rss'] = max(state['max_rss'],p.memory_info().rss)
+        except psutil.Error:
+            pass
+        if state['done'].wait(TRACE_INTERVAL):
+            break
+    return
 
+def clean_cache():
+    # Release the tiles and readers of the previous scene so that the session does not grow
+    JAI.getDefaultInstance().getTileCache().flush()
+    System.gc()
+    # Remove the temporary files of the previous scene (e.g. extracted from a zip file)
+    if tmp_keep is not None:
+        for f in os.listdir(args.tmp_dnam):
+            if f in tmp_keep:
+                continue
+            gnam = os.path.join(args.tmp_dnam,f)
+            if os.path.isdir(gnam):
+                shutil.rmtree(gnam,ignore_errors=True)
+            else:
+                try:
+                    os.remove(gnam)
+                except OSError: # may be still open
+                    pass
+    return
+
+System = jpy.get_type('java.lang.System')
+JAI = jpy.get_type('javax.media.jai.JAI')
+ImageIO = jpy.get_type('javax.imageio.ImageIO')
 # Get snappy Operators
 GPF.getDefaultInstance().getOperatorSpiRegistry().loadOperatorSpis()
-# Read original product
-if safe_flag:
-    data = ProductIO.readProduct(os.path.join(args.inp_fnam,'MTD_MSIL2A.xml'))
+if args.server or args.inp_list is not None:
+    tmp_keep = set(os.listdir(args.tmp_dnam)) # files made at startup are kept
 else:
-    data = ProductIO.readProduct(args.inp_fnam)
-# Resample (ResamplingOp.java)
-params = HashMap()
-params.put('sourceProduct',data)
-params.put('upsampling','Bilinear')
-params.put('downsampling','Mean')
-params.put('targetResolution',args.resolution)
-data_tmp = GPF.createProduct('Resample',params,data)
-data = data_tmp
-# Subset (SubsetOp.java)
-wkt = args.polygon
-geom = WKTReader().read(wkt)
-params = HashMap()
-params.put('copyMetadata',True)
-params.put('geoRegion',geom)
-data_tmp = GPF.createProduct('Subset',params,data)
-data = data_tmp
-if args.geotiff:
-    ProductIO.writeProduct(data,args.out_fnam,'GeoTiff')
+    tmp_keep = None
+if args.server:
+    # Persistent session to run subsets without paying the JVM startup and initialization cost for each scene.
+    # Requests are read from stdin as JSON lines ({"argv":[arg1,...],"cwd":folder}) and the exit status
+    # and resource usage of each request are written to the original stdout. The JVM options of the requests are ignored.
+    ImageIO.setUseCache(False) # no imageio* cache files are left behind
+    proto = os.fdopen(os.dup(sys.stdout.fileno()),'w')
+    os.dup2(sys.stderr.fileno(),sys.stdout.fileno())
+    for line in sys.stdin:
+        line = line.strip()
+        if len(line) < 1:
+            continue
+        request = json.loads(line)
+        cwd = os.getcwd()
+        usage1 = get_usage()
+        state = {'max_rss':0,'done':threading.Event()}
+        thread = threading.Thread(target=trace_rss,args=(state,))
+        thread.start()
+        try:
+            os.chdir(request['cwd'])
+            run_subset(parser.parse_args(request['argv']))
+            ret = 0
+        except SystemExit as e:
+            if e.code is None:
+                ret = 0
+            elif isinstance(e.code,int):
+                ret = e.code
+            else:
+                sys.stderr.write('{}\n'.format(e.code))
+                ret = 1
+        except BaseException:
+            traceback.print_exc()
+            ret = 1
+        finally:
+            state['done'].set()
+            thread.join()
+            clean_cache()
+            os.chdir(cwd)
+            sys.stdout.flush()
+            sys.stderr.flush()
+        usage2 = get_usage()
+        usage = {key:usage2[key]-usage1[key] for key in usage2}
+        usage['max_rss'] = state['max_rss'] # peak of this request
+        proto.write(json.dumps({'ret':ret,'usage':usage})+'\n')
+        proto.flush()
+elif args.inp_list is not None:
+    # Run subsets of the listed scenes in one session
+    ImageIO.setUseCache(False)
+    with open(args.inp_list,'r') as fp:
+        for line in fp:
+            item = [f.strip('"') for f in shlex.split(line,comments=True,posix=(os.name != 'nt'))] # quote file names with spaces
+            if len(item) < 1:
+                continue
+            opts = parser.parse_args(sys.argv[1:])
+            opts.inp_fnam = item[0]
+            opts.out_fnam = item[1] if len(item) > 1 else None
+            run_subset(opts)
+            clean_cache()
 else:
-    ProductIO.writeProduct(data,args.out_fnam,'BEAM-DIMAP')
+    run_subset(args)
+
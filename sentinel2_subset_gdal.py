@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+import os
+import sys
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from datetime import datetime
+import numpy as np
+try:
+    import gdal
+except Exception:
+    from osgeo import gdal
+try:
+    import osr
+except Exception:
+    from osgeo import osr
+from argparse import ArgumentParser,RawTextHelpFormatter
+
+# Constants
+D0 = datetime(2022,1,25) # L2A product Baseline 04.00
+# Bands in the same order and with the same names as the SNAP product (angle bands are not included)
+BAND_NAMES = ['B1','B2','B3','B4','B5','B6','B7','B8','B8A','B9','B11','B12',
+              'quality_aot','quality_wvp','quality_cloud_confidence','quality_snow_confidence','quality_scene_classification']
+BAND_PATTERNS = [('^.*_(B\d[\dA])_(\d\d)m\.jp2$',None),
+                 ('^.*_AOT_(\d\d)m\.jp2$','quality_aot'),
+                 ('^.*_WVP_(\d\d)m\.jp2$','quality_wvp'),
+                 ('^.*_CLD(?:PRB)?_(\d\d)m\.jp2$','quality_cloud_confidence'),
+                 ('^.*_SNW(?:PRB)?_(\d\d)m\.jp2$','quality_snow_confidence'),
+                 ('^.*_SCL_(\d\d)m\.jp2$','quality_scene_classification')]
+INDEX_BANDS = ['quality_scene_classification'] # resampled by nearest neighbor
+
+# Default values
+DATDIR = os.curdir
+POLYGON_CIHEA = 'POLYGON((107.201 -6.910,107.367 -6.910,107.367 -6.750,107.201 -6.750,107.201 -6.910))' # Cihea
+POLYGON_BOJONGSOANG = 'POLYGON((107.54 -7.04,107.75 -7.04,107.75 -6.95,107.54 -6.95,107.54 -7.04))' # Bojongsoang
+RESOLUTION = 10 # m
+NO_DATA = 0
+
+# Read options
+parser = ArgumentParser(formatter_class=lambda prog:RawTextHelpFormatter(prog,max_help_position=200,width=200))
+parser.add_argument('-I','--inp_fnam',default=None,help='Input file name (%(default)s)')
+parser.add_argument('-O','--out_fnam',default=None,help='Output file name (%(default)s)')
+parser.add_argument('-D','--datdir',default=DATDIR,help='Output data directory (%(default)s)')
+parser.add_argument('--site',default=None,help='Site name for preset coordinates (%(default)s)')
+parser.add_argument('--polygon',default=None,help='Polygon of ROI in WKT format (%(default)s)')
+parser.add_argument('-r','--resolution',default=RESOLUTION,type=int,help='Spatial resolution in m (%(default)s)')
+parser.add_argument('--no_data',default=NO_DATA,type=int,help='No-data value of L2A bands (%(default)s)')
+parser.add_argument('--overwrite',default=False,action='store_true',help='Overwrite mode (%(default)s)')
+args = parser.parse_args()
+
+zip_flag = False
+m = re.search('^[^_]+_[^_]+_([^_]+)_.*.SAFE$',os.path.basename(args.inp_fnam))
+if not m:
+    m = re.search('^[^_]+_[^_]+_([^_]+)_.*.zip$',os.path.basename(args.inp_fnam))
+    if not m:
+        raise ValueError('Error in file name >>> '+args.inp_fnam)
+    zip_flag = True
+dstr = m.group(1)[:8]
+if args.out_fnam is None:
+    args.out_fnam = os.path.join(args.datdir,'{}.tif'.format(dstr))
+if os.path.exists(args.out_fnam) and not args.overwrite:
+    sys.stderr.write('input: {}, output: {} ... exists, skip!\n'.format(args.inp_fnam,args.out_fnam))
+    sys.exit()
+if args.site is not None:
+    if args.site.lower() == 'cihea':
+        args.polygon = POLYGON_CIHEA
+    elif args.site.lower() == 'bojongsoang':
+        args.polygon = POLYGON_BOJONGSOANG
+    else:
+        raise ValueError('Error, unknown site >>> '+args.site)
+if args.polygon is None:
+    raise ValueError('Error, polygon={}'.format(args.polygon))
+
+# List files in the product (GDAL reads a zip file through /vsizip/)
+if zip_flag:
+    with zipfile.ZipFile(args.inp_fnam,'r') as z:
+        fnams = ['/vsizip/'+os.path.abspath(args.inp_fnam)+'/'+f for f in z.namelist()]
+else:
+    fnams = []
+    for root,dirs,files in os.walk(args.inp_fnam):
+        for f in files:
+            fnams.append(os.path.join(root,f))
+fnams = sorted(fnams)
+
+# Select the finest resolution for each band
+band_fnams = {}
+band_resos = {}
+for fnam in fnams:
+    f = os.path.basename(fnam)
+    for pattern,band_name in BAND_PATTERNS:
+        m = re.search(pattern,f)
+        if not m:
+            continue
+        if band_name is None:
+            band_name = m.group(1)
+            band_name = 'B'+band_name[1:].lstrip('0') if band_name[1:].isdigit() else band_name # B02 -> B2
+        reso = int(m.group(m.lastindex))
+        if not band_name in band_fnams or reso < band_resos[band_name]:
+            band_fnams[band_name] = fnam
+            band_resos[band_name] = reso
+        break
+for band_name in BAND_NAMES:
+    if not band_name in band_fnams:
+        raise ValueError('Error in finding {} >>> {}'.format(band_name,args.inp_fnam))
+
+# Read offsets from the product metadata
+offsets = None
+mnam = None
+for fnam in fnams:
+    if re.search('^MTD_MSIL2A\.xml$',os.path.basename(fnam)):
+        mnam = fnam
+        break
+if mnam is None:
+    raise ValueError('Error in finding MTD_MSIL2A.xml >>> {}'.format(args.inp_fnam))
+if zip_flag:
+    with zipfile.ZipFile(args.inp_fnam,'r') as z:
+        root = ET.fromstring(z.read(mnam[len('/vsizip/'+os.path.abspath(args.inp_fnam)+'/'):]))
+else:
+    root = ET.parse(mnam).getroot()
+band_ids = {}
+for elem in root.iter():
+    tag = elem.tag.split('}')[-1]
+    if tag == 'Spectral_Information':
+        band_ids[elem.get('bandId')] = elem.get('physicalBand')
+    elif tag == 'BOA_ADD_OFFSET':
+        if offsets is None:
+            offsets = {}
+        offsets[elem.get('band_id')] = float(elem.text)
+if offsets is not None:
+    offsets = {band_ids[band_id]:offsets[band_id] for band_id in offsets}
+add_offset = offsets is not None
+dtim = datetime.strptime(dstr,'%Y%m%d')
+if dtim < D0:
+    if add_offset:
+        sys.stderr.write('Warning, date={}, add_offset={} >>> {}\n'.format(dstr,add_offset,args.inp_fnam))
+        sys.stderr.flush()
+else:
+    if not add_offset:
+        raise ValueError('Error, date={}, add_offset={} >>> {}'.format(dstr,add_offset,args.inp_fnam))
+
+# Get the pixel region covering the polygon in the tile grid
+ds = gdal.Open(band_fnams['B2'])
+if ds is None:
+    raise IOError('Error, cannot open >>> {}'.format(band_fnams['B2']))
+src_nx = ds.RasterXSize
+src_ny = ds.RasterYSize
+src_prj = ds.GetProjection()
+src_trans = ds.GetGeoTransform()
+ds = None
+src_xmin = src_trans[0]
+src_ymax = src_trans[3]
+src_xmax = src_xmin+src_nx*src_trans[1]
+src_ymin = src_ymax+src_ny*src_trans[5]
+src_srs = osr.SpatialReference()
+src_srs.ImportFromEPSG(4326)
+dst_srs = osr.SpatialReference(wkt=src_prj)
+if hasattr(osr,'OAMS_TRADITIONAL_GIS_ORDER'):
+    src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+ct = osr.CoordinateTransformation(src_srs,dst_srs)
+values = [float(v) for v in re.findall('[+-]?\d+(?:\.\d*)?(?:[eE][+-]?\d+)?',args.polygon)]
+if len(values) < 6 or len(values)%2 != 0:
+    raise ValueError('Error in polygon >>> {}'.format(args.polygon))
+xp = []
+yp = []
+for lon,lat in zip(values[0::2],values[1::2]):
+    x,y,z = ct.TransformPoint(lon,lat)
+    xp.append(x)
+    yp.append(y)
+xstp = float(args.resolution)
+dst_xmin = max(src_xmin+np.floor((min(xp)-src_xmin)/xstp)*xstp,src_xmin)
+dst_xmax = min(src_xmin+np.ceil((max(xp)-src_xmin)/xstp)*xstp,src_xmax)
+dst_ymax = min(src_ymax-np.floor((src_ymax-max(yp))/xstp)*xstp,src_ymax)
+dst_ymin = max(src_ymax-np.ceil((src_ymax-min(yp))/xstp)*xstp,src_ymin)
+dst_nx = int((dst_xmax-dst_xmin)/xstp+0.5)
+dst_ny = int((dst_ymax-dst_ymin)/xstp+0.5)
+if dst_nx < 1 or dst_ny < 1:
+    raise ValueError('Error, no overlap with the polygon >>> {}'.format(args.inp_fnam))
+dst_trans = (dst_xmin,xstp,0.0,dst_ymax,0.0,-xstp)
+dst_nb = len(BAND_NAMES)
+dst_meta = {'FlagReplaceNoData':True,'FlagAddOffset':add_offset}
+
+# Resample, subset and write each band
+drv = gdal.GetDriverByName('GTiff')
+ds = drv.Create(args.out_fnam,dst_nx,dst_ny,dst_nb,gdal.GDT_Float32)
+ds.SetProjection(src_prj)
+ds.SetGeoTransform(dst_trans)
+ds.SetMetadata(dst_meta)
+for iband,band_name in enumerate(BAND_NAMES):
+    if band_name in INDEX_BANDS:
+        method = 'near'
+    elif band_resos[band_name] < args.resolution:
+        method = 'average' # Mean in SNAP
+    else:
+        method = 'bilinear'
+    options = '-of MEM -ot Float32'
+    options += ' -te {} {} {} {}'.format(dst_xmin,dst_ymin,dst_xmax,dst_ymax)
+    options += ' -tr {} {}'.format(xstp,xstp)
+    options += ' -r {}'.format(method)
+    options += ' -srcnodata {} -dstnodata {}'.format(args.no_data,args.no_data)
+    tmp_ds = gdal.Warp('',band_fnams[band_name],options=options)
+    if tmp_ds is None:
+        raise IOError('Error, cannot resample {} >>> {}'.format(band_name,band_fnams[band_name]))
+    data = tmp_ds.GetRasterBand(1).ReadAsArray().astype(np.float32)
+    tmp_ds = None
+    data[data == args.no_data] = np.nan # Replace no_data
+    if add_offset and band_name in offsets: # Add offset
+        data += offsets[band_name]
+    band = ds.GetRasterBand(iband+1)
+    band.WriteArray(data)
+    band.SetDescription(band_name)
+band.SetNoDataValue(np.nan) # The TIFFTAG_GDAL_NODATA only support one value per dataset
+ds.FlushCache()
+ds = None # close dataset
@@ -13,7 +13,6 @@ try:
     import osr
 except Exception:
     from osgeo import osr
-from scipy.interpolate import griddata
 from argparse import ArgumentParser,RawTextHelpFormatter
 
 # Defaults
@@ -29,6 +28,8 @@ YMAX_BOJONGSOANG = 9229335.0 # Bojongsoang, pixel center
 XSTP = 10.0
 YSTP = -10.0
 BAND_COL = 1
+METHOD = 'nearest'
+BLOCK_SIZE = 256 # rows
 
 # Read options
 parser = ArgumentParser(formatter_class=lambda prog:RawTextHelpFormatter(prog,max_help_position=200,width=200))
@@ -47,6 +48,8 @@ parser.add_argument('-y','--ymin',default=YMIN_CIHEA,type=float,help='Minimum Y
 parser.add_argument('-Y','--ymax',default=YMAX_CIHEA,type=float,help='Maximum Y in m (%(default)s)')
 parser.add_argument('--ystp',default=YSTP,type=float,help='Step Y in m (%(default)s)')
 parser.add_argument('--band_col',default=BAND_COL,help='Band column number (%(default)s)')
+parser.add_argument('--method',default=METHOD,help='Resampling method, nearest or linear (%(default)s)')
+parser.add_argument('--block_size',default=BLOCK_SIZE,type=int,help='Number of output rows processed at once (%(default)s)')
 parser.add_argument('--no_check_grid',default=False,action='store_true',help='Do not check grid (%(default)s)')
 parser.add_argument('--read_comments',default=False,action='store_true',help='Read comments from input_file (%(default)s)')
 parser.add_argument('-v','--verbose',default=False,action='store_true',help='Verbose mode (%(default)s)')
@@ -55,6 +58,8 @@ args = parser.parse_args()
 if args.out_fnam is None:
     bnam,enam = os.path.splitext(os.path.basename(args.inp_fnam))
     args.out_fnam = os.path.join(args.datdir,bnam+'_resample'+enam)
+if not args.method in ['nearest','linear']:
+    raise ValueError('Error, unknown resampling method >>> {}'.format(args.method))
 if os.path.exists(args.out_fnam) and not args.overwrite:
     sys.stderr.write('input: {}, output: {} ... exists, skip!\n'.format(args.inp_fnam,args.out_fnam))
     sys.exit()
@@ -73,8 +78,9 @@ if args.site is not None:
         raise ValueError('Error, unknown site >>> '+args.site)
 
 dst_trans = (args.xmin-0.5*args.xstp,args.xstp,0.0,args.ymax-0.5*args.ystp,0.0,args.ystp)
-dst_xp,dst_yp = np.meshgrid(np.arange(args.xmin,args.xmax+0.1*args.xstp,args.xstp),np.arange(args.ymax,args.ymin+0.1*args.ystp,args.ystp))
-dst_shape = dst_xp.shape
+dst_xp = np.arange(args.xmin,args.xmax+0.1*args.xstp,args.xstp)
+dst_yp = np.arange(args.ymax,args.ymin+0.1*args.ystp,args.ystp)
+dst_shape = (dst_yp.size,dst_xp.size)
 dst_ny,dst_nx = dst_shape
 
 ds = gdal.Open(args.inp_fnam)
@@ -85,16 +91,14 @@ src_shape = (src_ny,src_nx)
 src_prj = ds.GetProjection()
 src_trans = ds.GetGeoTransform()
 src_meta = ds.GetMetadata()
-src_data = ds.ReadAsArray().astype(np.float64).reshape(src_nb,src_ny,src_nx)
-src_indy,src_indx = np.indices(src_shape)
-src_xp = src_trans[0]+(src_indx+0.5)*src_trans[1]+(src_indy+0.5)*src_trans[2]
-src_yp = src_trans[3]+(src_indx+0.5)*src_trans[4]+(src_indy+0.5)*src_trans[5]
+src_xp = src_trans[0]+(np.arange(src_nx)+0.5)*src_trans[1]+0.5*src_trans[2] # first row
+src_yp = src_trans[3]+0.5*src_trans[4]+(np.arange(src_ny)+0.5)*src_trans[5] # first column
 if not args.no_check_grid:
-    indx1 = np.argmin(np.abs(src_xp[0,:]-dst_xp[0,0]))
-    indx2 = np.argmin(np.abs(src_xp[0,:]-dst_xp[0,-1]))+1
-    indy1 = np.argmin(np.abs(src_yp[:,0]-dst_yp[0,0]))
-    indy2 = np.argmin(np.abs(src_yp[:,0]-dst_yp[-1,0]))+1
-    if np.array_equal(dst_xp[0,:],src_xp[0,indx1:indx2]) and np.array_equal(dst_yp[:,0],src_yp[indy1:indy2,0]):
+    indx1 = np.argmin(np.abs(src_xp-dst_xp[0]))
+    indx2 = np.argmin(np.abs(src_xp-dst_xp[-1]))+1
+    indy1 = np.argmin(np.abs(src_yp-dst_yp[0]))
+    indy2 = np.argmin(np.abs(src_yp-dst_yp[-1]))+1
+    if np.array_equal(dst_xp,src_xp[indx1:indx2]) and np.array_equal(dst_yp,src_yp[indy1:indy2]):
         flag_grid = True
     else:
         flag_grid = False
@@ -198,26 +202,54 @@ dst_nb = len(indxs)
 if args.verbose:
     for i in indxs:
         sys.stderr.write('{}\n'.format(band_name[i]))
+def resample_block(band,y1,y2):
+    # Resample the output rows y1:y2 by index arithmetic between the affine grids
+    det = src_trans[1]*src_trans[5]-src_trans[2]*src_trans[4]
+    dx = dst_xp[None,:]-src_trans[0]
+    dy = dst_yp[y1:y2,None]-src_trans[3]
+    fx = (src_trans[5]*dx-src_trans[2]*dy)/det-0.5 # x index of the source pixel centers
+    fy = (src_trans[1]*dy-src_trans[4]*dx)/det-0.5 # y index of the source pixel centers
+    if args.method == 'nearest': # the nearest edge pixel is used outside the source as in griddata
+        ix = np.clip(np.floor(fx+0.5).astype(np.int64),0,src_nx-1)
+        iy = np.clip(np.floor(fy+0.5).astype(np.int64),0,src_ny-1)
+        i1 = iy.min()
+        j1 = ix.min()
+        data = band.ReadAsArray(int(j1),int(i1),int(ix.max()-j1+1),int(iy.max()-i1+1)).astype(np.float64)
+        return data[iy-i1,ix-j1]
+    ix = np.clip(np.floor(fx).astype(np.int64),0,max(src_nx-2,0))
+    iy = np.clip(np.floor(fy).astype(np.int64),0,max(src_ny-2,0))
+    wx = np.clip(fx-ix,0.0,1.0)
+    wy = np.clip(fy-iy,0.0,1.0)
+    ix2 = np.minimum(ix+1,src_nx-1)
+    iy2 = np.minimum(iy+1,src_ny-1)
+    i1 = iy.min()
+    j1 = ix.min()
+    data = band.ReadAsArray(int(j1),int(i1),int(ix2.max()-j1+1),int(iy2.max()-i1+1)).astype(np.float64)
+    return (data[iy-i1,ix-j1]*(1.0-wx)+data[iy-i1,ix2-j1]*wx)*(1.0-wy)+(data[iy2-i1,ix-j1]*(1.0-wx)+data[iy2-i1,ix2-j1]*wx)*wy
+
 if flag_grid:
     sys.stderr.write('############ No need to interpolate.\n')
-    dst_data = src_data[indxs,indy1:indy2,indx1:indx2]
-else:
-    dst_data = []
-    for i in indxs:
-        dst_data.append(griddata((src_xp.flatten(),src_yp.flatten()),src_data[i].flatten(),(dst_xp.flatten(),dst_yp.flatten()),method='nearest').reshape(dst_shape))
-    dst_data = np.array(dst_data)
 dst_meta = src_meta
 dst_prj = src_prj
 
+src_ds = gdal.Open(args.inp_fnam)
 drv = gdal.GetDriverByName('GTiff')
 ds = drv.Create(args.out_fnam,dst_nx,dst_ny,dst_nb,gdal.GDT_Float32)
 ds.SetProjection(dst_prj)
 ds.SetGeoTransform(dst_trans)
 ds.SetMetadata(dst_meta)
 for i in range(dst_nb):
+    inp_band = src_ds.GetRasterBand(indxs[i]+1)
     band = ds.GetRasterBand(i+1)
-    band.WriteArray(dst_data[i])
+    for y1 in range(0,dst_ny,args.block_size):
+        y2 = min(y1+args.block_size,dst_ny)
+        if flag_grid:
+            data = inp_band.ReadAsArray(int(indx1),int(indy1+y1),int(indx2-indx1),int(y2-y1))
+        else:
+            data = resample_block(inp_band,y1,y2)
+        band.WriteArray(data.astype(np.float32),0,y1)
     band.SetDescription(band_name[indxs[i]])
 band.SetNoDataValue(np.nan) # The TIFFTAG_GDAL_NODATA only support one value per dataset
 ds.FlushCache()
 ds = None # close dataset
+src_ds = None
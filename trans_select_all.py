@@ -11,6 +11,7 @@ from glob import glob
 from datetime import datetime
 import numpy as np
 from matplotlib.dates import date2num,num2date
+from proc_catalog import list_dir
 from argparse import ArgumentParser,RawTextHelpFormatter
 
 # Constants
@@ -105,7 +106,7 @@ for year in years:
     ynam = os.path.join(args.datdir,ystr)
     if not os.path.isdir(ynam):
         continue
-    for d in sorted(os.listdir(ynam)):
+    for d in list_dir(ynam):
         dnam = os.path.join(ynam,d)
         if not os.path.isdir(dnam):
             continue
@@ -13,6 +13,7 @@ import matplotlib.cm as cm
 from matplotlib.dates import date2num,num2date,YearLocator,MonthLocator,DayLocator,DateFormatter
 from matplotlib.backends.backend_pdf import PdfPages
 from mpl_toolkits.axes_grid1 import make_axes_locatable
+from proc_catalog import list_dir
 from argparse import ArgumentParser,RawTextHelpFormatter
 
 # Constants
@@ -128,7 +129,7 @@ for year in years:
     ynam = os.path.join(args.datdir,ystr)
     if not os.path.isdir(ynam):
         continue
-    for d in sorted(os.listdir(ynam)):
+    for d in list_dir(ynam):
         dnam = os.path.join(ynam,d)
         if not os.path.isdir(dnam):
             continue